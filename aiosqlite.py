@@ -1,40 +1,147 @@
 import asyncio
+import functools
+import itertools
+import queue
 import sqlite3
-from typing import Any, Iterable, Optional
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Iterable, NamedTuple, Optional
 
 Row = sqlite3.Row
 IntegrityError = sqlite3.IntegrityError
 
 
+class Executor:
+    """
+    Собственные потоки шима вместо общего пула asyncio.to_thread.
+
+    Состоит из max_workers однопоточных «полос»; каждое соединение при
+    открытии закрепляется за одной полосой, поэтому sqlite-объекты
+    никогда не переходят между потоками.
+    """
+
+    def __init__(self, max_workers: int = 4, thread_name_prefix: str = "aiosqlite"):
+        if max_workers < 1:
+            raise ValueError("max_workers must be >= 1")
+        self.max_workers = max_workers
+        self._lanes = [
+            ThreadPoolExecutor(1, thread_name_prefix=f"{thread_name_prefix}-{i}")
+            for i in range(max_workers)
+        ]
+        self._next = itertools.count()
+
+    def lane(self) -> ThreadPoolExecutor:
+        return self._lanes[next(self._next) % self.max_workers]
+
+    def shutdown(self, wait: bool = True) -> None:
+        for lane in self._lanes:
+            lane.shutdown(wait=wait)
+
+
+_default_executor: Executor | None = None
+
+
+def get_executor() -> Executor:
+    global _default_executor
+    if _default_executor is None:
+        _default_executor = Executor()
+    return _default_executor
+
+
+def set_executor(executor: Executor) -> None:
+    """Задаёт исполнитель для соединений, открытых без явного executor=."""
+    global _default_executor
+    _default_executor = executor
+
+
+def _execute_fetchone(conn: sqlite3.Connection, sql: str, parameters: tuple):
+    cursor = conn.execute(sql, parameters)
+    try:
+        return cursor.fetchone()
+    finally:
+        cursor.close()
+
+
+def _execute_fetchall(conn: sqlite3.Connection, sql: str, parameters: tuple):
+    cursor = conn.execute(sql, parameters)
+    try:
+        return cursor.fetchall()
+    finally:
+        cursor.close()
+
+
 class Cursor:
-    def __init__(self, cursor: sqlite3.Cursor):
+    def __init__(self, cursor: sqlite3.Cursor, lane: ThreadPoolExecutor):
         self._cursor = cursor
+        self._lane = lane
 
     async def fetchone(self) -> Optional[sqlite3.Row]:
-        return await asyncio.to_thread(self._cursor.fetchone)
+        return await _run(self._lane, self._cursor.fetchone)
 
     async def fetchall(self) -> list[sqlite3.Row]:
-        return await asyncio.to_thread(self._cursor.fetchall)
+        return await _run(self._lane, self._cursor.fetchall)
 
 
 class Connection:
-    def __init__(self, conn: sqlite3.Connection):
+    def __init__(self, conn: sqlite3.Connection, lane: ThreadPoolExecutor):
         self._conn = conn
+        self._lane = lane
 
     async def execute(self, sql: str, parameters: Iterable[Any] | None = None) -> Cursor:
         if parameters is None:
             parameters = ()
-        cursor = await asyncio.to_thread(self._conn.execute, sql, tuple(parameters))
-        return Cursor(cursor)
+        cursor = await _run(self._lane, self._conn.execute, sql, tuple(parameters))
+        return Cursor(cursor, self._lane)
+
+    async def execute_fetchone(
+        self, sql: str, parameters: Iterable[Any] | None = None
+    ) -> Optional[sqlite3.Row]:
+        """execute + fetchone за один переход в поток соединения."""
+        return await _run(
+            self._lane, _execute_fetchone, self._conn, sql, tuple(parameters or ())
+        )
+
+    async def execute_fetchall(
+        self, sql: str, parameters: Iterable[Any] | None = None
+    ) -> list[sqlite3.Row]:
+        """execute + fetchall за один переход в поток соединения."""
+        return await _run(
+            self._lane, _execute_fetchall, self._conn, sql, tuple(parameters or ())
+        )
 
     async def executescript(self, script: str) -> None:
-        await asyncio.to_thread(self._conn.executescript, script)
+        await _run(self._lane, self._conn.executescript, script)
+
+    async def backup(
+        self,
+        target: "Connection",
+        *,
+        pages: int = -1,
+        name: str = "main",
+        sleep: float = 0.25,
+    ) -> None:
+        """Копирует базу в target через backup API SQLite (в потоке источника)."""
+        await _run(
+            self._lane,
+            functools.partial(
+                self._conn.backup, target._conn, pages=pages, name=name, sleep=sleep
+            ),
+        )
 
     async def commit(self) -> None:
-        await asyncio.to_thread(self._conn.commit)
+        await _run(self._lane, self._conn.commit)
+
+    async def rollback(self) -> None:
+        await _run(self._lane, self._conn.rollback)
 
     async def close(self) -> None:
-        await asyncio.to_thread(self._conn.close)
+        await _run(self._lane, self._conn.close)
+
+    @property
+    def in_transaction(self) -> bool:
+        return self._conn.in_transaction
 
     @property
     def row_factory(self) -> Any:
@@ -45,7 +152,612 @@ class Connection:
         self._conn.row_factory = factory
 
 
-async def connect(path: str, **kwargs: Any) -> Connection:
+async def _run(lane: ThreadPoolExecutor, fn, *args: Any) -> Any:
+    return await asyncio.get_running_loop().run_in_executor(lane, fn, *args)
+
+
+async def connect(
+    path: str, *, executor: Executor | None = None, **kwargs: Any
+) -> Connection:
     kwargs.setdefault("check_same_thread", False)
-    conn = await asyncio.to_thread(sqlite3.connect, path, **kwargs)
-    return Connection(conn)
+    lane = (executor or get_executor()).lane()
+    conn = await _run(lane, functools.partial(sqlite3.connect, path, **kwargs))
+    return Connection(conn, lane)
+
+
+class PoolClosedError(RuntimeError):
+    pass
+
+
+class PooledConnection(Connection):
+    """
+    Соединение, выданное пулом: close() возвращает его в пул,
+    а не закрывает sqlite3-соединение.
+    """
+
+    def __init__(self, pool: "Pool", conn: Connection):
+        super().__init__(conn._conn, conn._lane)
+        self._pool = pool
+        self._raw = conn
+        self._released = False
+
+    async def close(self) -> None:
+        if self._released:
+            return
+        self._released = True
+        await self._pool.release(self._raw)
+
+
+class _Acquire:
+    def __init__(self, pool: "Pool"):
+        self._pool = pool
+        self._conn: PooledConnection | None = None
+
+    def __await__(self):
+        return self._pool._acquire().__await__()
+
+    async def __aenter__(self) -> PooledConnection:
+        self._conn = await self._pool._acquire()
+        return self._conn
+
+    async def __aexit__(self, *exc_info: Any) -> None:
+        await self._conn.close()
+
+
+class Pool:
+    """
+    Пул из фиксированного числа «тёплых» соединений к одной БД.
+
+        pool = Pool(path, size=4, row_factory=Row)
+        await pool.open()
+        async with pool.acquire() as db:
+            ...
+        db = await pool.acquire()   # db.close() вернёт соединение в пул
+
+    Перед выдачей соединения, простаивавшего дольше health_check_interval,
+    выполняется SELECT 1; битые соединения пересоздаются.
+    """
+
+    def __init__(
+        self,
+        path: str,
+        size: int = 4,
+        *,
+        row_factory: Any = None,
+        health_check_interval: float = 30.0,
+        **kwargs: Any,
+    ):
+        if size < 1:
+            raise ValueError("pool size must be >= 1")
+        self.path = path
+        self.size = size
+        self.row_factory = row_factory
+        self.health_check_interval = health_check_interval
+        self._kwargs = kwargs
+        self._lock = threading.Lock()
+        self._idle: deque[tuple[Connection, float]] = deque()
+        self._waiters: deque[asyncio.Future] = deque()
+        self._opened = 0
+        self._closed = False
+
+    @property
+    def closed(self) -> bool:
+        return self._closed
+
+    @property
+    def idle(self) -> int:
+        return len(self._idle)
+
+    async def open(self) -> None:
+        """Прогревает пул: открывает недостающие соединения заранее."""
+        while True:
+            with self._lock:
+                if self._closed or self._opened >= self.size:
+                    return
+                self._opened += 1
+            try:
+                conn = await self._connect()
+            except BaseException:
+                with self._lock:
+                    self._opened -= 1
+                raise
+            await self.release(conn)
+
+    def acquire(self) -> _Acquire:
+        return _Acquire(self)
+
+    async def _connect(self) -> Connection:
+        conn = await connect(self.path, **self._kwargs)
+        conn.row_factory = self.row_factory
+        return conn
+
+    async def _acquire(self) -> PooledConnection:
+        while True:
+            with self._lock:
+                if self._closed:
+                    raise PoolClosedError("pool is closed")
+                if self._idle:
+                    conn, last_used = self._idle.popleft()
+                    waiter = None
+                elif self._opened < self.size:
+                    self._opened += 1
+                    conn = last_used = waiter = None
+                else:
+                    conn = None
+                    waiter = asyncio.get_running_loop().create_future()
+                    self._waiters.append(waiter)
+
+            if waiter is not None:
+                try:
+                    conn = await waiter
+                except asyncio.CancelledError:
+                    with self._lock:
+                        if waiter in self._waiters:
+                            self._waiters.remove(waiter)
+                    if waiter.done() and not waiter.cancelled():
+                        await self.release(waiter.result())
+                    raise
+                last_used = time.monotonic()
+
+            if conn is None:
+                try:
+                    conn = await self._connect()
+                except BaseException:
+                    with self._lock:
+                        self._opened -= 1
+                    raise
+            elif time.monotonic() - last_used > self.health_check_interval:
+                if not await self._is_healthy(conn):
+                    await self._discard(conn)
+                    continue
+
+            return PooledConnection(self, conn)
+
+    async def release(self, conn: Connection) -> None:
+        if conn.in_transaction:
+            try:
+                await conn.rollback()
+            except sqlite3.Error:
+                await self._discard(conn)
+                return
+        conn.row_factory = self.row_factory
+
+        with self._lock:
+            if self._closed:
+                close_now = True
+            else:
+                close_now = False
+                while self._waiters:
+                    waiter = self._waiters.popleft()
+                    if waiter.done():
+                        continue
+                    waiter.get_loop().call_soon_threadsafe(
+                        _hand_over, self, waiter, conn
+                    )
+                    return
+                self._idle.append((conn, time.monotonic()))
+        if close_now:
+            await self._discard(conn)
+
+    async def _is_healthy(self, conn: Connection) -> bool:
+        try:
+            await conn.execute_fetchone("SELECT 1")
+        except sqlite3.Error:
+            return False
+        return True
+
+    async def _discard(self, conn: Connection) -> None:
+        with self._lock:
+            self._opened -= 1
+        try:
+            await conn.close()
+        except sqlite3.Error:
+            pass
+
+    async def close(self) -> None:
+        """Закрывает простаивающие соединения; занятые закроются при возврате."""
+        with self._lock:
+            self._closed = True
+            idle = [conn for conn, _ in self._idle]
+            self._idle.clear()
+            waiters = list(self._waiters)
+            self._waiters.clear()
+        for waiter in waiters:
+            if not waiter.done():
+                waiter.get_loop().call_soon_threadsafe(
+                    _fail_waiter, waiter, PoolClosedError("pool is closed")
+                )
+        for conn in idle:
+            await self._discard(conn)
+
+
+def _hand_over(pool: Pool, waiter: asyncio.Future, conn: Connection) -> None:
+    if waiter.done():
+        # ожидающий успел отмениться — возвращаем соединение в пул
+        asyncio.ensure_future(pool.release(conn))
+    else:
+        waiter.set_result(conn)
+
+
+def _fail_waiter(waiter: asyncio.Future, exc: BaseException) -> None:
+    if not waiter.done():
+        waiter.set_exception(exc)
+
+
+class WriterClosedError(RuntimeError):
+    pass
+
+
+class WriteResult(NamedTuple):
+    rowcount: int
+    lastrowid: Optional[int]
+    rows: list[tuple]
+
+
+class _WriteRequest:
+    __slots__ = ("statements", "future", "loop")
+
+    def __init__(self, statements, future: asyncio.Future, loop):
+        self.statements = statements
+        self.future = future
+        self.loop = loop
+
+    def resolve(self, result: Any, error: BaseException | None) -> None:
+        try:
+            self.loop.call_soon_threadsafe(_resolve, self.future, result, error)
+        except RuntimeError:
+            # цикл событий вызывающего уже закрыт
+            pass
+
+    def apply(self, conn: sqlite3.Connection) -> list[WriteResult]:
+        results = []
+        for sql, parameters, many in self.statements:
+            if many:
+                cursor = conn.executemany(sql, parameters)
+            else:
+                cursor = conn.execute(sql, parameters)
+            rows = cursor.fetchall()
+            results.append(WriteResult(cursor.rowcount, cursor.lastrowid, rows))
+        return results
+
+
+_STOP = object()
+
+
+class Writer:
+    """
+    Единственный писатель в БД: отдельный поток со своим соединением.
+
+    Запросы на запись складываются в очередь, поток забирает их группами
+    (не больше max_batch штук, ожидая добор не дольше max_delay секунд)
+    и коммитит каждую группу одной транзакцией — один fsync на группу.
+    Каждый запрос выполняется в своём SAVEPOINT, поэтому ошибка одного
+    (например, IntegrityError) не откатывает соседей по группе.
+    Future вызывающего завершается только после COMMIT группы.
+    """
+
+    def __init__(
+        self,
+        path: str,
+        *,
+        max_batch: int = 64,
+        max_delay: float = 0.002,
+        **kwargs: Any,
+    ):
+        self.path = path
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+        self._kwargs = kwargs
+        self._queue: queue.SimpleQueue = queue.SimpleQueue()
+        self._thread: threading.Thread | None = None
+        self._ready = threading.Event()
+        self._start_error: BaseException | None = None
+        self._closed = False
+        self.groups_committed = 0
+        self.requests_committed = 0
+
+    @property
+    def closed(self) -> bool:
+        return self._closed
+
+    def start(self) -> None:
+        if self._thread is not None:
+            return
+        self._thread = threading.Thread(
+            target=self._run, name="aiosqlite-writer", daemon=True
+        )
+        self._thread.start()
+        self._ready.wait()
+        if self._start_error is not None:
+            raise self._start_error
+
+    async def execute(
+        self, sql: str, parameters: Iterable[Any] | None = None
+    ) -> WriteResult:
+        (result,) = await self._submit([(sql, tuple(parameters or ()), False)])
+        return result
+
+    async def executemany(
+        self, sql: str, seq_of_parameters: Iterable[Iterable[Any]]
+    ) -> WriteResult:
+        seq = [tuple(p) for p in seq_of_parameters]
+        (result,) = await self._submit([(sql, seq, True)])
+        return result
+
+    async def transaction(
+        self, statements: Iterable[tuple[str, Iterable[Any]]]
+    ) -> list[WriteResult]:
+        """Несколько операторов атомарно: либо все, либо ни одного."""
+        return await self._submit(
+            [(sql, tuple(parameters or ()), False) for sql, parameters in statements]
+        )
+
+    async def _submit(self, statements) -> list[WriteResult]:
+        if self._closed:
+            raise WriterClosedError("writer is closed")
+        self.start()
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._queue.put(_WriteRequest(statements, future, loop))
+        return await future
+
+    def _run(self) -> None:
+        kwargs = dict(self._kwargs)
+        kwargs.setdefault("check_same_thread", False)
+        try:
+            conn = sqlite3.connect(self.path, isolation_level=None, **kwargs)
+        except BaseException as e:
+            self._start_error = e
+            self._ready.set()
+            return
+        self._ready.set()
+
+        stopping = False
+        try:
+            while not stopping:
+                item = self._queue.get()
+                if item is _STOP:
+                    break
+                batch = [item]
+                deadline = time.monotonic() + self.max_delay
+                while len(batch) < self.max_batch:
+                    try:
+                        item = self._queue.get_nowait()
+                    except queue.Empty:
+                        timeout = deadline - time.monotonic()
+                        if timeout <= 0:
+                            break
+                        try:
+                            item = self._queue.get(timeout=timeout)
+                        except queue.Empty:
+                            break
+                    if item is _STOP:
+                        stopping = True
+                        break
+                    batch.append(item)
+                self._commit_group(conn, batch)
+        finally:
+            conn.close()
+            self._fail_pending()
+
+    def _fail_pending(self) -> None:
+        while True:
+            try:
+                item = self._queue.get_nowait()
+            except queue.Empty:
+                return
+            if item is _STOP:
+                continue
+            item.resolve(None, WriterClosedError("writer is closed"))
+
+    def _commit_group(self, conn: sqlite3.Connection, batch: list) -> None:
+        outcomes = []
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            for request in batch:
+                conn.execute("SAVEPOINT write_request")
+                try:
+                    result = request.apply(conn)
+                except Exception as e:
+                    conn.execute("ROLLBACK TO write_request")
+                    conn.execute("RELEASE write_request")
+                    outcomes.append((request, None, e))
+                else:
+                    conn.execute("RELEASE write_request")
+                    outcomes.append((request, result, None))
+            conn.execute("COMMIT")
+        except Exception as e:
+            if conn.in_transaction:
+                conn.execute("ROLLBACK")
+            outcomes = [(request, None, e) for request in batch]
+        else:
+            self.groups_committed += 1
+            self.requests_committed += len(batch)
+
+        for request, result, error in outcomes:
+            request.resolve(result, error)
+
+    async def close(self) -> None:
+        """Дожидается записи всего, что уже в очереди, и останавливает поток."""
+        if self._closed:
+            return
+        self._closed = True
+        if self._thread is None:
+            return
+        self._queue.put(_STOP)
+        await asyncio.to_thread(self._thread.join)
+
+
+def _resolve(future: asyncio.Future, result: Any, error: BaseException | None) -> None:
+    if future.done():
+        return
+    if error is not None:
+        future.set_exception(error)
+    else:
+        future.set_result(result)
+
+
+class _RemoteWriteRequest(_WriteRequest):
+    """Запрос из другого процесса: ответ уходит обратно по его соединению."""
+
+    __slots__ = ("request_id", "reply")
+
+    def __init__(self, statements, request_id: int, reply):
+        super().__init__(statements, None, None)
+        self.request_id = request_id
+        self.reply = reply
+
+    def resolve(self, result: Any, error: BaseException | None) -> None:
+        self.reply(self.request_id, result, error)
+
+
+class WriterServer:
+    """
+    Отдаёт Writer процессам-воркерам.
+
+    Каждое multiprocessing.Connection обслуживает свой поток: принимает
+    (request_id, statements), ставит запрос в очередь писателя наравне с
+    локальными, а ответ (request_id, результат, ошибка) отправляет поток
+    писателя после COMMIT группы. Групповой коммит работает через все
+    процессы сразу.
+    """
+
+    def __init__(self, writer: Writer):
+        self.writer = writer
+        self._threads: list[threading.Thread] = []
+
+    def serve(self, conn) -> None:
+        thread = threading.Thread(
+            target=self._serve,
+            args=(conn,),
+            name="aiosqlite-writer-server",
+            daemon=True,
+        )
+        self._threads.append(thread)
+        thread.start()
+
+    def _serve(self, conn) -> None:
+        lock = threading.Lock()
+
+        def reply(request_id, result, error):
+            with lock:
+                try:
+                    conn.send((request_id, result, error))
+                except (OSError, ValueError):
+                    # воркер уже отключился
+                    pass
+                except Exception as e:
+                    # ошибка, которую не удалось упаковать pickle
+                    conn.send((request_id, None, RuntimeError(repr(error or e))))
+
+        try:
+            while True:
+                message = conn.recv()
+                if message is None:
+                    break
+                request_id, statements = message
+                if self.writer.closed:
+                    reply(request_id, None, WriterClosedError("writer is closed"))
+                    continue
+                self.writer.start()
+                self.writer._queue.put(
+                    _RemoteWriteRequest(statements, request_id, reply)
+                )
+        except (EOFError, OSError):
+            pass
+        finally:
+            with lock:
+                conn.close()
+
+    def join(self, timeout: float | None = None) -> None:
+        for thread in self._threads:
+            thread.join(timeout)
+
+
+class RemoteWriter:
+    """
+    Writer из другого процесса: тот же интерфейс (execute, executemany,
+    transaction), но запросы уходят по multiprocessing.Connection к
+    WriterServer. Ответы читает отдельный поток.
+    """
+
+    def __init__(self, conn, path: str):
+        self.path = path
+        self._conn = conn
+        self._seq = itertools.count()
+        self._waiters: dict[int, _WriteRequest] = {}
+        self._lock = threading.Lock()
+        self._thread: threading.Thread | None = None
+        self._closed = False
+        self.requests_committed = 0
+
+    @property
+    def closed(self) -> bool:
+        return self._closed
+
+    def start(self) -> None:
+        if self._thread is not None:
+            return
+        self._thread = threading.Thread(
+            target=self._run, name="aiosqlite-remote-writer", daemon=True
+        )
+        self._thread.start()
+
+    execute = Writer.execute
+    executemany = Writer.executemany
+    transaction = Writer.transaction
+
+    async def _submit(self, statements) -> list[WriteResult]:
+        if self._closed:
+            raise WriterClosedError("writer is closed")
+        self.start()
+        loop = asyncio.get_running_loop()
+        request = _WriteRequest(statements, loop.create_future(), loop)
+        with self._lock:
+            # поток ответов мог уже закрыться и разобрать ожидающих
+            if self._closed:
+                raise WriterClosedError("writer is closed")
+            request_id = next(self._seq)
+            try:
+                self._conn.send((request_id, statements))
+            except OSError:
+                self._closed = True  # сервер ушёл — это не ошибка запроса
+                raise WriterClosedError("writer is closed") from None
+            self._waiters[request_id] = request
+        results = await request.future
+        self.requests_committed += 1
+        return results
+
+    def _run(self) -> None:
+        try:
+            while True:
+                request_id, result, error = self._conn.recv()
+                with self._lock:
+                    request = self._waiters.pop(request_id)
+                request.resolve(result, error)
+        except (EOFError, OSError):
+            pass
+        finally:
+            self._closed = True
+            with self._lock:
+                waiters = list(self._waiters.values())
+                self._waiters.clear()
+            for request in waiters:
+                request.resolve(None, WriterClosedError("writer is closed"))
+
+    async def close(self) -> None:
+        """Отключается от сервера; незавершённые запросы получат ошибку."""
+        if self._closed:
+            return
+        self._closed = True
+        with self._lock:
+            pending = [request.future for request in self._waiters.values()]
+        await asyncio.gather(*pending, return_exceptions=True)
+        with self._lock:
+            try:
+                self._conn.send(None)
+            except OSError:
+                pass
+        if self._thread is not None:
+            await asyncio.to_thread(self._thread.join)
+        self._conn.close()
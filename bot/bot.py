@@ -1,11 +1,26 @@
 #!/usr/bin/env python3
 import asyncio
+import hmac
+import html
+import itertools
 import json
 import logging
 import math
+import multiprocessing
 import os
+import re
+import secrets
+import signal
+import threading
+import time
+import uuid
+import zlib
+from array import array
+from collections import Counter, OrderedDict, deque
 from urllib.parse import parse_qsl, urlencode, urlparse, urlunparse
-from datetime import datetime
+from datetime import datetime, timezone
+from enum import Enum
+from typing import TypedDict
 
 import aiosqlite
 from aiogram import Bot, Dispatcher, F, Router, types
@@ -23,6 +38,21 @@ from aiogram.types import (
 )
 from dotenv import load_dotenv
 
+try:
+    import numpy as np
+except ImportError:  # без numpy пакетный пересчёт геозоны идёт обычным циклом
+    np = None
+
+try:
+    import orjson
+except ImportError:  # без orjson payload'ы разбирает стандартный json
+    orjson = None
+
+try:
+    from aiohttp import web
+except ImportError:  # без aiohttp работает только long polling
+    web = None
+
 # -----------------------------
 #  НАСТРОЙКИ / ENV
 # -----------------------------
@@ -37,6 +67,63 @@ MASTER_ADMIN_IDS = {
 }
 
 DB_PATH = os.getenv("DB_PATH", "attendance.db")
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "4"))
+DB_THREADS = int(os.getenv("DB_THREADS", str(DB_POOL_SIZE)))
+DB_WRITE_BATCH = int(os.getenv("DB_WRITE_BATCH", "64"))
+DB_WRITE_DELAY_MS = float(os.getenv("DB_WRITE_DELAY_MS", "2"))
+ROLE_CACHE_SIZE = int(os.getenv("ROLE_CACHE_SIZE", "10000"))
+ROLE_CACHE_TTL = float(os.getenv("ROLE_CACHE_TTL", "600"))
+PROFILE_CACHE_SIZE = int(os.getenv("PROFILE_CACHE_SIZE", "10000"))
+PROFILE_TOUCH_INTERVAL = float(os.getenv("PROFILE_TOUCH_INTERVAL", "60"))
+GEO_TRACK_SIZE = int(os.getenv("GEO_TRACK_SIZE", "32"))
+GEO_MIN_INTERVAL = float(os.getenv("GEO_MIN_INTERVAL", "5"))  # секунды
+GEO_MIN_DISTANCE = float(os.getenv("GEO_MIN_DISTANCE", "10"))  # метры
+GEO_MAX_USERS = int(os.getenv("GEO_MAX_USERS", "20000"))
+GEO_MAX_PENDING = int(os.getenv("GEO_MAX_PENDING", "100000"))
+GEO_FLUSH_INTERVAL = float(os.getenv("GEO_FLUSH_INTERVAL", "15"))
+GEO_FIX_MAX_AGE = float(os.getenv("GEO_FIX_MAX_AGE", "120"))
+PAYLOAD_FLUSH_INTERVAL = float(os.getenv("PAYLOAD_FLUSH_INTERVAL", "5"))
+PAYLOAD_MAX_PENDING = int(os.getenv("PAYLOAD_MAX_PENDING", "50000"))
+PAYLOAD_DICT_SIZE = int(os.getenv("PAYLOAD_DICT_SIZE", "16384"))  # байты, до 32 КБ
+PAYLOAD_DICT_SAMPLES = int(os.getenv("PAYLOAD_DICT_SAMPLES", "500"))
+# Откуда читают отчётные запросы (статистика, выгрузки):
+# live — общий пул; readonly — отдельный пул mode=ro к той же базе;
+# snapshot — периодически обновляемая копия базы (backup API).
+REPORTING_MODE = os.getenv("REPORTING_MODE", "live").lower()
+REPORTING_SNAPSHOT_PATH = os.getenv("REPORTING_SNAPSHOT_PATH", "")  # пусто — в памяти
+REPORTING_REFRESH_INTERVAL = float(os.getenv("REPORTING_REFRESH_INTERVAL", "60"))
+REPORTING_POOL_SIZE = int(os.getenv("REPORTING_POOL_SIZE", "2"))
+INGEST_CONCURRENCY = int(os.getenv("INGEST_CONCURRENCY", "16"))
+INGEST_QUEUE_LIMIT = int(os.getenv("INGEST_QUEUE_LIMIT", "2000"))
+# web_app_data длиннее 4096 байт Telegram и так не пропускает
+PAYLOAD_MAX_BYTES = int(os.getenv("PAYLOAD_MAX_BYTES", "4096"))
+# Лимиты Telegram на исходящие: ~30 сообщений/с на бота, 1/с в личный чат,
+# 20/мин в группу. Берём с запасом.
+SEND_GLOBAL_RATE = float(os.getenv("SEND_GLOBAL_RATE", "25"))  # сообщений в секунду
+SEND_CHAT_RATE = float(os.getenv("SEND_CHAT_RATE", "1"))
+SEND_GROUP_PER_MINUTE = float(os.getenv("SEND_GROUP_PER_MINUTE", "20"))
+SEND_CONCURRENCY = int(os.getenv("SEND_CONCURRENCY", "8"))
+SEND_MAX_ATTEMPTS = int(os.getenv("SEND_MAX_ATTEMPTS", "5"))
+SEND_RETRY_DELAY = float(os.getenv("SEND_RETRY_DELAY", "30"))  # секунды, растёт вдвое
+SEND_RETRY_INTERVAL = float(os.getenv("SEND_RETRY_INTERVAL", "15"))
+SEND_RETRY_LEASE = float(os.getenv("SEND_RETRY_LEASE", "600"))
+# Вебхук вместо long polling, если задан WEBHOOK_URL (публичный https-адрес,
+# который проксируется на WEBHOOK_HOST:WEBHOOK_PORT)
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "")
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/telegram/webhook")
+WEBHOOK_HOST = os.getenv("WEBHOOK_HOST", "127.0.0.1")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", "8080"))
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "")  # пусто — случайный на каждый запуск
+WEBHOOK_MAX_CONNECTIONS = int(os.getenv("WEBHOOK_MAX_CONNECTIONS", "40"))
+# Окно, в котором повторная доставка того же апдейта (callback, web_app_data)
+# не обрабатывается заново. IDEMPOTENCY_PERSIST=1 — помнить и между рестартами.
+IDEMPOTENCY_TTL = float(os.getenv("IDEMPOTENCY_TTL", "3600"))  # секунды
+IDEMPOTENCY_SIZE = int(os.getenv("IDEMPOTENCY_SIZE", "50000"))
+IDEMPOTENCY_PERSIST = os.getenv("IDEMPOTENCY_PERSIST", "0") == "1"
+# Процессов-воркеров; больше одного — только вместе с вебхуком
+WORKERS = int(os.getenv("WORKERS", "1"))
+DEFAULT_GEO_RADIUS = 150.0  # базовый радиус геозоны в метрах
+GEO_ZONE_CELL_DEG = float(os.getenv("GEO_ZONE_CELL_DEG", "0.005"))  # ≈ 550 м по широте
 
 if not BOT_TOKEN:
     raise RuntimeError("BOT_TOKEN не задан (env или .env).")
@@ -82,8 +169,23 @@ def build_webapp_url(base_url: str, params: dict[str, str]) -> str:
     return urlunparse(parsed._replace(query=new_query))
 
 
-def now_iso() -> str:
-    return datetime.utcnow().isoformat(timespec="seconds")
+# Время в БД хранится целым числом миллисекунд Unix (UTC):
+# компактно, сравнивается как число и годится для индексов по диапазону.
+
+
+def now_ms() -> int:
+    return time.time_ns() // 1_000_000
+
+
+def ms_to_datetime(ms: int) -> datetime:
+    return datetime.fromtimestamp(ms / 1000, tz=timezone.utc)
+
+
+def datetime_to_ms(dt: datetime) -> int:
+    """Наивный datetime считается UTC."""
+    if dt.tzinfo is None:
+        dt = dt.replace(tzinfo=timezone.utc)
+    return int(dt.timestamp() * 1000)
 
 
 def haversine_m(lat1: float, lon1: float, lat2: float, lon2: float) -> float:
@@ -103,357 +205,3350 @@ def haversine_m(lat1: float, lon1: float, lat2: float, lon2: float) -> float:
     return R * c
 
 
-async def get_db() -> aiosqlite.Connection:
-    db = await aiosqlite.connect(DB_PATH)
-    db.row_factory = aiosqlite.Row
-    return db
+def haversine_m_vec(lats, lons, lat0: float, lon0: float):
+    """
+    Векторная версия haversine_m: расстояния в метрах от массивов точек
+    (numpy.ndarray) до одной точки. NaN в координатах даёт NaN.
+    """
+    R = 6371000.0
+    phi1 = np.radians(lats)
+    phi2 = math.radians(lat0)
+    d_phi = np.radians(lat0 - lats)
+    d_lambda = np.radians(lon0 - lons)
 
+    a = np.sin(d_phi / 2) ** 2 + np.cos(phi1) * math.cos(phi2) * np.sin(
+        d_lambda / 2
+    ) ** 2
+    return R * 2 * np.arctan2(np.sqrt(a), np.sqrt(1 - a))
 
-async def init_db():
-    db = await get_db()
-    try:
-        await db.executescript(
-            """
-            PRAGMA journal_mode=WAL;
-
-            CREATE TABLE IF NOT EXISTS users (
-                telegram_id   INTEGER PRIMARY KEY,
-                first_name    TEXT,
-                last_name     TEXT,
-                username      TEXT,
-                fio           TEXT,
-                email         TEXT,
-                role          TEXT DEFAULT 'student',
-                created_at    TEXT DEFAULT (datetime('now')),
-                updated_at    TEXT DEFAULT (datetime('now'))
-            );
-
-            CREATE TABLE IF NOT EXISTS settings (
-                key   TEXT PRIMARY KEY,
-                value TEXT
-            );
-
-            CREATE TABLE IF NOT EXISTS lectures (
-                id           TEXT PRIMARY KEY,
-                is_open      INTEGER DEFAULT 0,
-                created_by   INTEGER,
-                geo_lat      REAL,
-                geo_lon      REAL,
-                geo_radius   REAL DEFAULT 150.0, -- радиус в метрах
-                opened_at    TEXT,
-                closed_at    TEXT
-            );
-
-            CREATE TABLE IF NOT EXISTS attendances (
-                id             INTEGER PRIMARY KEY AUTOINCREMENT,
-                user_id        INTEGER,
-                lecture_id     TEXT,
-                created_at     TEXT DEFAULT (datetime('now')),
-                status         TEXT, -- pending, approved, rejected, pending_video
-                geo_lat        REAL,
-                geo_lon        REAL,
-                geo_accuracy   REAL,
-                device         TEXT,
-                extra_json     TEXT,
-                video_chat_id  INTEGER,
-                video_message_id INTEGER,
-                reviewer_id    INTEGER,
-                reviewed_at    TEXT,
-                FOREIGN KEY(user_id) REFERENCES users(telegram_id),
-                FOREIGN KEY(lecture_id) REFERENCES lectures(id)
-            );
-
-            CREATE UNIQUE INDEX IF NOT EXISTS idx_att_unique
-                ON attendances(user_id, lecture_id);
-            """
+
+# Собственные потоки для SQLite: каждое соединение пула живёт в своём потоке
+# и не делит дефолтный executor цикла с остальным кодом.
+db_executor = aiosqlite.Executor(DB_THREADS, thread_name_prefix="attendance-db")
+_db_pool: aiosqlite.Pool | None = None
+
+
+async def get_pool() -> aiosqlite.Pool:
+    """
+    Пул соединений к DB_PATH. Пересоздаётся, если DB_PATH поменяли
+    (например, в тестах).
+    """
+    global _db_pool
+    if _db_pool is None or _db_pool.closed or _db_pool.path != DB_PATH:
+        old_pool = _db_pool
+        _db_pool = aiosqlite.Pool(
+            DB_PATH,
+            size=DB_POOL_SIZE,
+            row_factory=aiosqlite.Row,
+            executor=db_executor,
         )
-        await db.commit()
-    finally:
-        await db.close()
+        if old_pool is not None:
+            await old_pool.close()
+    return _db_pool
 
 
-async def get_setting(key: str) -> str | None:
-    db = await get_db()
-    try:
-        cur = await db.execute("SELECT value FROM settings WHERE key = ?", (key,))
-        row = await cur.fetchone()
-        return row["value"] if row else None
-    finally:
-        await db.close()
+async def get_db() -> aiosqlite.Connection:
+    """
+    Берёт соединение из пула. db.close() возвращает его обратно.
+    """
+    pool = await get_pool()
+    return await pool.acquire()
 
 
-async def set_setting(key: str, value: str):
-    db = await get_db()
-    try:
-        await db.execute(
-            """
-            INSERT INTO settings (key, value)
-            VALUES (?, ?)
-            ON CONFLICT(key) DO UPDATE SET value=excluded.value
-            """,
-            (key, value),
+_db_writer: aiosqlite.Writer | None = None
+# В воркере писатель — RemoteWriter к супервизору, своего поток не заводим
+_writer_remote = False
+
+
+async def get_writer() -> aiosqlite.Writer:
+    """
+    Единственный писатель в DB_PATH (отдельный поток с групповым коммитом).
+    Все изменения данных идут через него, чтобы транзакции не дрались
+    за блокировку WAL.
+    """
+    global _db_writer
+    if _writer_remote:
+        # второй писатель в ту же БД — ровно то, от чего уходили
+        if _db_writer is None or _db_writer.closed:
+            raise aiosqlite.WriterClosedError("supervisor writer is closed")
+        return _db_writer
+    if _db_writer is None or _db_writer.closed or _db_writer.path != DB_PATH:
+        old_writer = _db_writer
+        _db_writer = aiosqlite.Writer(
+            DB_PATH,
+            max_batch=DB_WRITE_BATCH,
+            max_delay=DB_WRITE_DELAY_MS / 1000,
+            uri=DB_PATH.startswith("file:"),
         )
-        await db.commit()
-    finally:
-        await db.close()
+        if old_writer is not None:
+            await old_writer.close()
+    return _db_writer
 
 
-async def ensure_user(message: Message) -> None:
+async def db_write(sql: str, parameters: tuple = ()) -> aiosqlite.WriteResult:
+    writer = await get_writer()
+    return await writer.execute(sql, parameters)
+
+
+def readonly_uri(path: str) -> str:
+    if not path.startswith("file:"):
+        return f"file:{os.path.abspath(path)}?mode=ro"
+    if "mode=" in path:
+        return path
+    return path + ("&" if "?" in path else "?") + "mode=ro"
+
+
+class ReportingStore:
     """
-    Создаёт/обновляет пользователя в БД.
+    Соединения для отчётных запросов, чтобы аналитика не конкурировала
+    с записью отметок (см. REPORTING_MODE).
+
+    В режиме snapshot refresh() снимает копию живой базы через backup API
+    в новую базу (в памяти или во временный файл) и атомарно подменяет пул;
+    запросы, уже идущие по старой копии, спокойно дочитывают её.
+
+    У отчётов свои потоки SQLite: долгий запрос или backup занимает полосу
+    reporting.executor, а не ту, на которой живут соединения общего пула.
     """
-    db = await get_db()
-    try:
-        u = message.from_user
-        await db.execute(
-            """
-            INSERT INTO users (telegram_id, first_name, last_name, username, updated_at)
-            VALUES (?, ?, ?, ?, ?)
-            ON CONFLICT(telegram_id) DO UPDATE SET
-                first_name = excluded.first_name,
-                last_name  = excluded.last_name,
-                username   = excluded.username,
-                updated_at = excluded.updated_at
-            """,
-            (
-                u.id,
-                u.first_name,
-                u.last_name,
-                u.username,
-                now_iso(),
-            ),
+
+    MODES = ("live", "readonly", "snapshot")
+
+    def __init__(self, mode: str, snapshot_path: str, pool_size: int):
+        if mode not in self.MODES:
+            raise ValueError(f"REPORTING_MODE must be one of {self.MODES}, got {mode!r}")
+        self.mode = mode
+        self.snapshot_path = snapshot_path
+        self.pool_size = pool_size
+        # +1 полоса под источник backup, чтобы срез не ждал отчётов
+        self.executor = aiosqlite.Executor(
+            pool_size + 1, thread_name_prefix="attendance-report"
+        )
+        self.refreshed_at: int | None = None
+        self._pool: aiosqlite.Pool | None = None
+        self._keeper: aiosqlite.Connection | None = None  # держит копию в памяти
+        self._lock: asyncio.Lock | None = None
+
+    def _new_pool(self, path: str) -> aiosqlite.Pool:
+        return aiosqlite.Pool(
+            path,
+            size=self.pool_size,
+            row_factory=aiosqlite.Row,
+            executor=self.executor,
+            uri=True,
         )
-        await db.commit()
-    finally:
-        await db.close()
 
+    async def acquire(self) -> aiosqlite.Connection:
+        if self.mode == "live":
+            return await get_db()
+        if self.mode == "readonly":
+            path = readonly_uri(DB_PATH)
+            if self._pool is None or self._pool.closed or self._pool.path != path:
+                old_pool, self._pool = self._pool, self._new_pool(path)
+                if old_pool is not None:
+                    await old_pool.close()
+            return await self._pool.acquire()
+        if self._pool is None:
+            await self.refresh()
+        return await self._pool.acquire()
+
+    async def refresh(self) -> int:
+        """Снимает новый срез (только для snapshot). Возвращает его время, мс."""
+        if self.mode != "snapshot":
+            raise RuntimeError("refresh() is only available in snapshot mode")
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        async with self._lock:
+            taken_at = now_ms()
+            if self.snapshot_path:
+                pool, keeper = await self._snapshot_to_file(), None
+            else:
+                pool, keeper = await self._snapshot_to_memory()
+            old_pool, old_keeper = self._pool, self._keeper
+            self._pool, self._keeper = pool, keeper
+            self.refreshed_at = taken_at
+        if old_pool is not None:
+            await old_pool.close()
+        if old_keeper is not None:
+            await old_keeper.close()
+        return taken_at
+
+    async def _backup_into(self, target: aiosqlite.Connection) -> None:
+        # своё соединение, а не из get_db(): backup всей базы не должен
+        # держать соединение и поток, которых ждут отметки
+        source = await aiosqlite.connect(
+            DB_PATH, uri=DB_PATH.startswith("file:"), executor=self.executor
+        )
+        try:
+            await source.backup(target)
+        finally:
+            await source.close()
 
-async def set_user_profile(telegram_id: int, fio: str | None, email: str | None):
-    db = await get_db()
-    try:
-        await db.execute(
-            """
-            UPDATE users
-               SET fio = COALESCE(?, fio),
-                   email = COALESCE(?, email),
-                   updated_at = ?
-             WHERE telegram_id = ?
-            """,
-            (fio, email, now_iso(), telegram_id),
+    async def _snapshot_to_memory(self):
+        path = f"file:reporting-{uuid.uuid4().hex}?mode=memory&cache=shared"
+        keeper = await aiosqlite.connect(path, uri=True, executor=self.executor)
+        try:
+            await self._backup_into(keeper)
+        except BaseException:
+            await keeper.close()
+            raise
+        return self._new_pool(path), keeper
+
+    async def _snapshot_to_file(self) -> aiosqlite.Pool:
+        tmp_path = self.snapshot_path + ".tmp"
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        target = await aiosqlite.connect(tmp_path, executor=self.executor)
+        try:
+            await self._backup_into(target)
+            # копии не нужен WAL: только чтение, без -wal/-shm рядом
+            await target.execute("PRAGMA journal_mode=DELETE")
+        finally:
+            await target.close()
+        # открытые соединения дочитывают старый файл, новые видят свежий
+        os.replace(tmp_path, self.snapshot_path)
+        return self._new_pool(readonly_uri(self.snapshot_path))
+
+    async def close(self) -> None:
+        pool, self._pool = self._pool, None
+        keeper, self._keeper = self._keeper, None
+        self.refreshed_at = None
+        self._lock = None
+        if pool is not None:
+            await pool.close()
+        if keeper is not None:
+            await keeper.close()
+
+
+reporting = ReportingStore(REPORTING_MODE, REPORTING_SNAPSHOT_PATH, REPORTING_POOL_SIZE)
+
+
+async def get_report_db() -> aiosqlite.Connection:
+    """Соединение для отчётов; db.close() возвращает его в пул."""
+    return await reporting.acquire()
+
+
+async def close_db(keep_pending: bool = False) -> None:
+    """
+    Останавливает писателя и пул. Кэши в памяти зеркалят БД, поэтому
+    вместе с соединениями сбрасываются и они. С keep_pending буферы, ещё
+    не записанные в БД, остаются — их допишет следующий flush.
+    """
+    global _db_pool, _db_writer
+    role_cache.clear()
+    settings_cache.clear()
+    profile_cache.clear()
+    lecture_registry.clear()
+    geo_store.clear(keep_pending)
+    payload_archive.clear(keep_pending)
+    idempotency.clear()
+    if _db_writer is not None:
+        writer, _db_writer = _db_writer, None
+        await writer.close()
+    await reporting.close()
+    if _db_pool is not None:
+        pool, _db_pool = _db_pool, None
+        await pool.close()
+
+
+# Счётчики lecture_stats с нуля — для первичного заполнения и проверки.
+LECTURE_STATS_AGGREGATE_SQL = """
+    SELECT lecture_id,
+           COUNT(*) AS total,
+           SUM(status IS 'approved') AS approved,
+           SUM(status IS 'pending_video') AS pending_video,
+           SUM(status IS 'pending') AS pending,
+           SUM(status IS 'rejected') AS rejected
+      FROM attendances
+     GROUP BY lecture_id
+"""
+
+
+# Триггеры, которые ведут lecture_stats (миграция 3; после пересборки
+# attendances их нужно создать заново).
+LECTURE_STATS_TRIGGERS = (
+    """
+    CREATE TRIGGER IF NOT EXISTS trg_lecture_stats_insert
+    AFTER INSERT ON attendances
+    BEGIN
+        INSERT INTO lecture_stats
+            (lecture_id, total, approved, pending_video, pending, rejected)
+        VALUES (
+            NEW.lecture_id,
+            1,
+            NEW.status IS 'approved',
+            NEW.status IS 'pending_video',
+            NEW.status IS 'pending',
+            NEW.status IS 'rejected'
         )
-        await db.commit()
-    finally:
-        await db.close()
+        ON CONFLICT(lecture_id) DO UPDATE SET
+            total = total + 1,
+            approved = approved + excluded.approved,
+            pending_video = pending_video + excluded.pending_video,
+            pending = pending + excluded.pending,
+            rejected = rejected + excluded.rejected;
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS trg_lecture_stats_update
+    AFTER UPDATE OF status ON attendances
+    WHEN OLD.status IS NOT NEW.status
+    BEGIN
+        UPDATE lecture_stats
+           SET approved = approved
+                   - (OLD.status IS 'approved') + (NEW.status IS 'approved'),
+               pending_video = pending_video
+                   - (OLD.status IS 'pending_video') + (NEW.status IS 'pending_video'),
+               pending = pending
+                   - (OLD.status IS 'pending') + (NEW.status IS 'pending'),
+               rejected = rejected
+                   - (OLD.status IS 'rejected') + (NEW.status IS 'rejected')
+         WHERE lecture_id = NEW.lecture_id;
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS trg_lecture_stats_delete
+    AFTER DELETE ON attendances
+    BEGIN
+        UPDATE lecture_stats
+           SET total = total - 1,
+               approved = approved - (OLD.status IS 'approved'),
+               pending_video = pending_video - (OLD.status IS 'pending_video'),
+               pending = pending - (OLD.status IS 'pending'),
+               rejected = rejected - (OLD.status IS 'rejected')
+         WHERE lecture_id = OLD.lecture_id;
+    END
+    """,
+)
+
+# Индексы под запросы бота (миграция 4; см. tests/test_query_plans.py).
+QUERY_INDEXES = (
+    # отметки лекции со статусом: реестр, статистика, пересчёт геозоны
+    """
+    CREATE INDEX IF NOT EXISTS idx_att_lecture_status
+        ON attendances(lecture_id, status, user_id)
+    """,
+    # последняя отметка, ждущая кружок (handle_video_note)
+    """
+    CREATE INDEX IF NOT EXISTS idx_att_pending_video
+        ON attendances(user_id, created_at, lecture_id)
+        WHERE status = 'pending_video'
+    """,
+    # прогрев кэша ролей недавно активными пользователями
+    """
+    CREATE INDEX IF NOT EXISTS idx_users_updated
+        ON users(updated_at, role)
+    """,
+    # открытые лекции (подгрузка отметок в реестр)
+    """
+    CREATE INDEX IF NOT EXISTS idx_lectures_open
+        ON lectures(id) WHERE is_open = 1
+    """,
+)
 
+# Текущее время в мс средствами SQLite (для DEFAULT колонок).
+NOW_MS_SQL = "CAST(ROUND((julianday('now') - 2440587.5) * 86400000) AS INTEGER)"
 
-async def set_user_role(telegram_id: int, role: str):
+
+def iso_to_ms_sql(column: str) -> str:
+    """
+    SQL-выражение, переводящее колонку из старого TEXT-формата (ISO-строки и
+    datetime('now')) в мс Unix. Уже числовые значения не трогает.
+    """
+    return (
+        f"CASE WHEN typeof({column}) = 'text'"
+        f" THEN CAST(ROUND((julianday({column}) - 2440587.5) * 86400000) AS INTEGER)"
+        f" ELSE {column} END"
+    )
+
+
+# Миграции схемы: шаг N переводит базу с user_version N-1 на N.
+# Шаги только дописываются в конец; уже выпущенные не меняются.
+# IF NOT EXISTS оставлен, чтобы шаги спокойно легли на базы, созданные
+# до появления миграций (у них user_version = 0, а часть таблиц уже есть).
+SCHEMA_MIGRATIONS: list[tuple[str, ...]] = [
+    # 1: исходная схема
+    (
+        """
+        CREATE TABLE IF NOT EXISTS users (
+            telegram_id   INTEGER PRIMARY KEY,
+            first_name    TEXT,
+            last_name     TEXT,
+            username      TEXT,
+            fio           TEXT,
+            email         TEXT,
+            role          TEXT DEFAULT 'student',
+            created_at    TEXT DEFAULT (datetime('now')),
+            updated_at    TEXT DEFAULT (datetime('now'))
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS settings (
+            key   TEXT PRIMARY KEY,
+            value TEXT
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS lectures (
+            id           TEXT PRIMARY KEY,
+            is_open      INTEGER DEFAULT 0,
+            created_by   INTEGER,
+            geo_lat      REAL,
+            geo_lon      REAL,
+            geo_radius   REAL DEFAULT 150.0, -- радиус в метрах
+            opened_at    TEXT,
+            closed_at    TEXT
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS attendances (
+            id             INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id        INTEGER,
+            lecture_id     TEXT,
+            created_at     TEXT DEFAULT (datetime('now')),
+            status         TEXT, -- pending, approved, rejected, pending_video
+            geo_lat        REAL,
+            geo_lon        REAL,
+            geo_accuracy   REAL,
+            device         TEXT,
+            extra_json     TEXT,
+            video_chat_id  INTEGER,
+            video_message_id INTEGER,
+            reviewer_id    INTEGER,
+            reviewed_at    TEXT,
+            FOREIGN KEY(user_id) REFERENCES users(telegram_id),
+            FOREIGN KEY(lecture_id) REFERENCES lectures(id)
+        )
+        """,
+        """
+        CREATE UNIQUE INDEX IF NOT EXISTS idx_att_unique
+            ON attendances(user_id, lecture_id)
+        """,
+    ),
+    # 2: трек geo_stream и именованные геозоны
+    (
+        """
+        CREATE TABLE IF NOT EXISTS geo_samples (
+            user_id   INTEGER NOT NULL,
+            ts        INTEGER NOT NULL, -- unix-время точки, мс
+            lat       REAL NOT NULL,
+            lon       REAL NOT NULL,
+            accuracy  REAL,
+            PRIMARY KEY (user_id, ts)
+        ) WITHOUT ROWID
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS geo_zones (
+            id            INTEGER PRIMARY KEY AUTOINCREMENT,
+            name          TEXT NOT NULL UNIQUE,
+            kind          TEXT NOT NULL, -- circle, polygon
+            lat           REAL,          -- центр круга
+            lon           REAL,
+            radius        REAL,          -- радиус круга в метрах
+            polygon_json  TEXT           -- [[lat, lon], ...] вершины многоугольника
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS lecture_zones (
+            lecture_id  TEXT NOT NULL,
+            zone_id     INTEGER NOT NULL,
+            PRIMARY KEY (lecture_id, zone_id)
+        ) WITHOUT ROWID
+        """,
+    ),
+    # 3: счётчики статусов по лекции, которые ведут триггеры
+    (
+        """
+        CREATE TABLE IF NOT EXISTS lecture_stats (
+            lecture_id     TEXT PRIMARY KEY,
+            total          INTEGER NOT NULL DEFAULT 0,
+            approved       INTEGER NOT NULL DEFAULT 0,
+            pending_video  INTEGER NOT NULL DEFAULT 0,
+            pending        INTEGER NOT NULL DEFAULT 0,
+            rejected       INTEGER NOT NULL DEFAULT 0
+        ) WITHOUT ROWID
+        """,
+        *LECTURE_STATS_TRIGGERS,
+        f"""
+        INSERT INTO lecture_stats
+            (lecture_id, total, approved, pending_video, pending, rejected)
+        SELECT * FROM ({LECTURE_STATS_AGGREGATE_SQL})
+         WHERE NOT EXISTS (SELECT 1 FROM lecture_stats)
+        """,
+    ),
+    # 4: индексы под запросы бота (см. tests/test_query_plans.py)
+    (
+        *QUERY_INDEXES,
+    ),
+    # 5: время — целые мс Unix вместо ISO-строк. SQLite не меняет тип
+    # колонки на месте, поэтому таблицы пересобираются с переносом данных.
+    (
+        f"""
+        CREATE TABLE attendances_new (
+            id             INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id        INTEGER,
+            lecture_id     TEXT,
+            created_at     INTEGER DEFAULT ({NOW_MS_SQL}), -- мс Unix
+            status         TEXT, -- pending, approved, rejected, pending_video
+            geo_lat        REAL,
+            geo_lon        REAL,
+            geo_accuracy   REAL,
+            device         TEXT,
+            extra_json     TEXT,
+            video_chat_id  INTEGER,
+            video_message_id INTEGER,
+            reviewer_id    INTEGER,
+            reviewed_at    INTEGER, -- мс Unix
+            FOREIGN KEY(user_id) REFERENCES users(telegram_id),
+            FOREIGN KEY(lecture_id) REFERENCES lectures(id)
+        )
+        """,
+        f"""
+        INSERT INTO attendances_new
+        SELECT id, user_id, lecture_id, {iso_to_ms_sql("created_at")}, status,
+               geo_lat, geo_lon, geo_accuracy, device, extra_json,
+               video_chat_id, video_message_id,
+               reviewer_id, {iso_to_ms_sql("reviewed_at")}
+          FROM attendances
+        """,
+        # id отметок живут в callback_data кнопок — счётчик AUTOINCREMENT
+        # переносим, чтобы id удалённых отметок не выдались повторно
+        "DELETE FROM sqlite_sequence WHERE name = 'attendances_new'",
+        "UPDATE sqlite_sequence SET name = 'attendances_new' WHERE name = 'attendances'",
+        "DROP TABLE attendances",
+        "ALTER TABLE attendances_new RENAME TO attendances",
+        f"""
+        CREATE TABLE users_new (
+            telegram_id   INTEGER PRIMARY KEY,
+            first_name    TEXT,
+            last_name     TEXT,
+            username      TEXT,
+            fio           TEXT,
+            email         TEXT,
+            role          TEXT DEFAULT 'student',
+            created_at    INTEGER DEFAULT ({NOW_MS_SQL}), -- мс Unix
+            updated_at    INTEGER DEFAULT ({NOW_MS_SQL})  -- мс Unix
+        )
+        """,
+        f"""
+        INSERT INTO users_new
+        SELECT telegram_id, first_name, last_name, username, fio, email, role,
+               {iso_to_ms_sql("created_at")}, {iso_to_ms_sql("updated_at")}
+          FROM users
+        """,
+        "DROP TABLE users",
+        "ALTER TABLE users_new RENAME TO users",
+        """
+        CREATE TABLE lectures_new (
+            id           TEXT PRIMARY KEY,
+            is_open      INTEGER DEFAULT 0,
+            created_by   INTEGER,
+            geo_lat      REAL,
+            geo_lon      REAL,
+            geo_radius   REAL DEFAULT 150.0, -- радиус в метрах
+            opened_at    INTEGER, -- мс Unix
+            closed_at    INTEGER  -- мс Unix
+        )
+        """,
+        f"""
+        INSERT INTO lectures_new
+        SELECT id, is_open, created_by, geo_lat, geo_lon, geo_radius,
+               {iso_to_ms_sql("opened_at")}, {iso_to_ms_sql("closed_at")}
+          FROM lectures
+        """,
+        "DROP TABLE lectures",
+        "ALTER TABLE lectures_new RENAME TO lectures",
+        """
+        CREATE UNIQUE INDEX idx_att_unique
+            ON attendances(user_id, lecture_id)
+        """,
+        *QUERY_INDEXES,
+        *LECTURE_STATS_TRIGGERS,
+    ),
+    # 6: у лекций целочисленный ключ, текст QR хранится один раз в code.
+    # attendances, lecture_zones и lecture_stats ссылаются на число.
+    (
+        """
+        CREATE TABLE lectures_new (
+            id           INTEGER PRIMARY KEY,
+            code         TEXT NOT NULL UNIQUE, -- внешний ID лекции (текст QR)
+            is_open      INTEGER DEFAULT 0,
+            created_by   INTEGER,
+            geo_lat      REAL,
+            geo_lon      REAL,
+            geo_radius   REAL DEFAULT 150.0, -- радиус в метрах
+            opened_at    INTEGER, -- мс Unix
+            closed_at    INTEGER  -- мс Unix
+        )
+        """,
+        """
+        INSERT INTO lectures_new
+            (code, is_open, created_by, geo_lat, geo_lon, geo_radius, opened_at, closed_at)
+        SELECT id, is_open, created_by, geo_lat, geo_lon, geo_radius, opened_at, closed_at
+          FROM lectures
+         ORDER BY rowid
+        """,
+        # отметки/зоны могли ссылаться на лекцию, которой нет в lectures
+        """
+        INSERT INTO lectures_new (code)
+        SELECT lecture_id FROM attendances WHERE lecture_id IS NOT NULL
+         UNION
+        SELECT lecture_id FROM lecture_zones
+        EXCEPT
+        SELECT code FROM lectures_new
+        """,
+        f"""
+        CREATE TABLE attendances_new (
+            id             INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id        INTEGER,
+            lecture_id     INTEGER,
+            created_at     INTEGER DEFAULT ({NOW_MS_SQL}), -- мс Unix
+            status         TEXT, -- pending, approved, rejected, pending_video
+            geo_lat        REAL,
+            geo_lon        REAL,
+            geo_accuracy   REAL,
+            device         TEXT,
+            extra_json     TEXT,
+            video_chat_id  INTEGER,
+            video_message_id INTEGER,
+            reviewer_id    INTEGER,
+            reviewed_at    INTEGER, -- мс Unix
+            FOREIGN KEY(user_id) REFERENCES users(telegram_id),
+            FOREIGN KEY(lecture_id) REFERENCES lectures(id)
+        )
+        """,
+        """
+        INSERT INTO attendances_new
+        SELECT a.id, a.user_id, l.id, a.created_at, a.status,
+               a.geo_lat, a.geo_lon, a.geo_accuracy, a.device, a.extra_json,
+               a.video_chat_id, a.video_message_id, a.reviewer_id, a.reviewed_at
+          FROM attendances a
+     LEFT JOIN lectures_new l ON l.code = a.lecture_id
+        """,
+        "DELETE FROM sqlite_sequence WHERE name = 'attendances_new'",
+        "UPDATE sqlite_sequence SET name = 'attendances_new' WHERE name = 'attendances'",
+        "DROP TABLE attendances",
+        "ALTER TABLE attendances_new RENAME TO attendances",
+        """
+        CREATE TABLE lecture_zones_new (
+            lecture_id  INTEGER NOT NULL,
+            zone_id     INTEGER NOT NULL,
+            PRIMARY KEY (lecture_id, zone_id)
+        ) WITHOUT ROWID
+        """,
+        """
+        INSERT INTO lecture_zones_new
+        SELECT l.id, z.zone_id
+          FROM lecture_zones z
+          JOIN lectures_new l ON l.code = z.lecture_id
+        """,
+        "DROP TABLE lecture_zones",
+        "ALTER TABLE lecture_zones_new RENAME TO lecture_zones",
+        "DROP TABLE lecture_stats",
+        """
+        CREATE TABLE lecture_stats (
+            lecture_id     INTEGER PRIMARY KEY,
+            total          INTEGER NOT NULL DEFAULT 0,
+            approved       INTEGER NOT NULL DEFAULT 0,
+            pending_video  INTEGER NOT NULL DEFAULT 0,
+            pending        INTEGER NOT NULL DEFAULT 0,
+            rejected       INTEGER NOT NULL DEFAULT 0
+        )
+        """,
+        f"""
+        INSERT INTO lecture_stats
+            (lecture_id, total, approved, pending_video, pending, rejected)
+        {LECTURE_STATS_AGGREGATE_SQL}
+        """,
+        "DROP TABLE lectures",
+        "ALTER TABLE lectures_new RENAME TO lectures",
+        """
+        CREATE UNIQUE INDEX idx_att_unique
+            ON attendances(user_id, lecture_id)
+        """,
+        *QUERY_INDEXES,
+        *LECTURE_STATS_TRIGGERS,
+    ),
+    # 7: сырые payload'ы отметок — в отдельную таблицу только на добавление,
+    # сжатые zlib со словарём (см. PayloadArchive); attendances становится узкой
+    (
+        f"""
+        CREATE TABLE IF NOT EXISTS payload_dicts (
+            id          INTEGER PRIMARY KEY,
+            created_at  INTEGER NOT NULL DEFAULT ({NOW_MS_SQL}), -- мс Unix
+            data        BLOB NOT NULL -- zdict для zlib
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS checkin_payloads (
+            attendance_id  INTEGER PRIMARY KEY,
+            codec          INTEGER NOT NULL, -- 0 — JSON как есть, 1 — zlib
+            dict_id        INTEGER REFERENCES payload_dicts(id), -- NULL — без словаря
+            data           BLOB NOT NULL
+        )
+        """,
+        # старые строки переносим как есть: сжать их средствами SQL нельзя
+        """
+        INSERT INTO checkin_payloads (attendance_id, codec, dict_id, data)
+        SELECT id, 0, NULL, CAST(extra_json AS BLOB)
+          FROM attendances
+         WHERE extra_json IS NOT NULL
+        """,
+        "ALTER TABLE attendances DROP COLUMN extra_json",
+    ),
+    # 8: исходящие сообщения, которые не ушли с первой попытки (см. OutboundSender)
+    (
+        f"""
+        CREATE TABLE IF NOT EXISTS outbox (
+            id               INTEGER PRIMARY KEY,
+            method           TEXT NOT NULL, -- метод Bot: send_message, delete_message, ...
+            chat_id          INTEGER NOT NULL,
+            params           TEXT NOT NULL, -- JSON остальных аргументов
+            hook             TEXT, -- OUTBOX_HOOKS, вызывается после отправки
+            context          TEXT, -- JSON для hook
+            attempts         INTEGER NOT NULL DEFAULT 0,
+            next_attempt_at  INTEGER NOT NULL, -- мс Unix
+            last_error       TEXT,
+            created_at       INTEGER NOT NULL DEFAULT ({NOW_MS_SQL})
+        )
+        """,
+        "CREATE INDEX IF NOT EXISTS idx_outbox_due ON outbox(next_attempt_at)",
+    ),
+    # 9: уже обработанные апдейты — второй уровень IdempotencyStore
+    (
+        """
+        CREATE TABLE IF NOT EXISTS processed_updates (
+            key         TEXT PRIMARY KEY, -- cb:<callback id> / msg:<chat>:<message id>
+            outcome     TEXT, -- JSON ответа на повтор
+            expires_at  INTEGER NOT NULL -- мс Unix
+        ) WITHOUT ROWID
+        """,
+        """
+        CREATE INDEX IF NOT EXISTS idx_processed_updates_expires
+            ON processed_updates(expires_at)
+        """,
+    ),
+    # 10: ключ схлопывания сообщений outbox — одна строка на key
+    (
+        "ALTER TABLE outbox ADD COLUMN key TEXT",
+        """
+        CREATE UNIQUE INDEX IF NOT EXISTS idx_outbox_key
+            ON outbox(key) WHERE key IS NOT NULL
+        """,
+    ),
+]
+
+
+async def get_schema_version(db) -> int:
+    row = await db.execute_fetchone("PRAGMA user_version")
+    return row[0]
+
+
+async def init_db() -> int:
+    """
+    Доводит схему до последней версии и возвращает её номер.
+    Актуальная база обходится одним чтением PRAGMA user_version.
+    Каждый шаг — отдельная транзакция вместе с записью новой версии,
+    поэтому упавший шаг не оставляет схему наполовину изменённой.
+    """
+    target = len(SCHEMA_MIGRATIONS)
     db = await get_db()
     try:
-        await db.execute(
-            """
-            UPDATE users
-               SET role = ?,
-                   updated_at = ?
-             WHERE telegram_id = ?
-            """,
-            (role, now_iso(), telegram_id),
-        )
-        await db.commit()
+        version = await get_schema_version(db)
+        if version >= target:
+            if version > target:
+                logger.warning(
+                    "DB schema version %s is newer than this bot knows (%s)",
+                    version,
+                    target,
+                )
+            return version
+
+        # WAL хранится в самом файле БД; в транзакции его не переключить
+        await db.execute("PRAGMA journal_mode=WAL")
+        while version < target:
+            await db.execute("BEGIN IMMEDIATE")
+            try:
+                # другой процесс мог успеть мигрировать, пока мы ждали блокировку
+                version = await get_schema_version(db)
+                if version < target:
+                    for sql in SCHEMA_MIGRATIONS[version]:
+                        await db.execute(sql)
+                    version += 1
+                    await db.execute(f"PRAGMA user_version = {version}")
+                await db.commit()
+            except Exception:
+                await db.rollback()
+                raise
+            logger.info("DB schema is at version %s", version)
+        return version
     finally:
         await db.close()
 
 
-async def get_user_role(telegram_id: int) -> str:
+# Сверка обходит обе таблицы целиком (это её смысл), но без сортировок:
+# агрегат идёт по idx_att_lecture_status, сопоставление — по первичным ключам.
+LECTURE_STATS_DRIFT_SQL = f"""
+    SELECT a.lecture_id
+      FROM ({LECTURE_STATS_AGGREGATE_SQL}) AS a
+ LEFT JOIN lecture_stats s ON s.lecture_id = a.lecture_id
+     WHERE (s.total, s.approved, s.pending_video, s.pending, s.rejected)
+           IS NOT (a.total, a.approved, a.pending_video, a.pending, a.rejected)
+ UNION ALL
+    SELECT s.lecture_id
+      FROM lecture_stats s
+     WHERE s.total != 0
+       AND NOT EXISTS (SELECT 1 FROM attendances WHERE lecture_id = s.lecture_id)
+"""
+
+
+async def find_lecture_stats_drift() -> list[str]:
+    """Лекции, у которых lecture_stats разошлась с attendances."""
     db = await get_db()
     try:
-        cur = await db.execute(
-            "SELECT role FROM users WHERE telegram_id = ?", (telegram_id,)
-        )
-        row = await cur.fetchone()
-        return row["role"] if row and row["role"] else "student"
+        rows = await db.execute_fetchall(LECTURE_STATS_DRIFT_SQL)
     finally:
         await db.close()
+    return [row[0] for row in rows]
+
+
+async def rebuild_lecture_stats() -> int:
+    """Пересчитывает lecture_stats с нуля одной транзакцией писателя."""
+    writer = await get_writer()
+    results = await writer.transaction(
+        [
+            ("DELETE FROM lecture_stats", ()),
+            (
+                f"""
+                INSERT INTO lecture_stats
+                    (lecture_id, total, approved, pending_video, pending, rejected)
+                {LECTURE_STATS_AGGREGATE_SQL}
+                """,
+                (),
+            ),
+        ]
+    )
+    return results[1].rowcount
 
 
 # -----------------------------
-#  КОМАНДЫ
+#  КЭШИ В ПАМЯТИ
 # -----------------------------
 
 
-@router.message(CommandStart())
-async def cmd_start(message: Message):
-    await ensure_user(message)
+class RoleCache:
+    """
+    Ограниченный LRU-кэш ролей с TTL.
 
-    role = await get_user_role(message.from_user.id)
-    role = role or "student"
+    Роли меняются только через set_user_role, который обновляет кэш
+    при записи, поэтому TTL — лишь страховка от правок БД в обход бота.
 
-    role_map = {
-        "student": ("student", ["student"]),
-        "speaker": ("speaker", ["student", "speaker"]),
-        "admin": ("admin", ["student", "speaker", "admin"]),
-        "rating": ("rating", ["student"]),
-    }
+    Роль, прочитанную из БД, кладут через fill() с generation на момент
+    начала чтения: если за время SELECT роль кому-то записали (put) или
+    сбросили (invalidate), прочитанное уже может быть старым и в кэш
+    не попадает — иначе отозванная роль жила бы до конца TTL.
+    """
 
-    role_param, allowed_panels = role_map.get(role, role_map["student"])
-    webapp_url = build_webapp_url(
-        WEBAPP_URL,
-        {
-            "role": role_param,
-            "panels": ",".join(allowed_panels),
-        },
-    )
+    def __init__(self, max_size: int, ttl: float):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._data: OrderedDict[int, tuple[str, float]] = OrderedDict()
+        self.generation = 0  # растёт с каждой записью роли
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def get(self, telegram_id: int) -> str | None:
+        item = self._data.get(telegram_id)
+        if item is None:
+            self.misses += 1
+            return None
+        role, expires_at = item
+        if expires_at < time.monotonic():
+            del self._data[telegram_id]
+            self.misses += 1
+            return None
+        self._data.move_to_end(telegram_id)
+        self.hits += 1
+        return role
+
+    def _store(self, telegram_id: int, role: str) -> None:
+        self._data[telegram_id] = (role, time.monotonic() + self.ttl)
+        self._data.move_to_end(telegram_id)
+        while len(self._data) > self.max_size:
+            self._data.popitem(last=False)
+
+    def put(self, telegram_id: int, role: str) -> None:
+        """Роль, только что записанная в БД."""
+        self.generation += 1
+        self._store(telegram_id, role)
+
+    def fill(self, telegram_id: int, role: str, generation: int) -> bool:
+        """Роль, прочитанная из БД; False — пока читали, роли менялись."""
+        if generation != self.generation:
+            return False
+        self._store(telegram_id, role)
+        return True
+
+    def invalidate(self, telegram_id: int) -> None:
+        self.generation += 1
+        self._data.pop(telegram_id, None)
+
+    def clear(self) -> None:
+        self.generation += 1
+        self._data.clear()
+
+    def stats(self) -> dict[str, int]:
+        return {"size": len(self._data), "hits": self.hits, "misses": self.misses}
+
+    async def warm(self) -> int:
+        """Загружает роли недавно активных пользователей из таблицы users."""
+        generation = self.generation
+        db = await get_db()
+        try:
+            rows = await db.execute_fetchall(
+                """
+                SELECT telegram_id, role
+                  FROM users
+              ORDER BY updated_at DESC
+                 LIMIT ?
+                """,
+                (self.max_size,),
+            )
+        finally:
+            await db.close()
+        # самые свежие кладём последними — они дальше всех от вытеснения
+        # если роли поменялись во время чтения, не кладём ничего —
+        # догрузятся по промахам
+        for row in reversed(rows):
+            if not self.fill(row["telegram_id"], row["role"] or "student", generation):
+                return 0
+        return len(rows)
 
-    kb = ReplyKeyboardMarkup(
-        resize_keyboard=True,
-        keyboard=[
-            [
-                KeyboardButton(
-                    text="Открыть мини-аппу",
-                    web_app=WebAppInfo(url=webapp_url),
-                )
-            ]
-        ],
-    )
 
-    await message.answer(
-        (
-            "Привет! Это бот для отметки посещаемости.\n\n"
-            "Нажми кнопку <b>«Открыть мини-аппу»</b>, чтобы запустить интерфейс,"
-            " который покажет разделы согласно твоей роли."
-        ),
-        reply_markup=kb,
-    )
+role_cache = RoleCache(ROLE_CACHE_SIZE, ROLE_CACHE_TTL)
 
 
-@router.message(Command("set_rating_chat"))
-async def cmd_set_rating_chat(message: Message):
+class SettingsCache:
     """
-    Выполняется в чате команды рейтинга.
-    Только мастер-админ.
+    Копия таблицы settings в памяти.
+
+    Загружается целиком при старте (или при первом обращении),
+    set_setting обновляет её после записи, reload() перечитывает таблицу —
+    на случай правок БД в обход бота. Чтения — поиск в словаре без I/O.
     """
-    if message.from_user.id not in MASTER_ADMIN_IDS:
-        await message.reply("Команда только для мастер-админов.")
-        return
 
-    chat_id = message.chat.id
-    await set_setting("rating_chat_id", str(chat_id))
-    await message.reply(
-        f"Чат рейтинга установлен: <code>{chat_id}</code>\n"
-        "Сюда будут отправляться кружки на проверку."
-    )
+    def __init__(self):
+        self._values: dict[str, str] = {}
+        self._loaded = False
 
+    @property
+    def loaded(self) -> bool:
+        return self._loaded
 
-@router.message(Command("whoami"))
-async def cmd_whoami(message: Message):
-    await ensure_user(message)
-    role = await get_user_role(message.from_user.id)
-    await message.reply(
-        f"Ваш Telegram ID: <code>{message.from_user.id}</code>\n"
-        f"Текущая роль в системе: <b>{role}</b>"
-    )
+    async def load(self) -> int:
+        db = await get_db()
+        try:
+            rows = await db.execute_fetchall("SELECT key, value FROM settings")
+        finally:
+            await db.close()
+        self._values = {row["key"]: row["value"] for row in rows}
+        self._loaded = True
+        return len(self._values)
 
+    async def reload(self) -> int:
+        return await self.load()
 
-# -----------------------------
-#  ОБРАБОТКА WEB_APP_DATA
-# -----------------------------
+    async def ensure_loaded(self) -> None:
+        if not self._loaded:
+            await self.load()
 
+    def get(self, key: str) -> str | None:
+        return self._values.get(key)
 
-@router.message(F.web_app_data)
-async def webapp_data_handler(message: Message):
-    """
-    Сюда прилетают данные из мини-аппы через Telegram.WebApp.sendData().
-    """
-    await ensure_user(message)
+    def get_int(self, key: str) -> int | None:
+        value = self._values.get(key)
+        if value is None:
+            return None
+        try:
+            return int(value)
+        except ValueError:
+            logger.warning("Настройка %s не является числом: %r", key, value)
+            return None
 
-    raw = message.web_app_data.data
-    try:
-        payload = json.loads(raw)
-    except Exception as e:
-        logger.exception("Bad WebApp payload: %s", raw)
-        await message.answer("⚠ Не удалось разобрать данные из мини-аппы.")
-        return
+    def set(self, key: str, value: str) -> None:
+        self._values[key] = value
 
-    actual_role = await get_user_role(message.from_user.id)
-    declared_role = (payload.get("role") or "").lower() or None
-    logger.info(
-        "WebApp payload from %s (role=%s, declared=%s): %s",
-        message.from_user.id,
-        actual_role,
-        declared_role,
-        payload,
-    )
+    def clear(self) -> None:
+        self._values = {}
+        self._loaded = False
 
-    p_type = payload.get("type")
-
-    # Дальше диспатчим по типу события
-    if p_type == "register":
-        await handle_register(message, payload)
-    elif p_type == "qr_scan":
-        await handle_qr_scan(message, payload)
-    elif p_type == "geo_stream":
-        await handle_geo_stream(message, payload)
-    elif p_type == "checkin":
-        await handle_checkin(message, payload)
-    elif p_type == "speaker_open_lecture":
-        await handle_speaker_open_lecture(message, payload)
-    elif p_type == "speaker_close_lecture":
-        await handle_speaker_close_lecture(message, payload)
-    elif p_type == "speaker_set_geo":
-        await handle_speaker_set_geo(message, payload)
-    elif p_type == "admin_set_role":
-        await handle_admin_set_role(message, payload)
-    elif p_type == "admin_request_stats":
-        await handle_admin_request_stats(message, payload)
-    else:
-        await message.answer(f"⚠ Неизвестный тип события: <code>{p_type}</code>.")
 
+settings_cache = SettingsCache()
 
-# -----------------------------
-#  ХЕНДЛЕРЫ ДЛЯ ТИПОВ PAYLOAD
-# -----------------------------
 
+class ProfileCache:
+    """
+    Отпечатки профилей, уже записанных в users:
+    (first_name, last_name, username, fio, email).
 
-async def handle_register(message: Message, payload: dict):
-    fio = payload.get("fio") or None
-    email = payload.get("email") or None
+    Если пришедшие данные совпадают с отпечатком, запись в БД пропускается,
+    а пользователь помечается «тронутым» — его updated_at обновится пачкой
+    в flush_profile_touches().
+    """
 
-    await set_user_profile(message.from_user.id, fio, email)
-    await message.answer("✅ Профиль обновлён.\nФИО и почта сохранены в системе.")
+    def __init__(self, max_size: int):
+        self.max_size = max_size
+        self._data: OrderedDict[int, tuple] = OrderedDict()
+        self._touched: dict[int, int] = {}
+        self.skipped_writes = 0
+
+    def get(self, telegram_id: int) -> tuple | None:
+        fingerprint = self._data.get(telegram_id)
+        if fingerprint is not None:
+            self._data.move_to_end(telegram_id)
+        return fingerprint
+
+    def put(self, telegram_id: int, fingerprint: tuple) -> None:
+        self._data[telegram_id] = fingerprint
+        self._data.move_to_end(telegram_id)
+        while len(self._data) > self.max_size:
+            self._data.popitem(last=False)
+
+    def invalidate(self, telegram_id: int) -> None:
+        self._data.pop(telegram_id, None)
+
+    def is_unchanged(self, telegram_id: int, fio: str | None, email: str | None) -> bool:
+        """
+        True, если UPDATE профиля (COALESCE по fio/email) ничего не поменяет,
+        кроме updated_at.
+        """
+        if fio is None and email is None:
+            return True
+        cached = self._data.get(telegram_id)
+        return (
+            cached is not None
+            and (fio is None or fio == cached[3])
+            and (email is None or email == cached[4])
+        )
 
+    def profile_written(
+        self, telegram_id: int, fio: str | None, email: str | None, rowcount: int
+    ) -> None:
+        cached = self._data.get(telegram_id)
+        if not rowcount:
+            self.invalidate(telegram_id)
+        elif cached is not None:
+            self.put(
+                telegram_id,
+                cached[:3]
+                + (
+                    cached[3] if fio is None else fio,
+                    cached[4] if email is None else email,
+                ),
+            )
 
-async def handle_qr_scan(message: Message, payload: dict):
-    qr = str(payload.get("qr") or "").strip()
-    if not qr:
-        await message.answer("⚠ Пустой QR.")
-        return
+    def touch(self, telegram_id: int) -> None:
+        self.skipped_writes += 1
+        self._touched[telegram_id] = now_ms()
 
-    # В простейшем варианте считаем, что qr = ID лекции.
-    lecture_id = qr
+    def pop_touched(self) -> list[tuple[int, int]]:
+        touched, self._touched = self._touched, {}
+        return [(ts, telegram_id) for telegram_id, ts in touched.items()]
 
-    db = await get_db()
-    try:
-        await db.execute(
-            """
-            INSERT INTO lectures (id, is_open, created_by, opened_at)
-            VALUES (?, 0, ?, ?)
-            ON CONFLICT(id) DO NOTHING
-            """,
-            (lecture_id, message.from_user.id, now_iso()),
-        )
-        await db.commit()
-    finally:
-        await db.close()
+    def clear(self) -> None:
+        self._data.clear()
+        self._touched.clear()
 
-    await message.answer(
-        f"📎 Лекция <code>{lecture_id}</code> привязана к вашему сеансу.\n"
-        "Итоговое решение, засчитывать ли отметку, принимает сервер."
+
+profile_cache = ProfileCache(PROFILE_CACHE_SIZE)
+
+
+async def flush_profile_touches() -> int:
+    """Пачкой обновляет updated_at у пользователей, чьи записи были пропущены."""
+    touched = profile_cache.pop_touched()
+    if not touched:
+        return 0
+    writer = await get_writer()
+    await writer.executemany(
+        "UPDATE users SET updated_at = ? WHERE telegram_id = ?", touched
     )
+    return len(touched)
 
 
-async def handle_geo_stream(message: Message, payload: dict):
-    """
+METERS_PER_DEGREE = 111320.0
+
+
+class GeoZone:
+    """
+    Именованная геозона: круг (центр + радиус в метрах) или многоугольник
+    из вершин [(lat, lon), ...]. Одну зону могут использовать много лекций.
+    """
+
+    __slots__ = ("id", "name", "kind", "lat", "lon", "radius", "polygon", "bbox")
+
+    def __init__(
+        self,
+        id: int,
+        name: str,
+        kind: str,
+        lat: float | None = None,
+        lon: float | None = None,
+        radius: float | None = None,
+        polygon: list[tuple[float, float]] | None = None,
+    ):
+        self.id = id
+        self.name = name
+        self.kind = kind
+        self.lat = lat
+        self.lon = lon
+        self.radius = radius
+        self.polygon = polygon
+        if kind == "circle":
+            d_lat = radius / METERS_PER_DEGREE
+            d_lon = radius / (METERS_PER_DEGREE * max(math.cos(math.radians(lat)), 1e-6))
+            self.bbox = (lat - d_lat, lon - d_lon, lat + d_lat, lon + d_lon)
+        else:
+            lats = [p[0] for p in polygon]
+            lons = [p[1] for p in polygon]
+            self.bbox = (min(lats), min(lons), max(lats), max(lons))
+
+    @classmethod
+    def from_row(cls, row) -> "GeoZone":
+        polygon = None
+        if row["polygon_json"]:
+            polygon = [tuple(p) for p in json.loads(row["polygon_json"])]
+        return cls(
+            row["id"],
+            row["name"],
+            row["kind"],
+            row["lat"],
+            row["lon"],
+            row["radius"],
+            polygon,
+        )
+
+    def contains(self, lat: float, lon: float) -> bool:
+        if self.kind == "circle":
+            return haversine_m(lat, lon, self.lat, self.lon) <= self.radius
+        # луч вдоль долготы; для зданий плоского приближения достаточно
+        inside = False
+        j = len(self.polygon) - 1
+        for i, (yi, xi) in enumerate(self.polygon):
+            yj, xj = self.polygon[j]
+            if (yi > lat) != (yj > lat) and lon < (xj - xi) * (lat - yi) / (yj - yi) + xi:
+                inside = not inside
+            j = i
+        return inside
+
+    def contains_vec(self, lats, lons):
+        """contains() для numpy-массивов точек."""
+        if self.kind == "circle":
+            return haversine_m_vec(lats, lons, self.lat, self.lon) <= self.radius
+        inside = np.zeros(len(lats), dtype=bool)
+        j = len(self.polygon) - 1
+        with np.errstate(divide="ignore", invalid="ignore"):
+            for i, (yi, xi) in enumerate(self.polygon):
+                yj, xj = self.polygon[j]
+                inside ^= ((yi > lats) != (yj > lats)) & (
+                    lons < (xj - xi) * (lats - yi) / (yj - yi) + xi
+                )
+                j = i
+        return inside
+
+
+class ZoneIndex:
+    """
+    Равномерная сетка по координатам: каждая зона лежит во всех ячейках,
+    которые задевает её bbox. Поиск зоны для точки проверяет только зоны
+    её ячейки, поэтому не дорожает с ростом общего числа зон.
+    """
+
+    def __init__(self, cell_deg: float):
+        self.cell_deg = cell_deg
+        self._zones: dict[int, GeoZone] = {}
+        self._by_name: dict[str, GeoZone] = {}
+        self._cells: dict[tuple[int, int], list[GeoZone]] = {}
+
+    def __len__(self) -> int:
+        return len(self._zones)
+
+    def _cell(self, lat: float, lon: float) -> tuple[int, int]:
+        return math.floor(lat / self.cell_deg), math.floor(lon / self.cell_deg)
+
+    def _cells_of(self, zone: GeoZone):
+        min_y, min_x = self._cell(zone.bbox[0], zone.bbox[1])
+        max_y, max_x = self._cell(zone.bbox[2], zone.bbox[3])
+        for y in range(min_y, max_y + 1):
+            for x in range(min_x, max_x + 1):
+                yield y, x
+
+    def add(self, zone: GeoZone) -> None:
+        self.remove(zone.id)
+        self._zones[zone.id] = zone
+        self._by_name[zone.name] = zone
+        for cell in self._cells_of(zone):
+            self._cells.setdefault(cell, []).append(zone)
+
+    def remove(self, zone_id: int) -> None:
+        zone = self._zones.pop(zone_id, None)
+        if zone is None:
+            return
+        self._by_name.pop(zone.name, None)
+        for cell in self._cells_of(zone):
+            bucket = self._cells.get(cell)
+            if bucket is not None:
+                bucket[:] = [z for z in bucket if z.id != zone_id]
+                if not bucket:
+                    del self._cells[cell]
+
+    def get(self, zone_id: int) -> GeoZone | None:
+        return self._zones.get(zone_id)
+
+    def by_name(self, name: str) -> GeoZone | None:
+        return self._by_name.get(name)
+
+    def find(
+        self, lat: float, lon: float, zone_ids: frozenset[int] | None = None
+    ) -> GeoZone | None:
+        """Первая зона (из zone_ids, если заданы), содержащая точку."""
+        for zone in self._cells.get(self._cell(lat, lon), ()):
+            if (zone_ids is None or zone.id in zone_ids) and zone.contains(lat, lon):
+                return zone
+        return None
+
+    def clear(self) -> None:
+        self._zones.clear()
+        self._by_name.clear()
+        self._cells.clear()
+
+
+zone_index = ZoneIndex(GEO_ZONE_CELL_DEG)
+
+
+class Lecture:
+    """
+    Состояние лекции, нужное на горячем пути отметки.
+
+    id — целочисленный ключ лекции в БД, code — внешний ID (текст QR),
+    который присылает мини-аппа и который видят пользователи.
+    Геозона лекции — её собственный круг (geo_lat/geo_lon/geo_radius) и/или
+    привязанные именованные зоны zone_ids; отметка проходит, если точка
+    попала хотя бы в одну.
+    attendees — кто уже отметился (user_id -> status); держится в памяти
+    только пока лекция открыта.
+    """
+
+    __slots__ = (
+        "id",
+        "code",
+        "is_open",
+        "created_by",
+        "geo_lat",
+        "geo_lon",
+        "geo_radius",
+        "zone_ids",
+        "attendees",
+    )
+
+    def __init__(
+        self,
+        id: int,
+        code: str,
+        is_open: bool = False,
+        created_by: int | None = None,
+        geo_lat: float | None = None,
+        geo_lon: float | None = None,
+        geo_radius: float | None = None,
+    ):
+        self.id = id
+        self.code = code
+        self.is_open = is_open
+        self.created_by = created_by
+        self.geo_lat = geo_lat
+        self.geo_lon = geo_lon
+        self.geo_radius = geo_radius
+        self.zone_ids: frozenset[int] = frozenset()
+        self.attendees: dict[int, str] | None = None
+
+    @property
+    def has_geofence(self) -> bool:
+        return (self.geo_lat is not None and self.geo_lon is not None) or bool(
+            self.zone_ids
+        )
+
+    def check_geo(
+        self, lat: float | None, lon: float | None
+    ) -> tuple[bool, float | None]:
+        """
+        Возвращает (попали ли в геозону, расстояние в метрах до центра
+        собственного круга лекции, если он задан).
+        Если геозона не задана, любая позиция подходит.
+        """
+        if not self.has_geofence:
+            return True, None
+        if lat is None or lon is None:
+            return False, None
+        distance = None
+        if self.geo_lat is not None and self.geo_lon is not None:
+            distance = haversine_m(lat, lon, self.geo_lat, self.geo_lon)
+            if distance <= (self.geo_radius or DEFAULT_GEO_RADIUS):
+                return True, distance
+        if self.zone_ids and zone_index.find(lat, lon, self.zone_ids) is not None:
+            return True, distance
+        # если дальше радиуса и вне зон, считаем подозрительным
+        return False, distance
+
+
+class LectureRegistry:
+    """
+    Авторитетная копия таблицы lectures в памяти.
+
+    Строится из БД при старте; хендлеры спикера и handle_qr_scan обновляют
+    её сразу после записи в БД, поэтому проверка «открыта ли лекция» и
+    геозоны при отметке обходятся без запросов.
+
+    Заодно это карта интернирования code -> id: хендлер переводит внешний
+    ID лекции в целочисленный ключ один раз, дальше все запросы идут по числу.
+    """
+
+    def __init__(self):
+        self._lectures: dict[int, Lecture] = {}
+        self._codes: dict[str, int] = {}
+        self._loaded = False
+
+    def __len__(self) -> int:
+        return len(self._lectures)
+
+    async def load(self) -> int:
+        db = await get_db()
+        try:
+            rows = await db.execute_fetchall(
+                """
+                SELECT id, code, is_open, created_by, geo_lat, geo_lon, geo_radius
+                  FROM lectures
+                """
+            )
+            zone_rows = await db.execute_fetchall(
+                """
+                SELECT id, name, kind, lat, lon, radius, polygon_json
+                  FROM geo_zones
+                """
+            )
+            link_rows = await db.execute_fetchall(
+                "SELECT lecture_id, zone_id FROM lecture_zones"
+            )
+            attendance_rows = await db.execute_fetchall(
+                """
+                SELECT a.lecture_id, a.user_id, a.status
+                  FROM attendances a
+                  JOIN lectures l ON l.id = a.lecture_id
+                 WHERE l.is_open = 1
+                """
+            )
+        finally:
+            await db.close()
+        lectures = {
+            row["id"]: Lecture(
+                row["id"],
+                row["code"],
+                bool(row["is_open"]),
+                row["created_by"],
+                row["geo_lat"],
+                row["geo_lon"],
+                row["geo_radius"],
+            )
+            for row in rows
+        }
+        zone_index.clear()
+        for row in zone_rows:
+            zone_index.add(GeoZone.from_row(row))
+        zone_ids: dict[int, set[int]] = {}
+        for row in link_rows:
+            zone_ids.setdefault(row["lecture_id"], set()).add(row["zone_id"])
+        for lecture_id, ids in zone_ids.items():
+            if lecture_id in lectures:
+                lectures[lecture_id].zone_ids = frozenset(ids)
+        for lecture in lectures.values():
+            if lecture.is_open:
+                lecture.attendees = {}
+        for row in attendance_rows:
+            lectures[row["lecture_id"]].attendees[row["user_id"]] = row["status"]
+        self._lectures = lectures
+        self._codes = {lecture.code: lecture.id for lecture in lectures.values()}
+        self._loaded = True
+        return len(self._lectures)
+
+    async def refresh(self, lecture_id: int) -> Lecture | None:
+        """
+        Перечитывает одну лекцию: строку, её геозоны и, если она открыта,
+        отметки. Так воркер узнаёт о правке спикера в другом воркере без
+        полной load().
+        """
+        db = await get_db()
+        try:
+            row = await db.execute_fetchone(
+                """
+                SELECT id, code, is_open, created_by, geo_lat, geo_lon, geo_radius
+                  FROM lectures
+                 WHERE id = ?
+                """,
+                (lecture_id,),
+            )
+            zone_rows = await db.execute_fetchall(
+                """
+                SELECT z.id, z.name, z.kind, z.lat, z.lon, z.radius, z.polygon_json
+                  FROM lecture_zones lz
+                  JOIN geo_zones z ON z.id = lz.zone_id
+                 WHERE lz.lecture_id = ?
+                """,
+                (lecture_id,),
+            )
+        finally:
+            await db.close()
+        if row is None:
+            return None
+        lecture = self.remember(row["id"], row["code"], row["created_by"])
+        lecture.geo_lat = row["geo_lat"]
+        lecture.geo_lon = row["geo_lon"]
+        lecture.geo_radius = row["geo_radius"]
+        for zone_row in zone_rows:
+            zone_index.add(GeoZone.from_row(zone_row))
+        lecture.zone_ids = frozenset(zone_row["id"] for zone_row in zone_rows)
+        if row["is_open"]:
+            lecture.is_open = True
+            await self.load_attendees(lecture)
+        else:
+            self.mark_closed(lecture)
+        return lecture
+
+    async def lookup(self, code: str) -> Lecture | None:
+        """
+        Лекция по внешнему ID для отметки. В воркере реестр может отставать:
+        лекцию только что открыли в другом воркере, а инвалидация ещё не
+        дошла. Поэтому промах и закрытую лекцию перед отказом перечитываем
+        из БД. В одном процессе реестр авторитетен, хватает get().
+        """
+        lecture = self.get(code)
+        if _worker_index is None or (lecture is not None and lecture.is_open):
+            return lecture
+        if lecture is None:
+            db = await get_db()
+            try:
+                row = await db.execute_fetchone(
+                    "SELECT id FROM lectures WHERE code = ?", (code,)
+                )
+            finally:
+                await db.close()
+            if row is None:
+                return None
+            return await self.refresh(row["id"])
+        return await self.refresh(lecture.id)
+
+    async def load_attendees(self, lecture: Lecture) -> None:
+        db = await get_db()
+        try:
+            rows = await db.execute_fetchall(
+                "SELECT user_id, status FROM attendances WHERE lecture_id = ?",
+                (lecture.id,),
+            )
+        finally:
+            await db.close()
+        lecture.attendees = {row["user_id"]: row["status"] for row in rows}
+
+    async def mark_open(self, lecture: Lecture) -> Lecture:
+        lecture.is_open = True
+        if lecture.attendees is None:
+            await self.load_attendees(lecture)
+        return lecture
+
+    def mark_closed(self, lecture: Lecture) -> None:
+        lecture.is_open = False
+        lecture.attendees = None
+
+    def set_attendee_status(self, lecture_id: int, user_id: int, status: str) -> None:
+        lecture = self._lectures.get(lecture_id)
+        if lecture is not None and lecture.attendees is not None:
+            lecture.attendees[user_id] = status
+
+    async def ensure_loaded(self) -> None:
+        if not self._loaded:
+            await self.load()
+
+    def get(self, code: str) -> Lecture | None:
+        lecture_id = self._codes.get(code)
+        return None if lecture_id is None else self._lectures.get(lecture_id)
+
+    def by_id(self, lecture_id: int) -> Lecture | None:
+        return self._lectures.get(lecture_id)
+
+    def remember(self, lecture_id: int, code: str, created_by: int | None) -> Lecture:
+        """Кладёт в реестр лекцию, строка которой уже есть в БД."""
+        lecture = self._lectures.get(lecture_id)
+        if lecture is None:
+            lecture = Lecture(lecture_id, code, created_by=created_by)
+            self._lectures[lecture_id] = lecture
+            self._codes[code] = lecture_id
+        return lecture
+
+    async def intern(self, code: str, created_by: int | None) -> Lecture:
+        """
+        Лекция по внешнему ID; если её ещё нет, создаёт закрытую строку
+        в lectures (аналог INSERT ... ON CONFLICT DO NOTHING).
+        """
+        lecture = self.get(code)
+        if lecture is not None:
+            return lecture
+        result = await db_write(
+            """
+            INSERT INTO lectures (code, is_open, created_by, opened_at)
+            VALUES (?, 0, ?, ?)
+            ON CONFLICT(code) DO UPDATE SET code = excluded.code
+            RETURNING id
+            """,
+            (code, created_by, now_ms()),
+        )
+        (lecture_id,) = result.rows[0]
+        return self.remember(lecture_id, code, created_by)
+
+    def with_zone(self, zone_id: int) -> list[Lecture]:
+        return [
+            lecture for lecture in self._lectures.values() if zone_id in lecture.zone_ids
+        ]
+
+    def clear(self) -> None:
+        self._lectures = {}
+        self._codes = {}
+        self._loaded = False
+        zone_index.clear()
+
+
+lecture_registry = LectureRegistry()
+
+
+class GeoTrack:
+    """
+    Кольцевой буфер последних геоточек пользователя в упакованных массивах.
+    """
+
+    __slots__ = ("lat", "lon", "acc", "ts", "head", "count", "received_at")
+
+    def __init__(self, capacity: int):
+        self.lat = array("d", bytes(8 * capacity))
+        self.lon = array("d", bytes(8 * capacity))
+        self.acc = array("d", bytes(8 * capacity))
+        self.ts = array("q", bytes(8 * capacity))
+        self.head = 0  # куда писать следующую точку
+        self.count = 0
+        self.received_at = 0.0  # time.monotonic() последней точки
+
+    def __len__(self) -> int:
+        return self.count
+
+    def append(self, lat: float, lon: float, acc: float, ts: int) -> None:
+        i = self.head
+        self.lat[i] = lat
+        self.lon[i] = lon
+        self.acc[i] = acc
+        self.ts[i] = ts
+        self.head = (i + 1) % len(self.ts)
+        self.count = min(self.count + 1, len(self.ts))
+        self.received_at = time.monotonic()
+
+    def last(self) -> tuple[float, float, float, int] | None:
+        if not self.count:
+            return None
+        i = self.head - 1
+        return self.lat[i], self.lon[i], self.acc[i], self.ts[i]
+
+    def samples(self) -> list[tuple[float, float, float, int]]:
+        """Точки от старых к новым."""
+        capacity = len(self.ts)
+        start = (self.head - self.count) % capacity
+        return [
+            (self.lat[i], self.lon[i], self.acc[i], self.ts[i])
+            for i in ((start + k) % capacity for k in range(self.count))
+        ]
+
+
+class GeoStreamStore:
+    """
+    Последние геоточки geo_stream по пользователям + буфер на запись в БД.
+
+    Точка сохраняется, только если с предыдущей прошло не меньше
+    min_interval секунд или пользователь сместился дальше min_distance
+    метров (прореживание). Сохранённые точки копятся в _pending и пишутся
+    в geo_samples одним executemany в flush_geo_samples(). При переполнении
+    буфера теряются самые старые точки (счётчик dropped); неудачная пачка
+    возвращается requeue().
+    """
+
+    def __init__(
+        self,
+        capacity: int,
+        min_interval: float,
+        min_distance: float,
+        max_users: int,
+        max_pending: int,
+    ):
+        self.capacity = capacity
+        self.min_interval_ms = int(min_interval * 1000)
+        self.min_distance = min_distance
+        self.max_users = max_users
+        self._tracks: OrderedDict[int, GeoTrack] = OrderedDict()
+        self._pending: deque[tuple] = deque(maxlen=max_pending)
+        self.accepted = 0
+        self.downsampled = 0
+        self.dropped = 0
+
+    def add(
+        self,
+        user_id: int,
+        lat: float,
+        lon: float,
+        acc: float | None,
+        ts: int | None = None,
+    ) -> bool:
+        if ts is None:
+            ts = now_ms()
+        acc = -1.0 if acc is None else float(acc)
+
+        track = self._tracks.get(user_id)
+        if track is None:
+            track = GeoTrack(self.capacity)
+            self._tracks[user_id] = track
+            while len(self._tracks) > self.max_users:
+                self._tracks.popitem(last=False)
+        else:
+            self._tracks.move_to_end(user_id)
+            last = track.last()
+            if (
+                last is not None
+                and ts - last[3] < self.min_interval_ms
+                and haversine_m(lat, lon, last[0], last[1]) < self.min_distance
+            ):
+                self.downsampled += 1
+                return False
+
+        track.append(lat, lon, acc, ts)
+        self._make_room(1)
+        self._pending.append((user_id, ts, lat, lon, None if acc < 0 else acc))
+        self.accepted += 1
+        return True
+
+    def last_fix(
+        self, user_id: int, max_age: float
+    ) -> tuple[float, float, float | None] | None:
+        """Последняя точка (lat, lon, accuracy) не старше max_age секунд."""
+        track = self._tracks.get(user_id)
+        if track is None or time.monotonic() - track.received_at > max_age:
+            return None
+        last = track.last()
+        if last is None:
+            return None
+        lat, lon, acc, _ = last
+        return lat, lon, None if acc < 0 else acc
+
+    def track(self, user_id: int) -> GeoTrack | None:
+        return self._tracks.get(user_id)
+
+    def _make_room(self, count: int) -> None:
+        overflow = len(self._pending) + count - self._pending.maxlen
+        if overflow > 0:
+            if not self.dropped:
+                logger.warning("Буфер geo_samples переполнен, старые точки теряются")
+            self.dropped += overflow
+
+    def pop_pending(self) -> list[tuple]:
+        pending = list(self._pending)
+        self._pending.clear()
+        return pending
+
+    def requeue(self, pending: list[tuple]) -> None:
+        """Возвращает в начало буфера пачку, которую не удалось записать."""
+        self._make_room(len(pending))
+        room = self._pending.maxlen - len(self._pending)
+        self._pending.extendleft(reversed(pending[max(len(pending) - room, 0) :]))
+
+    def clear(self, keep_pending: bool = False) -> None:
+        self._tracks.clear()
+        if not keep_pending:
+            self._pending.clear()
+            self.dropped = 0
+
+
+geo_store = GeoStreamStore(
+    GEO_TRACK_SIZE,
+    GEO_MIN_INTERVAL,
+    GEO_MIN_DISTANCE,
+    GEO_MAX_USERS,
+    GEO_MAX_PENDING,
+)
+
+
+async def flush_geo_samples() -> int:
+    samples = geo_store.pop_pending()
+    if not samples:
+        return 0
+    try:
+        writer = await get_writer()
+        await writer.executemany(
+            """
+            INSERT OR IGNORE INTO geo_samples (user_id, ts, lat, lon, accuracy)
+            VALUES (?, ?, ?, ?, ?)
+            """,
+            samples,
+        )
+    except BaseException:
+        geo_store.requeue(samples)  # повторит следующий flush
+        raise
+    return len(samples)
+
+
+PAYLOAD_CODEC_JSON = 0
+PAYLOAD_CODEC_ZLIB = 1
+
+# Фрагменты JSON, из которых собирается словарь: ключи вместе с двоеточием
+# и короткие строковые значения (тип payload'а, устройство и т. п.).
+PAYLOAD_FRAGMENT_RE = re.compile(rb'"[^"\\]{1,64}"\s*:\s*(?:\{\s*|"[^"\\]{0,48}")?')
+
+
+def train_zdict(samples: list[bytes], size: int) -> bytes:
+    """
+    Собирает словарь для zlib из образцов payload'ов: фрагменты, которые
+    встречаются в большинстве образцов. zlib дешевле ссылается на конец
+    словаря, поэтому самые частые фрагменты кладутся последними.
+    """
+    counts: Counter[bytes] = Counter()
+    for sample in samples:
+        counts.update(set(PAYLOAD_FRAGMENT_RE.findall(sample)))
+    picked: list[bytes] = []
+    total = 0
+    for fragment, count in counts.most_common():
+        if count < 2 or total + len(fragment) > size:
+            continue
+        picked.append(fragment)
+        total += len(fragment)
+    return b"".join(reversed(picked))
+
+
+class PayloadArchive:
+    """
+    Буфер сырых payload'ов отметок на запись в checkin_payloads.
+
+    Payload'ы копятся в _pending и пишутся одним executemany во
+    flush_checkin_payloads(), сжатые zlib. Словарь (zdict) обучается один
+    раз на первых dict_samples payload'ах и хранится в payload_dicts;
+    каждая строка помнит dict_id, с которым её сжали.
+
+    Переполненный буфер вытесняет самые старые payload'ы — они считаются
+    в dropped; пачка, которую не удалось записать, возвращается requeue().
+    """
+
+    def __init__(self, max_pending: int, dict_size: int, dict_samples: int):
+        self.dict_size = dict_size
+        self.dict_samples = dict_samples
+        self._pending: deque[tuple[int, bytes]] = deque(maxlen=max_pending)
+        self._samples: list[bytes] = []
+        self._dicts: dict[int, bytes] = {}
+        self.dict_id: int | None = None
+        self.raw_bytes = 0
+        self.stored_bytes = 0
+        self.dropped = 0
+
+    def _make_room(self, count: int) -> None:
+        overflow = len(self._pending) + count - self._pending.maxlen
+        if overflow > 0:
+            if not self.dropped:
+                logger.warning("Буфер payload'ов отметок переполнен, старые теряются")
+            self.dropped += overflow
+
+    def add(self, attendance_id: int, raw: str) -> None:
+        data = raw.encode()
+        self._make_room(1)
+        self._pending.append((attendance_id, data))
+        if self.dict_id is None and len(self._samples) < self.dict_samples:
+            self._samples.append(data)
+
+    def get_pending(self, attendance_id: int) -> bytes | None:
+        for pending_id, data in self._pending:
+            if pending_id == attendance_id:
+                return data
+        return None
+
+    def pop_pending(self) -> list[tuple[int, bytes]]:
+        pending = list(self._pending)
+        self._pending.clear()
+        return pending
+
+    def requeue(self, pending: list[tuple[int, bytes]]) -> None:
+        """Возвращает в начало буфера пачку, которую не удалось записать."""
+        self._make_room(len(pending))
+        room = self._pending.maxlen - len(self._pending)
+        # не влезло — теряем самые старые из пачки, а не свежие из буфера
+        self._pending.extendleft(reversed(pending[max(len(pending) - room, 0) :]))
+
+    def needs_dictionary(self) -> bool:
+        return self.dict_id is None and len(self._samples) >= self.dict_samples
+
+    def train(self) -> bytes:
+        # образцы отдаются в обучение один раз; если словарь не вышел,
+        # соберутся новые
+        samples, self._samples = self._samples, []
+        return train_zdict(samples, self.dict_size)
+
+    def use_dictionary(self, dict_id: int, zdict: bytes) -> None:
+        self._dicts[dict_id] = zdict
+        self.dict_id = dict_id
+        self._samples = []
+
+    def remember_dictionary(self, dict_id: int, zdict: bytes) -> None:
+        self._dicts[dict_id] = zdict
+
+    def dictionary(self, dict_id: int) -> bytes | None:
+        return self._dicts.get(dict_id)
+
+    def compress(self, data: bytes) -> tuple[int, int | None, bytes]:
+        """(codec, dict_id, сжатые данные) для строки checkin_payloads."""
+        if self.dict_id is None:
+            packed = zlib.compress(data)
+        else:
+            compressor = zlib.compressobj(zdict=self._dicts[self.dict_id])
+            packed = compressor.compress(data) + compressor.flush()
+        self.raw_bytes += len(data)
+        self.stored_bytes += len(packed)
+        return PAYLOAD_CODEC_ZLIB, self.dict_id, packed
+
+    def decompress(self, codec: int, dict_id: int | None, data: bytes) -> bytes:
+        if codec == PAYLOAD_CODEC_JSON:
+            return data
+        if dict_id is None:
+            return zlib.decompress(data)
+        decompressor = zlib.decompressobj(zdict=self._dicts[dict_id])
+        return decompressor.decompress(data) + decompressor.flush()
+
+    def clear(self, keep_pending: bool = False) -> None:
+        # в буфере сырые байты — сжатие словарём случится при записи
+        if not keep_pending:
+            self._pending.clear()
+            self.dropped = 0
+        self._samples = []
+        self._dicts.clear()
+        self.dict_id = None
+
+
+payload_archive = PayloadArchive(
+    PAYLOAD_MAX_PENDING, PAYLOAD_DICT_SIZE, PAYLOAD_DICT_SAMPLES
+)
+
+
+async def load_payload_dictionary() -> int | None:
+    """Подхватывает последний обученный словарь из payload_dicts."""
+    db = await get_db()
+    try:
+        row = await db.execute_fetchone(
+            "SELECT id, data FROM payload_dicts ORDER BY id DESC LIMIT 1"
+        )
+    finally:
+        await db.close()
+    if row is not None:
+        payload_archive.use_dictionary(row["id"], bytes(row["data"]))
+        return row["id"]
+    return None
+
+
+async def flush_checkin_payloads() -> int:
+    payloads = payload_archive.pop_pending()
+    if not payloads:
+        return 0
+    try:
+        await write_checkin_payloads(payloads)
+    except BaseException:
+        payload_archive.requeue(payloads)  # повторит следующий flush
+        raise
+    return len(payloads)
+
+
+async def write_checkin_payloads(payloads: list[tuple[int, bytes]]) -> None:
+    writer = await get_writer()
+    if payload_archive.needs_dictionary():
+        zdict = payload_archive.train()
+        if zdict:
+            result = await writer.execute(
+                "INSERT INTO payload_dicts (data) VALUES (?) RETURNING id", (zdict,)
+            )
+            payload_archive.use_dictionary(result.rows[0][0], zdict)
+            logger.info("Trained payload dictionary: %s bytes", len(zdict))
+    await writer.executemany(
+        """
+        INSERT OR IGNORE INTO checkin_payloads (attendance_id, codec, dict_id, data)
+        VALUES (?, ?, ?, ?)
+        """,
+        [
+            (attendance_id, *payload_archive.compress(data))
+            for attendance_id, data in payloads
+        ],
+    )
+
+
+async def get_checkin_payload(attendance_id: int) -> dict | None:
+    """Сырой payload отметки (из буфера или из checkin_payloads)."""
+    data = payload_archive.get_pending(attendance_id)
+    if data is None:
+        db = await get_db()
+        try:
+            row = await db.execute_fetchone(
+                """
+                SELECT p.codec, p.dict_id, p.data, d.data AS zdict
+                  FROM checkin_payloads p
+             LEFT JOIN payload_dicts d ON d.id = p.dict_id
+                 WHERE p.attendance_id = ?
+                """,
+                (attendance_id,),
+            )
+        finally:
+            await db.close()
+        if row is None:
+            return None
+        if row["dict_id"] is not None:
+            payload_archive.remember_dictionary(row["dict_id"], bytes(row["zdict"]))
+        data = payload_archive.decompress(
+            row["codec"], row["dict_id"], bytes(row["data"])
+        )
+    return json.loads(data)
+
+
+class IdempotencyStore:
+    """
+    Окно идемпотентности для апдейтов, которые Telegram доставил повторно
+    (сеть моргнула, вебхук не успел ответить 200).
+
+    Ключ — id callback-запроса или (чат, message_id) сообщения. Первый
+    claim() занимает ключ, complete() запоминает итог — то, чем ответить на
+    повтор. Повтор получает сохранённый итог и не трогает ни БД, ни Telegram.
+    В памяти — ограниченный LRU с TTL; с persistent ключи ещё и пишутся в
+    processed_updates и переживают рестарт.
+    """
+
+    _PENDING = object()  # первая доставка ещё обрабатывается
+
+    def __init__(self, max_size: int, ttl: float, persistent: bool = False):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.persistent = persistent
+        self._data: OrderedDict[str, tuple[object, float]] = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def _put(self, key: str, outcome, expires_at: float) -> None:
+        self._data[key] = (outcome, expires_at)
+        self._data.move_to_end(key)
+        while len(self._data) > self.max_size:
+            self._data.popitem(last=False)
+
+    async def claim(self, key: str) -> tuple[bool, dict | None]:
+        """
+        (True, None) — ключ наш, обрабатываем. (False, outcome) — повтор;
+        outcome None, если первая доставка ещё в работе или ответа не было.
+        """
+        item = self._data.get(key)
+        if item is not None and item[1] >= time.monotonic():
+            self.hits += 1
+            outcome = item[0]
+            return False, None if outcome is self._PENDING else outcome
+        # занимаем до похода в БД, чтобы параллельный повтор уже видел ключ
+        self._put(key, self._PENDING, time.monotonic() + self.ttl)
+        if self.persistent:
+            db = await get_db()
+            try:
+                row = await db.execute_fetchone(
+                    """
+                    SELECT outcome, expires_at
+                      FROM processed_updates
+                     WHERE key = ? AND expires_at > ?
+                    """,
+                    (key, now_ms()),
+                )
+            finally:
+                await db.close()
+            if row is not None:
+                outcome = json.loads(row["outcome"]) if row["outcome"] else None
+                left = (row["expires_at"] - now_ms()) / 1000
+                self._put(key, outcome, time.monotonic() + left)
+                self.hits += 1
+                return False, outcome
+        self.misses += 1
+        return True, None
+
+    async def complete(self, key: str, outcome: dict | None = None) -> None:
+        self._put(key, outcome, time.monotonic() + self.ttl)
+        if self.persistent:
+            await db_write(
+                """
+                INSERT OR REPLACE INTO processed_updates (key, outcome, expires_at)
+                VALUES (?, ?, ?)
+                """,
+                (
+                    key,
+                    json.dumps(outcome, ensure_ascii=False) if outcome else None,
+                    now_ms() + int(self.ttl * 1000),
+                ),
+            )
+
+    def release(self, key: str) -> None:
+        """Обработка не удалась — повтор пусть попробует заново."""
+        self._data.pop(key, None)
+
+    def clear(self) -> None:
+        self._data.clear()
+
+    def stats(self) -> dict[str, int]:
+        return {"size": len(self._data), "hits": self.hits, "misses": self.misses}
+
+
+idempotency = IdempotencyStore(IDEMPOTENCY_SIZE, IDEMPOTENCY_TTL, IDEMPOTENCY_PERSIST)
+
+
+async def purge_processed_updates() -> int:
+    """Удаляет из processed_updates ключи, чьё окно истекло."""
+    result = await db_write(
+        "DELETE FROM processed_updates WHERE expires_at <= ?", (now_ms(),)
+    )
+    return result.rowcount
+
+
+async def run_periodically(interval: float, job, what: str) -> None:
+    """Фоновая задача: вызывает job() раз в interval секунд, ошибки логирует."""
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            await job()
+        except Exception:
+            logger.exception("Фоновая задача «%s» упала", what)
+
+
+async def get_setting(key: str) -> str | None:
+    await settings_cache.ensure_loaded()
+    return settings_cache.get(key)
+
+
+async def get_setting_int(key: str) -> int | None:
+    await settings_cache.ensure_loaded()
+    return settings_cache.get_int(key)
+
+
+async def set_setting(key: str, value: str):
+    await db_write(
+        """
+        INSERT INTO settings (key, value)
+        VALUES (?, ?)
+        ON CONFLICT(key) DO UPDATE SET value=excluded.value
+        """,
+        (key, value),
+    )
+    settings_cache.set(key, value)
+    publish_invalidation("settings")
+
+
+async def ensure_user(message: Message) -> None:
+    """
+    Создаёт/обновляет пользователя в БД.
+    Если имя, фамилия и username не изменились, запись пропускается.
+    """
+    u = message.from_user
+    names = (u.first_name, u.last_name, u.username)
+
+    cached = profile_cache.get(u.id)
+    if cached is None:
+        db = await get_db()
+        try:
+            row = await db.execute_fetchone(
+                """
+                SELECT first_name, last_name, username, fio, email
+                  FROM users
+                 WHERE telegram_id = ?
+                """,
+                (u.id,),
+            )
+        finally:
+            await db.close()
+        if row:
+            cached = tuple(row)
+            profile_cache.put(u.id, cached)
+
+    if cached is not None and cached[:3] == names:
+        profile_cache.touch(u.id)
+        return
+
+    await db_write(
+        """
+        INSERT INTO users (telegram_id, first_name, last_name, username, updated_at)
+        VALUES (?, ?, ?, ?, ?)
+        ON CONFLICT(telegram_id) DO UPDATE SET
+            first_name = excluded.first_name,
+            last_name  = excluded.last_name,
+            username   = excluded.username,
+            updated_at = excluded.updated_at
+        """,
+        (
+            u.id,
+            u.first_name,
+            u.last_name,
+            u.username,
+            now_ms(),
+        ),
+    )
+    profile_cache.put(u.id, names + (cached[3:] if cached else (None, None)))
+
+
+USER_PROFILE_UPDATE_SQL = """
+    UPDATE users
+       SET fio = COALESCE(?, fio),
+           email = COALESCE(?, email),
+           updated_at = ?
+     WHERE telegram_id = ?
+"""
+
+
+async def set_user_profile(telegram_id: int, fio: str | None, email: str | None):
+    if profile_cache.is_unchanged(telegram_id, fio, email):
+        profile_cache.touch(telegram_id)
+        return
+
+    result = await db_write(
+        USER_PROFILE_UPDATE_SQL, (fio, email, now_ms(), telegram_id)
+    )
+    profile_cache.profile_written(telegram_id, fio, email, result.rowcount)
+
+
+async def set_user_role(telegram_id: int, role: str):
+    result = await db_write(
+        """
+        UPDATE users
+           SET role = ?,
+               updated_at = ?
+         WHERE telegram_id = ?
+        """,
+        (role, now_ms(), telegram_id),
+    )
+    if result.rowcount:
+        role_cache.put(telegram_id, role)
+    else:
+        # пользователя ещё нет в БД — роль осталась дефолтной
+        role_cache.invalidate(telegram_id)
+    publish_invalidation("role", telegram_id)
+
+
+async def get_user_role(telegram_id: int) -> str:
+    role = role_cache.get(telegram_id)
+    if role is not None:
+        return role
+
+    generation = role_cache.generation
+    db = await get_db()
+    try:
+        row = await db.execute_fetchone(
+            "SELECT role FROM users WHERE telegram_id = ?", (telegram_id,)
+        )
+    finally:
+        await db.close()
+    role = row["role"] if row and row["role"] else "student"
+    role_cache.fill(telegram_id, role, generation)
+    return role
+
+
+# -----------------------------
+#  КОМАНДЫ
+# -----------------------------
+
+
+@router.message(CommandStart())
+async def cmd_start(message: Message):
+    await ensure_user(message)
+
+    role = await get_user_role(message.from_user.id)
+    role = role or "student"
+
+    role_map = {
+        "student": ("student", ["student"]),
+        "speaker": ("speaker", ["student", "speaker"]),
+        "admin": ("admin", ["student", "speaker", "admin"]),
+        "rating": ("rating", ["student"]),
+    }
+
+    role_param, allowed_panels = role_map.get(role, role_map["student"])
+    webapp_url = build_webapp_url(
+        WEBAPP_URL,
+        {
+            "role": role_param,
+            "panels": ",".join(allowed_panels),
+        },
+    )
+
+    kb = ReplyKeyboardMarkup(
+        resize_keyboard=True,
+        keyboard=[
+            [
+                KeyboardButton(
+                    text="Открыть мини-аппу",
+                    web_app=WebAppInfo(url=webapp_url),
+                )
+            ]
+        ],
+    )
+
+    await message.answer(
+        (
+            "Привет! Это бот для отметки посещаемости.\n\n"
+            "Нажми кнопку <b>«Открыть мини-аппу»</b>, чтобы запустить интерфейс,"
+            " который покажет разделы согласно твоей роли."
+        ),
+        reply_markup=kb,
+    )
+
+
+@router.message(Command("set_rating_chat"))
+async def cmd_set_rating_chat(message: Message):
+    """
+    Выполняется в чате команды рейтинга.
+    Только мастер-админ.
+    """
+    if message.from_user.id not in MASTER_ADMIN_IDS:
+        await message.reply("Команда только для мастер-админов.")
+        return
+
+    chat_id = message.chat.id
+    await set_setting("rating_chat_id", str(chat_id))
+    await message.reply(
+        f"Чат рейтинга установлен: <code>{chat_id}</code>\n"
+        "Сюда будут отправляться кружки на проверку."
+    )
+
+
+@router.message(Command("reload_settings"))
+async def cmd_reload_settings(message: Message):
+    """
+    Перечитывает таблицу settings, если её поменяли в обход бота.
+    Только мастер-админ.
+    """
+    if message.from_user.id not in MASTER_ADMIN_IDS:
+        await message.reply("Команда только для мастер-админов.")
+        return
+
+    count = await settings_cache.reload()
+    await message.reply(f"Настройки перечитаны из БД: <b>{count}</b>.")
+
+
+@router.message(Command("cache_stats"))
+async def cmd_cache_stats(message: Message):
+    """Счётчики попаданий/промахов кэшей. Только мастер-админ."""
+    if message.from_user.id not in MASTER_ADMIN_IDS:
+        await message.reply("Команда только для мастер-админов.")
+        return
+
+    stats = role_cache.stats()
+    await message.reply(
+        "Кэш ролей: "
+        f"записей <b>{stats['size']}</b>, "
+        f"попаданий <b>{stats['hits']}</b>, "
+        f"промахов <b>{stats['misses']}</b>\n"
+        f"Пропущено записей профиля: <b>{profile_cache.skipped_writes}</b>"
+    )
+
+
+@router.message(Command("ingest_stats"))
+async def cmd_ingest_stats(message: Message):
+    """
+    Глубина и счётчики очередей: входящих payload'ов и исходящих сообщений.
+    Только мастер-админ.
+    """
+    if message.from_user.id not in MASTER_ADMIN_IDS:
+        await message.reply("Команда только для мастер-админов.")
+        return
+
+    stats = ingestion_queue.stats()
+    sending = outbound.stats()
+    replays = idempotency.stats()
+    await message.reply(
+        f"Очередь: сейчас <b>{stats['depth']}</b>, максимум <b>{stats['max_depth']}</b>\n"
+        f"Принято: <b>{stats['enqueued']}</b>, обработано: <b>{stats['processed']}</b>, "
+        f"ошибок: <b>{stats['failed']}</b>, отказов «занято»: <b>{stats['rejected']}</b>\n"
+        f"Исходящие: в очереди <b>{sending['depth']}</b>, "
+        f"отправляется <b>{sending['inflight']}</b>\n"
+        f"Отправлено: <b>{sending['sent']}</b>, "
+        f"схлопнуто: <b>{sending['coalesced']}</b>, "
+        f"отложено в outbox: <b>{sending['deferred']}</b>, "
+        f"потеряно: <b>{sending['dropped']}</b>, "
+        f"пауз flood control: <b>{sending['flood_waits']}</b>\n"
+        f"Повторные доставки отброшены: <b>{replays['hits']}</b> "
+        f"(ключей в окне: <b>{replays['size']}</b>)"
+    )
+
+
+@router.message(Command("check_stats"))
+async def cmd_check_stats(message: Message):
+    """
+    Сверяет lecture_stats с attendances и при расхождении пересчитывает
+    таблицу целиком. Только мастер-админ.
+    """
+    if message.from_user.id not in MASTER_ADMIN_IDS:
+        await message.reply("Команда только для мастер-админов.")
+        return
+
+    drift = await find_lecture_stats_drift()
+    if not drift:
+        await message.reply("Статистика лекций сходится с отметками.")
+        return
+
+    logger.warning("lecture_stats drift for lectures: %s", drift)
+    count = await rebuild_lecture_stats()
+    await message.reply(
+        f"Статистика расходилась по лекциям: <b>{len(drift)}</b>.\n"
+        f"Пересчитано лекций: <b>{count}</b>."
+    )
+
+
+@router.message(Command("whoami"))
+async def cmd_whoami(message: Message):
+    await ensure_user(message)
+    role = await get_user_role(message.from_user.id)
+    await message.reply(
+        f"Ваш Telegram ID: <code>{message.from_user.id}</code>\n"
+        f"Текущая роль в системе: <b>{role}</b>"
+    )
+
+
+# -----------------------------
+#  ОБРАБОТКА WEB_APP_DATA
+# -----------------------------
+
+
+class IngestionQueue:
+    """
+    Ограниченная очередь между webapp_data_handler и handle_*.
+
+    Хендлер только разбирает JSON и кладёт задачу в очередь; обработку
+    ведут concurrency воркеров, поэтому одновременно к БД идёт ограниченное
+    число payload'ов. Меньший priority обрабатывается раньше (отметки
+    обгоняют geo_stream). Когда очередь заполнена, submit() сразу
+    возвращает False; низкоприоритетные задачи начинают отбрасываться уже
+    на половине глубины.
+
+    Задачи с одним key (пользователь) выполняются строго по одной и в
+    порядке submit(), независимо от priority: пока у key есть задача в
+    очереди или в работе, следующие ждут в её цепочке.
+    """
+
+    def __init__(self, concurrency: int, max_depth: int, low_priority: int):
+        self.concurrency = concurrency
+        self.max_depth = max_depth
+        self.low_priority = low_priority
+        self._queue: asyncio.PriorityQueue | None = None
+        self._loop: asyncio.AbstractEventLoop | None = None
+        self._workers: list[asyncio.Task] = []
+        self._seq = itertools.count()
+        self._chains: dict[object, deque] = {}
+        self._chained = 0
+        self.enqueued = 0
+        self.processed = 0
+        self.failed = 0
+        self.rejected = 0
+        self.max_seen_depth = 0
+
+    @property
+    def depth(self) -> int:
+        if self._queue is None:
+            return 0
+        return self._queue.qsize() + self._chained
+
+    def start(self) -> None:
+        loop = asyncio.get_running_loop()
+        if self._loop is loop:
+            return
+        self._loop = loop
+        self._queue = asyncio.PriorityQueue()
+        self._workers = [
+            loop.create_task(self._worker()) for _ in range(self.concurrency)
+        ]
+
+    def submit(self, priority: int, handler, *args, key=None) -> bool:
+        self.start()
+        depth = self.depth
+        limit = self.max_depth
+        if priority >= self.low_priority:
+            limit //= 2
+        if depth >= limit:
+            self.rejected += 1
+            return False
+        chain = self._chains.get(key) if key is not None else None
+        if chain is not None:
+            chain.append((handler, args))
+            self._chained += 1
+        else:
+            if key is not None:
+                self._chains[key] = deque()
+            self._queue.put_nowait((priority, next(self._seq), key, handler, args))
+        self.enqueued += 1
+        self.max_seen_depth = max(self.max_seen_depth, depth + 1)
+        return True
+
+    async def _worker(self) -> None:
+        while True:
+            _, _, key, handler, args = await self._queue.get()
+            try:
+                await self._run(handler, args)
+                # цепочку key дорабатывает тот же воркер — порядок сохраняется
+                chain = self._chains.get(key) if key is not None else None
+                while chain:
+                    handler, args = chain.popleft()
+                    self._chained -= 1
+                    await self._run(handler, args)
+            finally:
+                if key is not None:
+                    self._chains.pop(key, None)
+                self._queue.task_done()
+
+    async def _run(self, handler, args) -> None:
+        try:
+            await handler(*args)
+            self.processed += 1
+        except Exception:
+            self.failed += 1
+            logger.exception("Ошибка обработки payload из очереди")
+
+    async def stop(self) -> None:
+        """Дожидается обработки уже принятых задач и останавливает воркеры."""
+        if self._queue is None:
+            return
+        await self._queue.join()
+        for worker in self._workers:
+            worker.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers = []
+        self._chains.clear()
+        self._chained = 0
+        self._queue = None
+        self._loop = None
+
+    def stats(self) -> dict[str, int]:
+        return {
+            "depth": self.depth,
+            "max_depth": self.max_seen_depth,
+            "enqueued": self.enqueued,
+            "processed": self.processed,
+            "failed": self.failed,
+            "rejected": self.rejected,
+        }
+
+
+LOW_PRIORITY = 3
+
+json_loads = orjson.loads if orjson is not None else json.loads
+
+ingestion_queue = IngestionQueue(INGEST_CONCURRENCY, INGEST_QUEUE_LIMIT, LOW_PRIORITY)
+
+
+class PayloadError(ValueError):
+    """Payload не прошёл схему; текст ошибки показывается пользователю."""
+
+    def __init__(self, message: str, spec: "PayloadType | None" = None):
+        super().__init__(message)
+        self.spec = spec
+
+
+# Конвертеры полей схемы: получают значение из JSON (не None) и возвращают
+# нормализованное или бросают PayloadError. None в ответ — «поле пустое».
+
+
+def str_field(max_len: int = 256):
+    def convert(value):
+        if isinstance(value, bool) or not isinstance(value, (str, int)):
+            raise PayloadError("ожидалась строка")
+        value = str(value).strip()
+        if len(value) > max_len:
+            raise PayloadError(f"длиннее {max_len} символов")
+        return value or None
+
+    return convert
+
+
+def float_field(lo: float = -math.inf, hi: float = math.inf, clamp: bool = False):
+    """clamp — значение вне [lo, hi] прижимается к границе, NaN — пустое поле."""
+
+    def convert(value):
+        if isinstance(value, bool):
+            raise PayloadError("ожидалось число")
+        try:
+            value = float(value)
+        except (TypeError, ValueError):
+            raise PayloadError("ожидалось число") from None
+        if not lo <= value <= hi:  # NaN тоже не проходит
+            if clamp:
+                return None if math.isnan(value) else min(max(value, lo), hi)
+            raise PayloadError(f"вне диапазона [{lo:g}, {hi:g}]")
+        return value
+
+    return convert
+
+
+def int_field(lo: int = 0):
+    def convert(value):
+        if isinstance(value, str) and value.strip().isdigit():
+            value = int(value)
+        if isinstance(value, bool) or not isinstance(value, int):
+            raise PayloadError("ожидалось целое число")
+        if value < lo:
+            raise PayloadError(f"меньше {lo}")
+        return value
+
+    return convert
+
+
+def list_field(max_items: int):
+    def convert(value):
+        if not isinstance(value, list):
+            raise PayloadError("ожидался список")
+        if len(value) > max_items:
+            raise PayloadError(f"больше {max_items} элементов")
+        return value
+
+    return convert
+
+
+def object_field(fields: dict):
+    decode = compile_schema(fields)
+
+    def convert(value):
+        if not isinstance(value, dict):
+            raise PayloadError("ожидался объект")
+        return decode(value)
+
+    return convert
+
+
+class Field:
+    """Поле схемы payload: конвертер, обязательность и старые имена ключа."""
+
+    __slots__ = ("convert", "required", "aliases")
+
+    def __init__(self, convert, required: bool = False, aliases: tuple = ()):
+        self.convert = convert
+        self.required = required
+        self.aliases = aliases
+
+
+def compile_schema(fields: dict[str, Field], keep_extra: bool = False):
+    """
+    Превращает схему в функцию decode(dict) -> dict. Разбор схемы делается
+    здесь один раз; decode только проходит по готовому кортежу полей.
+    Ключи приводятся к основному имени (lecture_id -> lectureId), пустые
+    значения выбрасываются, незнакомые ключи — тоже, если не keep_extra.
+    """
+    plan = tuple(
+        (name, (name, *field.aliases), field.convert, field.required)
+        for name, field in fields.items()
+    )
+    known = frozenset(key for _, keys, _, _ in plan for key in keys)
+
+    def decode(data: dict) -> dict:
+        if keep_extra:
+            out = {key: value for key, value in data.items() if key not in known}
+        else:
+            out = {}
+        for name, keys, convert, required in plan:
+            value = None
+            for key in keys:
+                value = data.get(key)
+                if value is not None:
+                    break
+            if value is not None:
+                try:
+                    value = convert(value)
+                except PayloadError as e:
+                    raise PayloadError(f"поле {name}: {e}") from None
+            if value is not None:
+                out[name] = value
+            elif required:
+                raise PayloadError(f"нет поля {name}")
+        return out
+
+    return decode
+
+
+class PayloadType:
+    __slots__ = ("name", "handler", "decode", "priority")
+
+    def __init__(self, name: str, handler, decode, priority: int):
+        self.name = name
+        self.handler = handler
+        self.decode = decode
+        self.priority = priority
+
+
+# Реестр типов payload из мини-аппы; заполняется декоратором payload_type
+PAYLOAD_TYPES: dict[str, PayloadType] = {}
+
+# Поля, которые мини-аппа шлёт в любом payload
+COMMON_FIELDS = {
+    "type": Field(str_field(64), required=True),
+    "role": Field(str_field(32)),
+}
+
+
+def payload_type(
+    name: str, fields: dict[str, Field], *, priority: int, keep_extra: bool = False
+):
+    """
+    Регистрирует хендлер типа payload со схемой полей. Меньший priority
+    обрабатывается раньше (см. IngestionQueue).
+    """
+    decode = compile_schema({**COMMON_FIELDS, **fields}, keep_extra)
+
+    def register(handler):
+        PAYLOAD_TYPES[name] = PayloadType(name, handler, decode, priority)
+        return handler
+
+    return register
+
+
+def parse_webapp_payload(raw: str | bytes) -> tuple[PayloadType | None, dict]:
+    """
+    Разбирает web_app_data до постановки в очередь: размер, JSON, схема типа.
+    Для неизвестного типа возвращает (None, сырой dict).
+    """
+    size = len(raw) if isinstance(raw, bytes) else len(raw.encode())
+    if size > PAYLOAD_MAX_BYTES:
+        raise PayloadError(f"данные длиннее {PAYLOAD_MAX_BYTES} байт")
+    try:
+        data = json_loads(raw)
+    except ValueError:
+        raise PayloadError("некорректный JSON") from None
+    if not isinstance(data, dict):
+        raise PayloadError("ожидался JSON-объект")
+    p_type = data.get("type")
+    if not isinstance(p_type, str):
+        raise PayloadError("поле type: ожидалась строка")
+    spec = PAYLOAD_TYPES.get(p_type)
+    if spec is None:
+        return None, data
+    try:
+        return spec, spec.decode(data)
+    except PayloadError as e:
+        raise PayloadError(str(e), spec) from None
+
+
+@router.message(F.web_app_data)
+async def webapp_data_handler(message: Message):
+    """
+    Сюда прилетают данные из мини-аппы через Telegram.WebApp.sendData().
+    Проверяем payload по схеме его типа; кривые и неизвестные payload'ы
+    отсекаются до БД, остальные уходят в очередь.
+    """
+    raw = message.web_app_data.data
+    try:
+        spec, payload = parse_webapp_payload(raw)
+    except PayloadError as e:
+        logger.warning("Bad WebApp payload from %s: %s", message.from_user.id, e)
+        if e.spec is not None and e.spec.priority >= LOW_PRIORITY:
+            return  # фоновые payload'ы (geo_stream) отбрасываем молча
+        await message.answer(
+            f"⚠ Не удалось разобрать данные из мини-аппы: {html.escape(str(e))}."
+        )
+        return
+    if spec is None:
+        p_type = html.escape(str(payload.get("type")))
+        await message.answer(f"⚠ Неизвестный тип события: <code>{p_type}</code>.")
+        return
+    await route_webapp_data(message, spec, payload)
+
+
+async def route_webapp_data(message: Message, spec: PayloadType, payload: dict):
+    """
+    Ставит payload в очередь под ключом idempotency. Ключ закрывает сама
+    задача очереди (settle_webapp_payload), когда обработка прошла или
+    упала. Повторную доставку не обрабатываем, но отвечаем на неё: итогом
+    первой или тем, что она ещё в работе. При перегрузке просим повторить.
+    """
+    key = f"msg:{message.chat.id}:{message.message_id}"
+    first, outcome = await idempotency.claim(key)
+    if not first:
+        logger.info("Duplicate WebApp update %s", key)
+        if spec.priority < LOW_PRIORITY:
+            pending = "⏳ Эти данные уже получены и обрабатываются."
+            await message.answer(outcome["text"] if outcome else pending)
+        return
+    try:
+        submitted = ingestion_queue.submit(
+            spec.priority,
+            settle_webapp_payload,
+            key,
+            message,
+            spec,
+            payload,
+            key=message.from_user.id,
+        )
+    except BaseException:
+        idempotency.release(key)
+        raise
+    if submitted:
+        return
+    idempotency.release(key)  # «повторите» — повтор должен пройти
+    logger.warning(
+        "Ingestion queue saturated, rejected %s from %s",
+        spec.name,
+        message.from_user.id,
+    )
+    if spec.priority < LOW_PRIORITY:
+        await message.answer(
+            "⏳ Сервер сейчас перегружен. Повторите действие через несколько секунд."
+        )
+
+
+async def settle_webapp_payload(
+    key: str, message: Message, spec: PayloadType, payload: dict
+):
+    """
+    Задача очереди: обрабатывает payload и закрывает его ключ. Если
+    обработка упала, ключ освобождается — повторная доставка пройдёт.
+    """
+    try:
+        await process_webapp_payload(message, spec, payload)
+    except BaseException:
+        idempotency.release(key)
+        raise
+    outcome = None
+    if spec.priority < LOW_PRIORITY:
+        outcome = {"text": "✅ Эти данные уже получены и обработаны."}
+    await idempotency.complete(key, outcome)
+
+
+async def process_webapp_payload(message: Message, spec: PayloadType, payload: dict):
+    await ensure_user(message)
+
+    actual_role = await get_user_role(message.from_user.id)
+    declared_role = (payload.get("role") or "").lower() or None
+    logger.info(
+        "WebApp payload from %s (role=%s, declared=%s): %s",
+        message.from_user.id,
+        actual_role,
+        declared_role,
+        payload,
+    )
+    await spec.handler(message, payload)
+
+
+# -----------------------------
+#  ИСХОДЯЩИЕ СООБЩЕНИЯ
+# -----------------------------
+
+
+class TokenBucket:
+    """Ведро токенов: rate токенов в секунду, не больше capacity про запас."""
+
+    __slots__ = ("rate", "capacity", "tokens", "updated")
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def _refill(self, now: float) -> None:
+        if now > self.updated:
+            self.tokens = min(
+                self.capacity, self.tokens + (now - self.updated) * self.rate
+            )
+            self.updated = now
+
+    def delay(self, now: float) -> float:
+        """Сколько секунд ждать до следующего токена (0 — можно сейчас)."""
+        self._refill(now)
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def take(self, now: float) -> None:
+        self._refill(now)
+        self.tokens -= 1
+
+    def is_full(self, now: float) -> bool:
+        self._refill(now)
+        return self.tokens >= self.capacity
+
+
+class OutboundMessage:
+    """Один вызов Bot API в очереди: bot.<method>(chat_id=chat_id, **params)."""
+
+    __slots__ = (
+        "method",
+        "chat_id",
+        "params",
+        "key",
+        "hook",
+        "context",
+        "attempts",
+        "outbox_id",
+    )
+
+    def __init__(
+        self,
+        method: str,
+        chat_id: int,
+        params: dict,
+        key: str | None = None,
+        hook: str | None = None,
+        context: dict | None = None,
+        attempts: int = 0,
+        outbox_id: int | None = None,
+    ):
+        self.method = method
+        self.chat_id = chat_id
+        self.params = params
+        self.key = key
+        self.hook = hook
+        self.context = context
+        self.attempts = attempts
+        self.outbox_id = outbox_id
+
+    @property
+    def per_chat(self) -> bool:
+        # лимит на чат касается новых сообщений; удаление и правки его не тратят
+        return self.method.startswith("send_")
+
+
+# Ошибки, после которых повтор не поможет (классы aiogram.exceptions)
+PERMANENT_SEND_ERRORS = frozenset(
+    {"TelegramBadRequest", "TelegramForbiddenError", "TelegramNotFound"}
+)
+
+
+def _to_json(value):
+    # клавиатуры aiogram — pydantic-модели
+    if hasattr(value, "model_dump"):
+        return value.model_dump(exclude_none=True)
+    raise TypeError(f"{type(value).__name__} не сериализуется в JSON")
+
+
+# сообщение с key заменяет уже отложенное с тем же key, как и в очереди
+OUTBOX_INSERT_SQL = """
+INSERT INTO outbox (method, chat_id, params, hook, context, attempts,
+                    next_attempt_at, last_error, key)
+VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+ON CONFLICT(key) WHERE key IS NOT NULL DO UPDATE SET
+    method = excluded.method,
+    chat_id = excluded.chat_id,
+    params = excluded.params,
+    hook = excluded.hook,
+    context = excluded.context,
+    attempts = excluded.attempts,
+    next_attempt_at = excluded.next_attempt_at,
+    last_error = excluded.last_error
+"""
+
+
+class OutboundSender:
+    """
+    Очередь исходящих вызовов Bot API с учётом лимитов Telegram.
+
+    Хендлеры кладут сообщение через enqueue() и сразу идут дальше; отправкой
+    занимается одна задача-диспетчер. Общее ведро токенов ограничивает бота
+    целиком, ведро на чат — отправку в один чат (в группы реже, чем в личку).
+    Сообщения в один чат уходят по порядку, разные чаты — параллельно, но
+    не больше concurrency сразу.
+
+    Ошибка с retry_after (TelegramRetryAfter) ставит на паузу всю очередь,
+    сообщение остаётся первым в своём чате. Прочие временные ошибки
+    записывают сообщение в outbox с растущей задержкой; retry_outbox()
+    возвращает их в очередь. Сообщения с одинаковым key схлопываются:
+    пока старое не ушло, его заменяет новое — и в очереди, и в outbox
+    (там key уникален; отправка по key удаляет отложенную копию).
+    """
+
+    def __init__(
+        self,
+        global_rate: float,
+        chat_rate: float,
+        group_rate: float,
+        concurrency: int,
+        max_attempts: int,
+        retry_delay: float,
+    ):
+        self.chat_rate = chat_rate
+        self.group_rate = group_rate
+        self.concurrency = concurrency
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+        self._global = TokenBucket(global_rate, max(global_rate, 1))
+        self._buckets: dict[int, TokenBucket] = {}
+        self._queues: OrderedDict[int, deque[OutboundMessage]] = OrderedDict()
+        self._keys: dict[str, OutboundMessage] = {}
+        self._sending_keys: set[str] = set()
+        self._busy: set[int] = set()
+        self._inflight: set[asyncio.Task] = set()
+        self._paused_until = 0.0
+        self._loop: asyncio.AbstractEventLoop | None = None
+        self._wakeup: asyncio.Event | None = None
+        self._dispatcher: asyncio.Task | None = None
+        self.enqueued = 0
+        self.coalesced = 0
+        self.sent = 0
+        self.deferred = 0
+        self.dropped = 0
+        self.flood_waits = 0
+
+    @property
+    def depth(self) -> int:
+        return sum(len(queue) for queue in self._queues.values())
+
+    def start(self) -> None:
+        loop = asyncio.get_running_loop()
+        if self._loop is loop:
+            return
+        self._loop = loop
+        self._wakeup = asyncio.Event()
+        self._busy.clear()
+        self._inflight.clear()
+        self._dispatcher = loop.create_task(self._dispatch())
+
+    def enqueue(
+        self,
+        method: str,
+        chat_id: int,
+        *,
+        key: str | None = None,
+        hook: str | None = None,
+        context: dict | None = None,
+        **params,
+    ) -> None:
+        if key is not None and key in self._keys:
+            queued = self._keys[key]
+            queued.method, queued.params = method, params
+            queued.hook, queued.context = hook, context
+            self.coalesced += 1
+            return
+        self._push(OutboundMessage(method, chat_id, params, key, hook, context))
+        self.enqueued += 1
+
+    def _push(self, msg: OutboundMessage, first: bool = False) -> None:
+        queue = self._queues.get(msg.chat_id)
+        if queue is None:
+            queue = self._queues[msg.chat_id] = deque()
+        if first:
+            queue.appendleft(msg)
+        else:
+            queue.append(msg)
+        if msg.key is not None:
+            self._keys[msg.key] = msg
+        self.start()
+        self._wakeup.set()
+
+    def _bucket(self, chat_id: int) -> TokenBucket:
+        bucket = self._buckets.get(chat_id)
+        if bucket is None:
+            # отрицательные id — группы и каналы
+            rate = self.group_rate if chat_id < 0 else self.chat_rate
+            bucket = self._buckets[chat_id] = TokenBucket(rate, 1)
+        return bucket
+
+    def _pump(self) -> float | None:
+        """
+        Запускает отправку всего, что пропускают лимиты. Возвращает, через
+        сколько секунд проверить снова (None — ждать нового сообщения).
+        """
+        now = time.monotonic()
+        if now < self._paused_until:
+            return self._paused_until - now
+        wait = None
+        for chat_id in list(self._queues):
+            if len(self._inflight) >= self.concurrency:
+                return wait
+            if chat_id in self._busy:
+                continue
+            queue = self._queues[chat_id]
+            msg = queue[0]
+            bucket = self._bucket(chat_id) if msg.per_chat else None
+            delay = bucket.delay(now) if bucket is not None else 0.0
+            if delay == 0:
+                delay = self._global.delay(now)
+                if delay == 0:
+                    self._global.take(now)
+                    if bucket is not None:
+                        bucket.take(now)
+                    queue.popleft()
+                    if not queue:
+                        del self._queues[chat_id]
+                    if msg.key is not None:
+                        self._keys.pop(msg.key, None)
+                        self._sending_keys.add(msg.key)
+                    self._busy.add(chat_id)
+                    task = self._loop.create_task(self._send(msg))
+                    self._inflight.add(task)
+                    task.add_done_callback(self._inflight.discard)
+                    continue
+            wait = delay if wait is None else min(wait, delay)
+        self._prune_buckets(now)
+        return wait
+
+    def _prune_buckets(self, now: float) -> None:
+        if len(self._buckets) <= 4 * len(self._queues) + 1024:
+            return
+        for chat_id, bucket in list(self._buckets.items()):
+            if chat_id not in self._queues and bucket.is_full(now):
+                del self._buckets[chat_id]
+
+    async def _dispatch(self) -> None:
+        while True:
+            self._wakeup.clear()
+            wait = self._pump()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), wait)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _send(self, msg: OutboundMessage) -> None:
+        try:
+            method = getattr(bot, msg.method)
+            result = await method(chat_id=msg.chat_id, **msg.params)
+        except Exception as e:
+            await self._failed(msg, e)
+        else:
+            self.sent += 1
+            try:
+                if msg.key is not None:
+                    # отложенная раньше копия с тем же key больше не нужна
+                    await db_write("DELETE FROM outbox WHERE key = ?", (msg.key,))
+                elif msg.outbox_id is not None:
+                    await db_write("DELETE FROM outbox WHERE id = ?", (msg.outbox_id,))
+                if msg.hook is not None:
+                    await OUTBOX_HOOKS[msg.hook](result, msg.context)
+            except Exception:
+                logger.exception("Ошибка после отправки %s", msg.method)
+        finally:
+            self._busy.discard(msg.chat_id)
+            self._sending_keys.discard(msg.key)
+            self._wakeup.set()
+
+    async def _failed(self, msg: OutboundMessage, error: Exception) -> None:
+        retry_after = getattr(error, "retry_after", None)
+        if retry_after is not None:
+            self.flood_waits += 1
+            self._paused_until = max(
+                self._paused_until, time.monotonic() + float(retry_after)
+            )
+            logger.warning("Flood control: пауза отправки на %s с", retry_after)
+            # если за это время пришла замена с тем же key, старое не нужно
+            if msg.key is None or msg.key not in self._keys:
+                self._push(msg, first=True)
+            return
+
+        msg.attempts += 1
+        if (
+            type(error).__name__ in PERMANENT_SEND_ERRORS
+            or msg.attempts >= self.max_attempts
+        ):
+            self.dropped += 1
+            logger.warning(
+                "Не удалось выполнить %s в чат %s (попыток: %s): %s",
+                msg.method,
+                msg.chat_id,
+                msg.attempts,
+                error,
+            )
+            if msg.outbox_id is not None:
+                try:
+                    await db_write(
+                        "DELETE FROM outbox WHERE id = ?", (msg.outbox_id,)
+                    )
+                except Exception:
+                    logger.exception("Не удалось удалить %s из outbox", msg.method)
+            return
+
+        self.deferred += 1
+        next_attempt_at = now_ms() + int(
+            self.retry_delay * 2 ** (msg.attempts - 1) * 1000
+        )
+        try:
+            if msg.outbox_id is None:
+                await db_write(
+                    OUTBOX_INSERT_SQL,
+                    self._outbox_row(msg, next_attempt_at, repr(error)),
+                )
+            else:
+                # в строку могло схлопнуться более новое сообщение
+                await db_write(
+                    """
+                    UPDATE outbox
+                       SET method = ?, chat_id = ?, params = ?, hook = ?,
+                           context = ?, attempts = ?, next_attempt_at = ?,
+                           last_error = ?, key = ?
+                     WHERE id = ?
+                    """,
+                    (
+                        *self._outbox_row(msg, next_attempt_at, repr(error)),
+                        msg.outbox_id,
+                    ),
+                )
+        except Exception:
+            logger.exception("Не удалось сохранить %s в outbox", msg.method)
+
+    @staticmethod
+    def _outbox_row(msg: OutboundMessage, next_attempt_at: int, error: str | None):
+        return (
+            msg.method,
+            msg.chat_id,
+            json.dumps(msg.params, ensure_ascii=False, default=_to_json),
+            msg.hook,
+            json.dumps(msg.context) if msg.context is not None else None,
+            msg.attempts,
+            next_attempt_at,
+            error,
+            msg.key,
+        )
+
+    def restore(self, row) -> None:
+        """Возвращает в очередь строку outbox, взятую retry_outbox()."""
+        key = row["key"]
+        if key is not None and (key in self._keys or key in self._sending_keys):
+            # в очереди уже более новое сообщение с этим key: отправившись,
+            # оно удалит строку, а не удавшись — перезапишет её
+            return
+        self._push(
+            OutboundMessage(
+                row["method"],
+                row["chat_id"],
+                json.loads(row["params"]),
+                hook=row["hook"],
+                context=json.loads(row["context"]) if row["context"] else None,
+                key=key,
+                attempts=row["attempts"],
+                outbox_id=row["id"],
+            )
+        )
+
+    async def drain(self) -> None:
+        """Ждёт, пока уйдёт всё, что уже в очереди."""
+        if self._queues:
+            self.start()
+        while self._queues or self._inflight:
+            await asyncio.gather(*self._inflight)
+            if self._queues:
+                await asyncio.sleep(0.01)
+
+    async def stop(self) -> int:
+        """
+        Останавливает диспетчер, дожидается начатых отправок и сохраняет
+        неотправленное в outbox, чтобы после перезапуска оно ушло.
+        """
+        if self._dispatcher is not None:
+            self._dispatcher.cancel()
+            await asyncio.gather(self._dispatcher, return_exceptions=True)
+        await asyncio.gather(*self._inflight, return_exceptions=True)
+        queued = [msg for queue in self._queues.values() for msg in queue]
+        self.clear()
+        rows = [
+            self._outbox_row(msg, now_ms(), None)
+            for msg in queued
+            if msg.outbox_id is None
+        ]
+        if rows:
+            writer = await get_writer()
+            await writer.executemany(OUTBOX_INSERT_SQL, rows)
+        # уже лежащие в outbox строки подхватит следующий retry_outbox()
+        leased = [(now_ms(), msg.outbox_id) for msg in queued if msg.outbox_id]
+        if leased:
+            writer = await get_writer()
+            await writer.executemany(
+                "UPDATE outbox SET next_attempt_at = ? WHERE id = ?", leased
+            )
+        return len(queued)
+
+    def clear(self) -> None:
+        self._queues.clear()
+        self._keys.clear()
+        self._sending_keys.clear()
+        self._busy.clear()
+        self._inflight.clear()
+        self._paused_until = 0.0
+        self._dispatcher = None
+        self._wakeup = None
+        self._loop = None
+
+    def stats(self) -> dict[str, int]:
+        return {
+            "depth": self.depth,
+            "inflight": len(self._inflight),
+            "enqueued": self.enqueued,
+            "coalesced": self.coalesced,
+            "sent": self.sent,
+            "deferred": self.deferred,
+            "dropped": self.dropped,
+            "flood_waits": self.flood_waits,
+        }
+
+
+outbound = OutboundSender(
+    SEND_GLOBAL_RATE,
+    SEND_CHAT_RATE,
+    SEND_GROUP_PER_MINUTE / 60,
+    SEND_CONCURRENCY,
+    SEND_MAX_ATTEMPTS,
+    SEND_RETRY_DELAY,
+)
+
+
+async def retry_outbox(limit: int = 500) -> int:
+    """
+    Забирает из outbox сообщения, которым пора повторить отправку.
+    Строки не удаляются, а откладываются на SEND_RETRY_LEASE: если процесс
+    упадёт раньше отправки, сообщение вернётся в очередь само.
+    """
+    now = now_ms()
+    result = await db_write(
+        """
+        UPDATE outbox
+           SET next_attempt_at = ?
+         WHERE id IN (
+                SELECT id FROM outbox
+                 WHERE next_attempt_at <= ?
+              ORDER BY next_attempt_at
+                 LIMIT ?
+               )
+     RETURNING id, method, chat_id, params, hook, context, attempts, key
+        """,
+        (now + int(SEND_RETRY_LEASE * 1000), now, limit),
+    )
+    columns = (
+        "id",
+        "method",
+        "chat_id",
+        "params",
+        "hook",
+        "context",
+        "attempts",
+        "key",
+    )
+    for row in result.rows:
+        outbound.restore(dict(zip(columns, row)))
+    return len(result.rows)
+
+
+# -----------------------------
+#  ХЕНДЛЕРЫ ДЛЯ ТИПОВ PAYLOAD
+# -----------------------------
+
+# Схемы полей и типы payload'ов. Ключи — как их шлёт мини-аппа (camelCase);
+# старые snake_case-варианты принимаются как алиасы.
+
+LECTURE_ID_FIELD = Field(str_field(128), aliases=("lecture_id",))
+LAT_FIELD = Field(float_field(-90, 90))
+LON_FIELD = Field(float_field(-180, 180))
+# грубая точность (геолокация по IP на десктопе) — не повод отклонять отметку
+ACCURACY_FIELD = Field(float_field(0, 100_000, clamp=True))
+PROFILE_FIELDS = {"fio": Field(str_field(256)), "email": Field(str_field(256))}
+
+
+class GeoFix(TypedDict, total=False):
+    latitude: float
+    longitude: float
+    accuracy: float
+
+
+class BasePayload(TypedDict, total=False):
+    type: str
+    role: str
+
+
+class LecturePayload(BasePayload, total=False):
+    lectureId: str
+
+
+class RegisterPayload(BasePayload, total=False):
+    fio: str
+    email: str
+
+
+class QrScanPayload(BasePayload, total=False):
+    qr: str
+
+
+class GeoStreamPayload(BasePayload, total=False):
+    lat: float
+    lon: float
+    accuracy: float
+    timestamp: int
+
+
+class CheckinPayload(LecturePayload, total=False):
+    fio: str
+    email: str
+    lastGeo: GeoFix
+    device: str
+
+
+class SetGeoPayload(LecturePayload, total=False):
+    lat: float
+    lon: float
+    accuracy: float
+
+
+class ZonePayload(LecturePayload, total=False):
+    name: str
+    lat: float
+    lon: float
+    radius: float
+    polygon: list
+
+
+class SetRolePayload(BasePayload, total=False):
+    targetUserId: int
+    newRole: str
+
+
+@payload_type("register", PROFILE_FIELDS, priority=2)
+async def handle_register(message: Message, payload: RegisterPayload):
+    fio = payload.get("fio")
+    email = payload.get("email")
+
+    await set_user_profile(message.from_user.id, fio, email)
+    await message.answer("✅ Профиль обновлён.\nФИО и почта сохранены в системе.")
+
+
+@payload_type("qr_scan", {"qr": Field(str_field(128))}, priority=2)
+async def handle_qr_scan(message: Message, payload: QrScanPayload):
+    qr = payload.get("qr")
+    if not qr:
+        await message.answer("⚠ Пустой QR.")
+        return
+
+    # В простейшем варианте считаем, что qr = ID лекции.
+    lecture_id = qr
+
+    await lecture_registry.ensure_loaded()
+    await lecture_registry.intern(lecture_id, message.from_user.id)
+
+    await message.answer(
+        f"📎 Лекция <code>{lecture_id}</code> привязана к вашему сеансу.\n"
+        "Итоговое решение, засчитывать ли отметку, принимает сервер."
+    )
+
+
+@payload_type(
+    "geo_stream",
+    {
+        "lat": LAT_FIELD,
+        "lon": LON_FIELD,
+        "accuracy": ACCURACY_FIELD,
+        "timestamp": Field(int_field()),
+    },
+    priority=LOW_PRIORITY,
+)
+async def handle_geo_stream(message: Message, payload: GeoStreamPayload):
+    """
     Live-трансляция геопозиции через watchPosition.
-    Сейчас мы просто логируем входящие координаты для диагностики.
+    Точки копятся в кольцевом буфере пользователя (geo_store) и пачками
+    пишутся в geo_samples; последняя точка подстраховывает отметку без lastGeo.
     """
     lat = payload.get("lat")
     lon = payload.get("lon")
@@ -467,8 +3562,8 @@ async def handle_geo_stream(message: Message, payload: dict):
         )
         return
 
-    # Можно сохранять последнюю geo в отдельную таблицу, но для простоты логируем:
-    logger.info(
+    geo_store.add(message.from_user.id, lat, lon, acc, ts)
+    logger.debug(
         "Geo stream from %s: lat=%s lon=%s acc=%s ts=%s",
         message.from_user.id,
         lat,
@@ -479,7 +3574,123 @@ async def handle_geo_stream(message: Message, payload: dict):
     # Пользователю не обязательно отвечать каждый раз.
 
 
-async def handle_checkin(message: Message, payload: dict):
+class CheckinOutcome(Enum):
+    APPROVED = "approved"
+    PENDING_VIDEO = "pending_video"
+    DUPLICATE = "duplicate"
+    CLOSED = "closed"
+    UNKNOWN_LECTURE = "unknown_lecture"
+
+
+async def record_checkin(
+    user_id: int,
+    lecture_id: int,
+    status: str,
+    lat: float | None,
+    lon: float | None,
+    acc: float | None,
+    device: str | None,
+    raw_payload: str,
+    fio: str | None,
+    email: str | None,
+) -> CheckinOutcome:
+    """
+    Записывает отметку одной транзакцией писателя: обновление профиля
+    (если оно что-то меняет) и INSERT ... SELECT, который вставляет строку
+    только для открытой лекции и молча пропускает дубль. Итог определяется
+    по самой БД, поэтому между проверкой и вставкой нет гонки.
+    """
+    statements = []
+    update_profile = not profile_cache.is_unchanged(user_id, fio, email)
+    if update_profile:
+        statements.append(
+            (USER_PROFILE_UPDATE_SQL, (fio, email, now_ms(), user_id))
+        )
+    statements.append(
+        (
+            """
+            INSERT INTO attendances (
+                user_id, lecture_id, status,
+                geo_lat, geo_lon, geo_accuracy,
+                device
+            )
+            SELECT ?, id, ?, ?, ?, ?, ?
+              FROM lectures
+             WHERE id = ? AND is_open = 1
+            ON CONFLICT(user_id, lecture_id) DO NOTHING
+            RETURNING id, status
+            """,
+            (user_id, status, lat, lon, acc, device, lecture_id),
+        )
+    )
+    statements.append(
+        (
+            """
+            SELECT l.is_open, a.status
+              FROM lectures l
+         LEFT JOIN attendances a
+                ON a.lecture_id = l.id AND a.user_id = ?
+             WHERE l.id = ?
+            """,
+            (user_id, lecture_id),
+        )
+    )
+
+    writer = await get_writer()
+    results = await writer.transaction(statements)
+    if update_profile:
+        profile_cache.profile_written(user_id, fio, email, results[0].rowcount)
+    else:
+        profile_cache.touch(user_id)
+
+    inserted, state = results[-2], results[-1]
+    if inserted.rows:
+        lecture_registry.set_attendee_status(lecture_id, user_id, status)
+        payload_archive.add(inserted.rows[0][0], raw_payload)
+        return CheckinOutcome(status)
+    if not state.rows:
+        return CheckinOutcome.UNKNOWN_LECTURE
+    is_open, existing_status = state.rows[0]
+    if not is_open:
+        return CheckinOutcome.CLOSED
+    lecture_registry.set_attendee_status(lecture_id, user_id, existing_status)
+    return CheckinOutcome.DUPLICATE
+
+
+def archived_payload(message: Message, payload: dict) -> str:
+    """
+    Запись для checkin_payloads: данные ровно в том виде, в каком их
+    прислала мини-аппа, — до алиасов, обрезки и отброса полей схемой.
+    """
+    web_app_data = getattr(message, "web_app_data", None)
+    if web_app_data is None:
+        return json.dumps({"raw": payload}, ensure_ascii=False)
+    # data уже проверена как JSON-объект — вклеиваем её без пересборки
+    return f'{{"raw": {web_app_data.data}}}'
+
+
+@payload_type(
+    "checkin",
+    {
+        "lectureId": LECTURE_ID_FIELD,
+        **PROFILE_FIELDS,
+        "lastGeo": Field(
+            object_field(
+                {
+                    "latitude": LAT_FIELD,
+                    "longitude": LON_FIELD,
+                    "accuracy": ACCURACY_FIELD,
+                }
+            )
+        ),
+        "device": Field(str_field(512)),
+    },
+    priority=1,
+    # незнакомые поля (appVersion и т. п.) остаются в payload для лога;
+    # в архив всё равно уходит исходный текст (archived_payload)
+    keep_extra=True,
+)
+async def handle_checkin(message: Message, payload: CheckinPayload):
     """
     Отметка студента:
     - проверяем, есть ли лекция
@@ -493,9 +3704,8 @@ async def handle_checkin(message: Message, payload: dict):
     last_geo = payload.get("lastGeo") or {}
     lecture_id = payload.get("lectureId")
 
-    await set_user_profile(user_id, fio or None, email or None)
-
     if not lecture_id:
+        await set_user_profile(user_id, fio, email)
         await message.answer(
             "⚠ Лекция не выбрана.\nОтсканируйте QR-код лекции в мини-аппе."
         )
@@ -504,114 +3714,77 @@ async def handle_checkin(message: Message, payload: dict):
     lat = last_geo.get("latitude")
     lon = last_geo.get("longitude")
     acc = last_geo.get("accuracy")
-
-    db = await get_db()
-    try:
-        # Проверим существование лекции и её геозону
-        cur = await db.execute(
-            "SELECT id, is_open, geo_lat, geo_lon, geo_radius FROM lectures WHERE id = ?",
-            (lecture_id,),
+    if lat is None or lon is None:
+        # мини-аппа не прислала lastGeo — берём свежую точку из geo_stream
+        fix = geo_store.last_fix(user_id, GEO_FIX_MAX_AGE)
+        if fix is not None:
+            lat, lon, acc = fix
+    distance = None
+
+    # Быстрые отказы — по реестру лекций в памяти, без записи отметки
+    await lecture_registry.ensure_loaded()
+    lec = await lecture_registry.lookup(lecture_id)
+    if lec is None:
+        outcome = CheckinOutcome.UNKNOWN_LECTURE
+    elif not lec.is_open:
+        outcome = CheckinOutcome.CLOSED
+    else:
+        # "один пользователь = одна отметка на лекцию" — по набору
+        # отметившихся в памяти; уникальный индекс остаётся страховкой.
+        if lec.attendees is None:
+            await lecture_registry.load_attendees(lec)
+        outcome = CheckinOutcome.DUPLICATE if user_id in lec.attendees else None
+
+    if outcome is not None:
+        await set_user_profile(user_id, fio, email)
+    else:
+        geo_ok, distance = lec.check_geo(lat, lon)
+        outcome = await record_checkin(
+            user_id,
+            lec.id,
+            "approved" if geo_ok else "pending_video",
+            lat,
+            lon,
+            acc,
+            payload.get("device"),
+            archived_payload(message, payload),
+            fio,
+            email,
         )
-        lec = await cur.fetchone()
 
-        if not lec:
-            await message.answer(
-                f"⚠ Лекция <code>{lecture_id}</code> не зарегистрирована.\n"
-                "Попросите спикера открыть лекцию в своей панели."
-            )
-            return
-
-        if not lec["is_open"]:
-            await message.answer(
-                f"🚫 Лекция <code>{lecture_id}</code> сейчас закрыта для отметок."
-            )
-            return
-
-        # Проверка "один пользователь = одна отметка на лекцию"
-        cur = await db.execute(
-            """
-            SELECT id, status
-              FROM attendances
-             WHERE user_id = ? AND lecture_id = ?
-            """,
-            (user_id, lecture_id),
+    if outcome is CheckinOutcome.UNKNOWN_LECTURE:
+        await message.answer(
+            f"⚠ Лекция <code>{lecture_id}</code> не зарегистрирована.\n"
+            "Попросите спикера открыть лекцию в своей панели."
         )
-        existing = await cur.fetchone()
-        if existing and existing["status"] in ("approved", "pending_video", "pending"):
-            await message.answer(
-                "ℹ Отметка по этой лекции уже существует.\n"
-                "Дублирующие отметки не засчитываются."
-            )
-            return
-
-        geo_ok = True
-        distance = None
-
-        if lec["geo_lat"] is not None and lec["geo_lon"] is not None:
-            if lat is None or lon is None:
-                geo_ok = False
-            else:
-                distance = haversine_m(lat, lon, lec["geo_lat"], lec["geo_lon"])
-                if distance is None:
-                    geo_ok = False
-                else:
-                    # если дальше радиуса, считаем подозрительным
-                    radius = lec["geo_radius"] or 150.0
-                    geo_ok = distance <= radius
-
-        status = "approved" if geo_ok else "pending_video"
-
-        try:
-            await db.execute(
-                """
-                INSERT INTO attendances (
-                    user_id, lecture_id, status,
-                    geo_lat, geo_lon, geo_accuracy,
-                    device, extra_json
-                )
-                VALUES (?, ?, ?, ?, ?, ?, ?, ?)
-                """,
-                (
-                    user_id,
-                    lecture_id,
-                    status,
-                    lat,
-                    lon,
-                    acc,
-                    payload.get("device") or None,
-                    json.dumps({"raw": payload}, ensure_ascii=False),
-                ),
-            )
-            await db.commit()
-        except aiosqlite.IntegrityError:
-            # уникальный индекс user_id+lecture_id
-            await message.answer(
-                "ℹ Отметка по этой лекции уже существует.\n"
-                "Дублирующие отметки не засчитываются."
-            )
-            return
-
-        if status == "approved":
-            text = (
-                "✅ Отметка предварительно засчитана.\n"
-                f"Лекция: <code>{lecture_id}</code>\n"
-            )
-            if distance is not None:
-                text += f"Расстояние до аудитории ≈ <b>{int(distance)} м</b>."
-            await message.answer(text)
-        else:
-            text = (
-                "⚠ Ваша геопозиция не совпала с геозоной лекции.\n"
-                "Пожалуйста, запишите <b>кружок (video note)</b> и отправьте его боту.\n"
-                "Команда рейтинга проверит и вручную засчитает/отклонит посещение."
-            )
-            await message.answer(text)
-
-    finally:
-        await db.close()
+    elif outcome is CheckinOutcome.CLOSED:
+        await message.answer(
+            f"🚫 Лекция <code>{lecture_id}</code> сейчас закрыта для отметок."
+        )
+    elif outcome is CheckinOutcome.DUPLICATE:
+        await message.answer(
+            "ℹ Отметка по этой лекции уже существует.\n"
+            "Дублирующие отметки не засчитываются."
+        )
+    elif outcome is CheckinOutcome.APPROVED:
+        text = (
+            "✅ Отметка предварительно засчитана.\n"
+            f"Лекция: <code>{lecture_id}</code>\n"
+        )
+        if distance is not None:
+            text += f"Расстояние до аудитории ≈ <b>{int(distance)} м</b>."
+        await message.answer(text)
+    else:
+        text = (
+            "⚠ Ваша геопозиция не совпала с геозоной лекции.\n"
+            "Пожалуйста, запишите <b>кружок (video note)</b> и отправьте его боту.\n"
+            "Команда рейтинга проверит и вручную засчитает/отклонит посещение."
+        )
+        await message.answer(text)
 
 
-async def handle_speaker_open_lecture(message: Message, payload: dict):
+@payload_type("speaker_open_lecture", {"lectureId": LECTURE_ID_FIELD}, priority=0)
+async def handle_speaker_open_lecture(message: Message, payload: LecturePayload):
     user_id = message.from_user.id
     role = await get_user_role(user_id)
     if role != "speaker" and user_id not in MASTER_ADMIN_IDS:
@@ -627,7 +3800,7 @@ async def handle_speaker_open_lecture(message: Message, payload: dict):
         )
         return
 
-    lecture_id = payload.get("lectureId") or payload.get("lecture_id")
+    lecture_id = payload.get("lectureId")
     if not lecture_id:
         await message.answer("⚠ Не указан ID лекции.")
         return
@@ -637,75 +3810,382 @@ async def handle_speaker_open_lecture(message: Message, payload: dict):
         await message.answer("🚫 Только спикер или мастер-админ может открывать лекцию.")
         return
 
+    await lecture_registry.ensure_loaded()
+    result = await db_write(
+        """
+        INSERT INTO lectures (code, is_open, created_by, opened_at)
+        VALUES (?, 1, ?, ?)
+        ON CONFLICT(code) DO UPDATE SET
+            is_open = 1,
+            opened_at = excluded.opened_at
+        RETURNING id
+        """,
+        (lecture_id, user_id, now_ms()),
+    )
+    (key,) = result.rows[0]
+    await lecture_registry.mark_open(lecture_registry.remember(key, lecture_id, user_id))
+    publish_invalidation("lectures", key)
+
+    await message.answer(
+        f"🔓 Лекция <code>{lecture_id}</code> открыта для отметок.\n"
+        "Студенты могут отмечаться через мини-аппу."
+    )
+
+
+@payload_type("speaker_close_lecture", {"lectureId": LECTURE_ID_FIELD}, priority=0)
+async def handle_speaker_close_lecture(message: Message, payload: LecturePayload):
+    user_id = message.from_user.id
+    role = await get_user_role(user_id)
+    if role != "speaker" and user_id not in MASTER_ADMIN_IDS:
+        logger.warning(
+            "Access denied for speaker_close_lecture: user=%s role=%s payload=%s",
+            user_id,
+            role,
+            payload,
+        )
+        await message.answer(
+            "🚫 У вас нет прав для закрытия лекции."
+            " Доступ разрешён только спикерам или мастер-админам."
+        )
+        return
+
+    lecture_id = payload.get("lectureId")
+    if not lecture_id:
+        await message.answer("⚠ Не указан ID лекции.")
+        return
+
+    await lecture_registry.ensure_loaded()
+    lecture = lecture_registry.get(lecture_id)
+    if lecture is not None:
+        await db_write(
+            """
+            UPDATE lectures
+               SET is_open = 0,
+                   closed_at = ?
+             WHERE id = ?
+            """,
+            (now_ms(), lecture.id),
+        )
+        lecture_registry.mark_closed(lecture)
+        publish_invalidation("lectures", lecture.id)
+
+    await message.answer(
+        f"🔒 Лекция <code>{lecture_id}</code> закрыта для новых отметок."
+    )
+
+
+def geo_ok_batch(lecture: Lecture, lats: list, lons: list) -> list[bool]:
+    """
+    check_geo для многих точек сразу. С numpy — векторно, без него — циклом.
+    Точка без координат (None) в геозону не попадает.
+    """
+    if not lecture.has_geofence:
+        return [True] * len(lats)
+    if np is not None:
+        lats = np.array(lats, dtype=float)
+        lons = np.array(lons, dtype=float)
+        # сравнения с NaN дают False — точки без координат не проходят
+        inside = np.zeros(len(lats), dtype=bool)
+        if lecture.geo_lat is not None and lecture.geo_lon is not None:
+            radius = lecture.geo_radius or DEFAULT_GEO_RADIUS
+            inside |= (
+                haversine_m_vec(lats, lons, lecture.geo_lat, lecture.geo_lon) <= radius
+            )
+        for zone_id in lecture.zone_ids:
+            zone = zone_index.get(zone_id)
+            if zone is not None:
+                inside |= zone.contains_vec(lats, lons)
+        return inside.tolist()
+    return [lecture.check_geo(lat, lon)[0] for lat, lon in zip(lats, lons)]
+
+
+async def reevaluate_lecture_geo(lecture_id: int) -> tuple[int, int]:
+    """
+    Пересчитывает автоматические решения по геозоне для уже сделанных отметок
+    лекции (после того как спикер поправил геозону): approved <-> pending_video.
+    Отметки, по которым уже есть кружок или решение рейтинга, не трогаем.
+    Возвращает (сколько стало approved, сколько стало pending_video).
+    """
+    await lecture_registry.ensure_loaded()
+    lecture = lecture_registry.by_id(lecture_id)
+    if lecture is None:
+        return 0, 0
+
     db = await get_db()
     try:
-        await db.execute(
+        rows = await db.execute_fetchall(
             """
-            INSERT INTO lectures (id, is_open, created_by, opened_at)
-            VALUES (?, 1, ?, ?)
-            ON CONFLICT(id) DO UPDATE SET
-                is_open = 1,
-                opened_at = excluded.opened_at
+            SELECT id, user_id, status, geo_lat, geo_lon
+              FROM attendances
+             WHERE lecture_id = ?
+               AND status IN ('approved', 'pending_video')
+               AND reviewer_id IS NULL
             """,
-            (lecture_id, user_id, now_iso()),
+            (lecture_id,),
+        )
+    finally:
+        await db.close()
+    if not rows:
+        return 0, 0
+
+    inside = geo_ok_batch(
+        lecture, [row["geo_lat"] for row in rows], [row["geo_lon"] for row in rows]
+    )
+    changes = []
+    for row, ok in zip(rows, inside):
+        new_status = "approved" if ok else "pending_video"
+        if new_status != row["status"]:
+            changes.append((new_status, row["id"], row["status"], row["user_id"]))
+    if not changes:
+        return 0, 0
+
+    writer = await get_writer()
+    # статус в WHERE — чтобы не затереть то, что успело поменяться за это время
+    await writer.executemany(
+        "UPDATE attendances SET status = ? WHERE id = ? AND status = ?",
+        [change[:3] for change in changes],
+    )
+    for new_status, _, _, user_id in changes:
+        lecture_registry.set_attendee_status(lecture_id, user_id, new_status)
+
+    approved = sum(1 for change in changes if change[0] == "approved")
+    return approved, len(changes) - approved
+
+
+@payload_type(
+    "speaker_set_geo",
+    {
+        "lectureId": LECTURE_ID_FIELD,
+        "lat": LAT_FIELD,
+        "lon": LON_FIELD,
+        "accuracy": ACCURACY_FIELD,
+    },
+    priority=0,
+)
+async def handle_speaker_set_geo(message: Message, payload: SetGeoPayload):
+    user_id = message.from_user.id
+    role = await get_user_role(user_id)
+    if role != "speaker" and user_id not in MASTER_ADMIN_IDS:
+        logger.warning(
+            "Access denied for speaker_set_geo: user=%s role=%s payload=%s",
+            user_id,
+            role,
+            payload,
+        )
+        await message.answer(
+            "🚫 У вас нет прав для изменения геозоны лекции."
+            " Доступ разрешён только спикерам или мастер-админам."
+        )
+        return
+
+    lecture_id = payload.get("lectureId")
+    lat = payload.get("lat")
+    lon = payload.get("lon")
+    acc = payload.get("accuracy")
+
+    if not lecture_id:
+        await message.answer(
+            "⚠ Не указан ID лекции.\nВ мини-аппе заполните поле ID лекции."
         )
-        await db.commit()
-    finally:
-        await db.close()
+        return
+    if lat is None or lon is None:
+        await message.answer("⚠ Не удалось получить координаты для геозоны.")
+        return
 
-    await message.answer(
-        f"🔓 Лекция <code>{lecture_id}</code> открыта для отметок.\n"
-        "Студенты могут отмечаться через мини-аппу."
+    await lecture_registry.ensure_loaded()
+    result = await db_write(
+        """
+        INSERT INTO lectures
+            (code, is_open, created_by, geo_lat, geo_lon, geo_radius, opened_at)
+        VALUES (?, 0, ?, ?, ?, ?, ?)
+        ON CONFLICT(code) DO UPDATE SET
+            geo_lat = excluded.geo_lat,
+            geo_lon = excluded.geo_lon,
+            geo_radius = excluded.geo_radius
+        RETURNING id
+        """,
+        (
+            lecture_id,
+            message.from_user.id,
+            lat,
+            lon,
+            DEFAULT_GEO_RADIUS,
+            now_ms(),
+        ),
     )
+    (key,) = result.rows[0]
+    lecture = lecture_registry.remember(key, lecture_id, message.from_user.id)
+    lecture.geo_lat = lat
+    lecture.geo_lon = lon
+    lecture.geo_radius = DEFAULT_GEO_RADIUS
+
+    approved, pending = await reevaluate_lecture_geo(lecture.id)
+    publish_invalidation("lectures", lecture.id)
+    text = (
+        f"📍 Геозона для лекции <code>{lecture_id}</code> установлена.\n"
+        f"lat={lat:.5f}, lon={lon:.5f}, точность ≈ {acc!r}."
+    )
+    if approved or pending:
+        text += (
+            "\nУже сделанные отметки пересчитаны: "
+            f"засчитано <b>{approved}</b>, ожидают кружок <b>{pending}</b>."
+        )
+    await message.answer(text)
 
 
-async def handle_speaker_close_lecture(message: Message, payload: dict):
+def parse_polygon(raw) -> list[tuple[float, float]] | None:
+    """
+    [[lat, lon], ...] из payload; None, если вершин меньше трёх, они кривые
+    или выходят за пределы широты [-90, 90] / долготы [-180, 180].
+    """
+    if not isinstance(raw, list) or len(raw) < 3:
+        return None
+    try:
+        polygon = [(float(lat), float(lon)) for lat, lon in raw]
+    except (TypeError, ValueError):
+        return None
+    if not all(-90 <= lat <= 90 and -180 <= lon <= 180 for lat, lon in polygon):
+        return None
+    return polygon
+
+
+ZONE_FIELDS = {"lectureId": LECTURE_ID_FIELD, "name": Field(str_field(64))}
+
+
+@payload_type(
+    "speaker_set_zone",
+    {
+        **ZONE_FIELDS,
+        "lat": LAT_FIELD,
+        "lon": LON_FIELD,
+        "radius": Field(float_field(1, 50_000)),
+        "polygon": Field(list_field(256)),
+    },
+    priority=0,
+)
+async def handle_speaker_set_zone(message: Message, payload: ZonePayload):
+    """
+    Создаёт/обновляет именованную геозону и привязывает её к лекции.
+    Круг: {name, lat, lon, radius}; многоугольник: {name, polygon: [[lat, lon], ...]}.
+    """
     user_id = message.from_user.id
     role = await get_user_role(user_id)
     if role != "speaker" and user_id not in MASTER_ADMIN_IDS:
         logger.warning(
-            "Access denied for speaker_close_lecture: user=%s role=%s payload=%s",
+            "Access denied for speaker_set_zone: user=%s role=%s payload=%s",
             user_id,
             role,
             payload,
         )
         await message.answer(
-            "🚫 У вас нет прав для закрытия лекции."
+            "🚫 У вас нет прав для изменения геозоны лекции."
             " Доступ разрешён только спикерам или мастер-админам."
         )
         return
 
-    lecture_id = payload.get("lectureId") or payload.get("lecture_id")
-    if not lecture_id:
-        await message.answer("⚠ Не указан ID лекции.")
+    lecture_id = payload.get("lectureId")
+    name = payload.get("name")
+    if not lecture_id or not name:
+        await message.answer("⚠ Укажите ID лекции и название зоны.")
         return
 
-    db = await get_db()
-    try:
-        await db.execute(
-            """
-            UPDATE lectures
-               SET is_open = 0,
-                   closed_at = ?
-             WHERE id = ?
-            """,
-            (now_iso(), lecture_id),
+    if "polygon" in payload:
+        polygon = parse_polygon(payload["polygon"])
+        if polygon is None:
+            await message.answer(
+                "⚠ Многоугольник должен содержать минимум три точки"
+                " с корректными координатами."
+            )
+            return
+        zone_fields = ("polygon", None, None, None, json.dumps(polygon))
+    else:
+        lat = payload.get("lat")
+        lon = payload.get("lon")
+        if lat is None or lon is None:
+            await message.answer("⚠ Не удалось получить координаты для геозоны.")
+            return
+        radius = payload.get("radius", DEFAULT_GEO_RADIUS)
+        zone_fields = ("circle", lat, lon, radius, None)
+
+    await lecture_registry.ensure_loaded()
+    # имена зон общие: чужую зону не переопределяем, иначе тихо сдвинется
+    # геозона лекций другого спикера
+    zone = zone_index.by_name(name)
+    if zone is not None and any(
+        other.created_by != user_id for other in lecture_registry.with_zone(zone.id)
+    ):
+        await message.answer(
+            f"⚠ Зона <b>{html.escape(name)}</b> уже используется в лекциях"
+            " другого спикера. Выберите другое название."
         )
-        await db.commit()
-    finally:
-        await db.close()
+        return
 
-    await message.answer(
-        f"🔒 Лекция <code>{lecture_id}</code> закрыта для новых отметок."
+    lecture = await lecture_registry.intern(lecture_id, user_id)
+    writer = await get_writer()
+    results = await writer.transaction(
+        [
+            (
+                """
+                INSERT INTO geo_zones (name, kind, lat, lon, radius, polygon_json)
+                VALUES (?, ?, ?, ?, ?, ?)
+                ON CONFLICT(name) DO UPDATE SET
+                    kind = excluded.kind,
+                    lat = excluded.lat,
+                    lon = excluded.lon,
+                    radius = excluded.radius,
+                    polygon_json = excluded.polygon_json
+                RETURNING id
+                """,
+                (name, *zone_fields),
+            ),
+            (
+                """
+                INSERT OR IGNORE INTO lecture_zones (lecture_id, zone_id)
+                SELECT ?, id FROM geo_zones WHERE name = ?
+                """,
+                (lecture.id, name),
+            ),
+        ]
+    )
+    (zone_id,) = results[0].rows[0]
+    kind, lat, lon, radius, polygon_json = zone_fields
+    zone_index.add(
+        GeoZone(
+            zone_id,
+            name,
+            kind,
+            lat,
+            lon,
+            radius,
+            [tuple(p) for p in json.loads(polygon_json)] if polygon_json else None,
+        )
     )
+    lecture.zone_ids = lecture.zone_ids | {zone_id}
+
+    # зона могла поменяться и у других лекций спикера — пересчитываем все с ней
+    approved = pending = 0
+    for other in lecture_registry.with_zone(zone_id):
+        a, p = await reevaluate_lecture_geo(other.id)
+        approved += a
+        pending += p
+        publish_invalidation("lectures", other.id)
+
+    text = f"📍 Зона <b>{name}</b> привязана к лекции <code>{lecture_id}</code>."
+    if approved or pending:
+        text += (
+            "\nУже сделанные отметки пересчитаны: "
+            f"засчитано <b>{approved}</b>, ожидают кружок <b>{pending}</b>."
+        )
+    await message.answer(text)
 
 
-async def handle_speaker_set_geo(message: Message, payload: dict):
+@payload_type("speaker_remove_zone", ZONE_FIELDS, priority=0)
+async def handle_speaker_remove_zone(message: Message, payload: ZonePayload):
     user_id = message.from_user.id
     role = await get_user_role(user_id)
     if role != "speaker" and user_id not in MASTER_ADMIN_IDS:
         logger.warning(
-            "Access denied for speaker_set_geo: user=%s role=%s payload=%s",
+            "Access denied for speaker_remove_zone: user=%s role=%s payload=%s",
             user_id,
             role,
             payload,
@@ -716,51 +4196,38 @@ async def handle_speaker_set_geo(message: Message, payload: dict):
         )
         return
 
-    lecture_id = payload.get("lectureId") or payload.get("lecture_id")
-    lat = payload.get("lat")
-    lon = payload.get("lon")
-    acc = payload.get("accuracy")
-
-    if not lecture_id:
-        await message.answer(
-            "⚠ Не указан ID лекции.\nВ мини-аппе заполните поле ID лекции."
-        )
-        return
-    if lat is None or lon is None:
-        await message.answer("⚠ Не удалось получить координаты для геозоны.")
+    lecture_id = payload.get("lectureId")
+    name = payload.get("name")
+    await lecture_registry.ensure_loaded()
+    zone = zone_index.by_name(name)
+    lecture = lecture_registry.get(lecture_id) if lecture_id else None
+    if lecture is None or zone is None or zone.id not in lecture.zone_ids:
+        await message.answer("⚠ Такая зона к лекции не привязана.")
         return
 
-    db = await get_db()
-    try:
-        await db.execute(
-            """
-            INSERT INTO lectures (id, is_open, created_by, geo_lat, geo_lon, geo_radius, opened_at)
-            VALUES (?, 0, ?, ?, ?, ?, ?)
-            ON CONFLICT(id) DO UPDATE SET
-                geo_lat = excluded.geo_lat,
-                geo_lon = excluded.geo_lon,
-                geo_radius = excluded.geo_radius
-            """,
-            (
-                lecture_id,
-                message.from_user.id,
-                lat,
-                lon,
-                150.0,  # базовый радиус, можно вынести в настройку
-                now_iso(),
-            ),
-        )
-        await db.commit()
-    finally:
-        await db.close()
-
-    await message.answer(
-        f"📍 Геозона для лекции <code>{lecture_id}</code> установлена.\n"
-        f"lat={lat:.5f}, lon={lon:.5f}, точность ≈ {acc!r}."
+    await db_write(
+        "DELETE FROM lecture_zones WHERE lecture_id = ? AND zone_id = ?",
+        (lecture.id, zone.id),
     )
+    lecture.zone_ids = lecture.zone_ids - {zone.id}
+    approved, pending = await reevaluate_lecture_geo(lecture.id)
+    publish_invalidation("lectures", lecture.id)
+
+    text = f"🗑 Зона <b>{name}</b> отвязана от лекции <code>{lecture_id}</code>."
+    if approved or pending:
+        text += (
+            "\nУже сделанные отметки пересчитаны: "
+            f"засчитано <b>{approved}</b>, ожидают кружок <b>{pending}</b>."
+        )
+    await message.answer(text)
 
 
-async def handle_admin_set_role(message: Message, payload: dict):
+@payload_type(
+    "admin_set_role",
+    {"targetUserId": Field(int_field(1)), "newRole": Field(str_field(16))},
+    priority=2,
+)
+async def handle_admin_set_role(message: Message, payload: SetRolePayload):
     if message.from_user.id not in MASTER_ADMIN_IDS:
         role = await get_user_role(message.from_user.id)
         logger.warning(
@@ -773,9 +4240,9 @@ async def handle_admin_set_role(message: Message, payload: dict):
         return
 
     target_id = payload.get("targetUserId")
-    new_role = (payload.get("newRole") or "").strip().lower()
+    new_role = (payload.get("newRole") or "").lower()
 
-    if not target_id or not str(target_id).isdigit():
+    if target_id is None:
         await message.answer("⚠ Некорректный Telegram user_id.")
         return
 
@@ -783,14 +4250,14 @@ async def handle_admin_set_role(message: Message, payload: dict):
         await message.answer("⚠ Некорректная роль.")
         return
 
-    target_id = int(target_id)
     await set_user_role(target_id, new_role)
     await message.answer(
         f"✅ Роль пользователя <code>{target_id}</code> изменена на <b>{new_role}</b>."
     )
 
 
-async def handle_admin_request_stats(message: Message, payload: dict):
+@payload_type("admin_request_stats", {"lectureId": LECTURE_ID_FIELD}, priority=2)
+async def handle_admin_request_stats(message: Message, payload: LecturePayload):
     if message.from_user.id not in MASTER_ADMIN_IDS:
         role = await get_user_role(message.from_user.id)
         logger.warning(
@@ -802,28 +4269,27 @@ async def handle_admin_request_stats(message: Message, payload: dict):
         await message.answer("🚫 Только мастер-админ может запрашивать статистику.")
         return
 
-    lecture_id = payload.get("lectureId") or payload.get("lecture_id")
+    lecture_id = payload.get("lectureId")
     if not lecture_id:
         await message.answer("⚠ Не указан ID лекции.")
         return
 
-    db = await get_db()
-    try:
-        cur = await db.execute(
-            """
-            SELECT
-                COUNT(*) AS total,
-                SUM(CASE WHEN status='approved' THEN 1 ELSE 0 END) AS ok,
-                SUM(CASE WHEN status='pending_video' THEN 1 ELSE 0 END) AS pending_vid,
-                SUM(CASE WHEN status='rejected' THEN 1 ELSE 0 END) AS rejected
-            FROM attendances
-            WHERE lecture_id = ?
-            """,
-            (lecture_id,),
-        )
-        row = await cur.fetchone()
-    finally:
-        await db.close()
+    await lecture_registry.ensure_loaded()
+    lecture = lecture_registry.get(lecture_id)
+    row = None
+    if lecture is not None:
+        db = await get_report_db()
+        try:
+            row = await db.execute_fetchone(
+                """
+                SELECT total, approved AS ok, pending_video AS pending_vid, rejected
+                  FROM lecture_stats
+                 WHERE lecture_id = ?
+                """,
+                (lecture.id,),
+            )
+        finally:
+            await db.close()
 
     if not row or row["total"] == 0:
         await message.answer(
@@ -831,13 +4297,17 @@ async def handle_admin_request_stats(message: Message, payload: dict):
         )
         return
 
-    await message.answer(
+    text = (
         f"📊 Статистика по лекции <code>{lecture_id}</code>:\n"
         f"Всего записей: <b>{row['total']}</b>\n"
         f"Засчитано: <b>{row['ok'] or 0}</b>\n"
         f"Ожидают видео/проверки: <b>{row['pending_vid'] or 0}</b>\n"
         f"Отклонено: <b>{row['rejected'] or 0}</b>"
     )
+    if reporting.refreshed_at is not None:
+        taken_at = ms_to_datetime(reporting.refreshed_at)
+        text += f"\n<i>Срез данных на {taken_at:%H:%M:%S} UTC.</i>"
+    await message.answer(text)
 
 
 # -----------------------------
@@ -853,82 +4323,81 @@ async def handle_video_note(message: Message):
     "Верифицировать / Отклонить" и сохраняет привязку.
     """
     user_id = message.from_user.id
-    rating_chat = await get_setting("rating_chat_id")
-    if not rating_chat:
+    rating_chat_id = await get_setting_int("rating_chat_id")
+    if rating_chat_id is None:
         await message.reply(
             "⚠ Чат рейтинга не настроен. Попросите мастер-админа выполнить /set_rating_chat в нужном чате."
         )
         return
 
-    rating_chat_id = int(rating_chat)
-
     db = await get_db()
     try:
         # Находим последнюю pending_video отметку для этого пользователя
-        cur = await db.execute(
+        att = await db.execute_fetchone(
             """
-            SELECT id, lecture_id
-              FROM attendances
-             WHERE user_id = ?
-               AND status = 'pending_video'
-          ORDER BY created_at DESC
+            SELECT a.id, a.lecture_id, l.code
+              FROM attendances a
+              JOIN lectures l ON l.id = a.lecture_id
+             WHERE a.user_id = ?
+               AND a.status = 'pending_video'
+          ORDER BY a.created_at DESC
              LIMIT 1
             """,
             (user_id,),
         )
-        att = await cur.fetchone()
-        if not att:
-            await message.reply(
-                "ℹ Нет отметки, ожидающей видеоподтверждения.\n"
-                "Сначала попробуйте отметиться через мини-аппу."
-            )
-            return
+    finally:
+        await db.close()
 
-        attendance_id = att["id"]
-        lecture_id = att["lecture_id"]
-
-        # Пересылаем кружок в чат рейтинга с inline-кнопками
-        fwd = await bot.send_video_note(
-            chat_id=rating_chat_id,
-            video_note=message.video_note.file_id,
-            caption=(
-                f"Кружок от пользователя <code>{user_id}</code>\n"
-                f"Лекция: <code>{lecture_id}</code>\n"
-                f"ID отметки: <code>{attendance_id}</code>"
-            ),
-            reply_markup=InlineKeyboardMarkup(
-                inline_keyboard=[
-                    [
-                        InlineKeyboardButton(
-                            text="✅ Верифицировать",
-                            callback_data=f"verify_att:{attendance_id}:ok",
-                        ),
-                        InlineKeyboardButton(
-                            text="❌ Отклонить",
-                            callback_data=f"verify_att:{attendance_id}:reject",
-                        ),
-                    ]
-                ]
-            ),
+    if not att:
+        await message.reply(
+            "ℹ Нет отметки, ожидающей видеоподтверждения.\n"
+            "Сначала попробуйте отметиться через мини-аппу."
         )
+        return
 
-        # Сохраняем, где лежит видео
-        await db.execute(
-            """
-            UPDATE attendances
-               SET video_chat_id = ?, video_message_id = ?, status = 'pending'
-             WHERE id = ?
-            """,
-            (fwd.chat.id, fwd.message_id, attendance_id),
-        )
-        await db.commit()
+    attendance_id = att["id"]
+    lecture_id = att["lecture_id"]
+    lecture_code = att["code"]
+
+    # Пересылаем кружок в чат рейтинга с inline-кнопками. Отправка идёт
+    # через очередь; привязку к сообщению сохранит store_forwarded_video.
+    # Повторный кружок, пока первый не ушёл, заменяет его.
+    outbound.enqueue(
+        "send_video_note",
+        rating_chat_id,
+        key=f"video:{attendance_id}",
+        hook="video_forwarded",
+        context={
+            "attendance_id": attendance_id,
+            "lecture_id": lecture_id,
+            "user_id": user_id,
+        },
+        video_note=message.video_note.file_id,
+        caption=(
+            f"Кружок от пользователя <code>{user_id}</code>\n"
+            f"Лекция: <code>{lecture_code}</code>\n"
+            f"ID отметки: <code>{attendance_id}</code>"
+        ),
+        reply_markup=InlineKeyboardMarkup(
+            inline_keyboard=[
+                [
+                    InlineKeyboardButton(
+                        text="✅ Верифицировать",
+                        callback_data=f"verify_att:{attendance_id}:ok",
+                    ),
+                    InlineKeyboardButton(
+                        text="❌ Отклонить",
+                        callback_data=f"verify_att:{attendance_id}:reject",
+                    ),
+                ]
+            ]
+        ),
+    )
 
-        await message.reply(
-            "✅ Кружок отправлен в команду рейтинга.\n"
-            "После проверки вы получите решение."
-        )
-    finally:
-        await db.close()
+    await message.reply(
+        "📨 Кружок поставлен в очередь на отправку команде рейтинга.\n"
+        "После проверки вы получите решение."
+    )
 
 
 @router.callback_query(F.data.startswith("verify_att:"))
@@ -937,96 +4406,427 @@ async def callback_verify_attendance(call: CallbackQuery):
     Обработка решения команды рейтинга:
     - verify_att:<attendance_id>:ok
     - verify_att:<attendance_id>:reject
+
+    Повторно доставленный callback получает тот же ответ из idempotency,
+    без записи в БД и без второго уведомления студенту.
     """
+    key = f"cb:{call.id}"
+    first, outcome = await idempotency.claim(key)
+    if not first:
+        if outcome is None:
+            await call.answer()  # первая доставка ещё обрабатывается
+        else:
+            await call.answer(outcome["text"], show_alert=outcome["alert"])
+        return
+    try:
+        text, alert = await verify_attendance(call)
+    except BaseException:
+        idempotency.release(key)
+        raise
+    await idempotency.complete(key, {"text": text, "alert": alert})
+
+    await call.answer(text, show_alert=alert)
+    if not alert:
+        # решение применено — убираем кнопки у самого callback-сообщения
+        try:
+            await call.message.edit_reply_markup(reply_markup=None)
+        except Exception:
+            pass
+
+
+async def verify_attendance(call: CallbackQuery) -> tuple[str, bool]:
+    """Применяет решение; возвращает ответ на callback и show_alert."""
     data = call.data or ""
     try:
         _, att_id_str, decision = data.split(":")
         attendance_id = int(att_id_str)
     except Exception:
-        await call.answer("Ошибка формата callback.", show_alert=True)
-        return
+        return "Ошибка формата callback.", True
 
     decision = decision.lower()
     if decision not in ("ok", "reject"):
-        await call.answer("Неверное действие.", show_alert=True)
-        return
+        return "Неверное действие.", True
 
     # Проверим, что нажимающий действительно в "rating" или мастер-админ
     user_id = call.from_user.id
     user_role = await get_user_role(user_id)
     if user_role not in ("rating", "admin") and user_id not in MASTER_ADMIN_IDS:
-        await call.answer("У вас нет прав оценивать кружки.", show_alert=True)
-        return
+        return "У вас нет прав оценивать кружки.", True
 
     db = await get_db()
     try:
-        cur = await db.execute(
+        att = await db.execute_fetchone(
             """
-            SELECT user_id, lecture_id, video_chat_id, video_message_id
-              FROM attendances
-             WHERE id = ?
+            SELECT a.user_id, a.lecture_id, l.code, a.video_chat_id, a.video_message_id
+              FROM attendances a
+              JOIN lectures l ON l.id = a.lecture_id
+             WHERE a.id = ?
             """,
             (attendance_id,),
         )
-        att = await cur.fetchone()
-        if not att:
-            await call.answer("Отметка не найдена.", show_alert=True)
-            return
+    finally:
+        await db.close()
 
-        new_status = "approved" if decision == "ok" else "rejected"
+    if not att:
+        return "Отметка не найдена.", True
 
-        await db.execute(
-            """
-            UPDATE attendances
-               SET status = ?,
-                   reviewer_id = ?,
-                   reviewed_at = ?
-             WHERE id = ?
-            """,
-            (new_status, user_id, now_iso(), attendance_id),
+    new_status = "approved" if decision == "ok" else "rejected"
+
+    await db_write(
+        """
+        UPDATE attendances
+           SET status = ?,
+               reviewer_id = ?,
+               reviewed_at = ?
+         WHERE id = ?
+        """,
+        (new_status, user_id, now_ms(), attendance_id),
+    )
+    lecture_registry.set_attendee_status(att["lecture_id"], att["user_id"], new_status)
+
+    # Удаляем кружок из чата рейтинга, если можем
+    if att["video_chat_id"] and att["video_message_id"]:
+        outbound.enqueue(
+            "delete_message",
+            att["video_chat_id"],
+            key=f"delete:{att['video_chat_id']}:{att['video_message_id']}",
+            message_id=att["video_message_id"],
         )
-        await db.commit()
 
-        # Удаляем кружок из чата рейтинга, если можем
-        if att["video_chat_id"] and att["video_message_id"]:
-            try:
-                await bot.delete_message(
-                    chat_id=att["video_chat_id"],
-                    message_id=att["video_message_id"],
-                )
-            except Exception as e:
-                logger.warning("Не удалось удалить сообщение с кружком: %s", e)
-
-        # Сообщаем студенту
-        student_id = att["user_id"]
-        if decision == "ok":
-            text = (
-                "✅ Ваша отметка по лекции "
-                f"<code>{att['lecture_id']}</code> подтверждена командой рейтинга."
-            )
-        else:
-            text = (
-                "❌ Ваша отметка по лекции "
-                f"<code>{att['lecture_id']}</code> отклонена командой рейтинга."
-            )
+    # Сообщаем студенту
+    student_id = att["user_id"]
+    if decision == "ok":
+        text = (
+            "✅ Ваша отметка по лекции "
+            f"<code>{att['code']}</code> подтверждена командой рейтинга."
+        )
+    else:
+        text = (
+            "❌ Ваша отметка по лекции "
+            f"<code>{att['code']}</code> отклонена командой рейтинга."
+        )
 
-        try:
-            await bot.send_message(student_id, text)
-        except Exception as e:
-            logger.warning("Не удалось отправить сообщение студенту: %s", e)
+    # если решение успели поменять, студент получит только последнее
+    outbound.enqueue(
+        "send_message", student_id, key=f"verdict:{attendance_id}", text=text
+    )
+
+    return "Решение применено.", False
 
-        await call.answer(
-            "Решение применено.",
-            show_alert=False,
+
+async def store_forwarded_video(fwd, context: dict) -> None:
+    """
+    Кружок ушёл в чат рейтинга: запоминаем, где он лежит. Если пока кружок
+    ждал в очереди, статус уже поменяли (проверяющий или пересчёт геозоны),
+    отметку не трогаем.
+    """
+    result = await db_write(
+        """
+        UPDATE attendances
+           SET video_chat_id = ?, video_message_id = ?, status = 'pending'
+         WHERE id = ? AND status = 'pending_video'
+        """,
+        (fwd.chat.id, fwd.message_id, context["attendance_id"]),
+    )
+    if result.rowcount == 1:
+        lecture_registry.set_attendee_status(
+            context["lecture_id"], context["user_id"], "pending"
         )
-        # Можно также изменить подпись/кнопки у самого callback-сообщения:
+
+
+# Что вызвать после успешной отправки (OutboundMessage.hook)
+OUTBOX_HOOKS = {
+    "video_forwarded": store_forwarded_video,
+}
+
+
+# -----------------------------
+#  ВЕБХУК
+# -----------------------------
+
+WEBHOOK_SECRET_HEADER = "X-Telegram-Bot-Api-Secret-Token"
+
+
+class WebhookReceiver:
+    """
+    Приём апдейтов от Telegram по HTTP.
+
+    Проверяет секрет из заголовка X-Telegram-Bot-Api-Secret-Token и сразу
+    отвечает 200, а сам апдейт отдаёт feed() в фоновой задаче: Telegram не
+    шлёт следующий апдейт в соединение, пока не получил ответ на текущий.
+    Апдейты одного пользователя кормятся по очереди, в порядке приёма.
+    Логика приёма — в receive(), aiohttp-обвязка — в app().
+    """
+
+    def __init__(self, secret: str, feed):
+        self.secret = secret
+        self.feed = feed
+        self._tasks: set[asyncio.Task] = set()
+        self._tails: dict[int, asyncio.Task] = {}  # последний апдейт пользователя
+        self.accepted = 0
+        self.rejected = 0
+
+    def receive(self, secret: str | None, body: bytes) -> int:
+        """Принимает тело запроса, возвращает HTTP-статус ответа."""
+        if secret is None or not hmac.compare_digest(
+            secret.encode(), self.secret.encode()
+        ):
+            self.rejected += 1
+            return 401
         try:
-            await call.message.edit_reply_markup(reply_markup=None)
+            update = json.loads(body)
+        except ValueError:
+            self.rejected += 1
+            return 400
+        if not isinstance(update, dict):
+            self.rejected += 1
+            return 400
+        self.dispatch(update)
+        self.accepted += 1
+        return 200
+
+    def dispatch(self, update: dict) -> None:
+        """Отдаёт апдейт feed() в фоновой задаче — после предыдущего того же from.id."""
+        user_id = update_user_id(update)
+        previous = self._tails.get(user_id) if user_id is not None else None
+        task = asyncio.get_running_loop().create_task(self._feed(update, previous))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        if user_id is not None:
+            self._tails[user_id] = task
+            task.add_done_callback(lambda t: self._forget(user_id, t))
+
+    def _forget(self, user_id: int, task: asyncio.Task) -> None:
+        if self._tails.get(user_id) is task:
+            del self._tails[user_id]
+
+    async def _feed(self, update: dict, previous: asyncio.Task | None = None) -> None:
+        if previous is not None:
+            await asyncio.wait([previous])  # ошибки предыдущего он логирует сам
+        try:
+            await self.feed(update)
         except Exception:
-            pass
+            logger.exception(
+                "Ошибка обработки апдейта %s из вебхука", update.get("update_id")
+            )
+
+    async def handle(self, request) -> "web.Response":
+        status = self.receive(
+            request.headers.get(WEBHOOK_SECRET_HEADER), await request.read()
+        )
+        return web.Response(status=status)
+
+    async def close(self, app=None) -> None:
+        """Дожидается апдейтов, которые уже приняты и ещё обрабатываются."""
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+
+    def app(self, path: str = WEBHOOK_PATH) -> "web.Application":
+        app = web.Application()
+        app.router.add_post(path, self.handle)
+        app.on_shutdown.append(self.close)
+        return app
+
+
+async def feed_webhook_update(update: dict) -> None:
+    await dp.feed_raw_update(bot, update)
+
+
+async def run_webhook(feed=feed_webhook_update) -> None:
+    """
+    Поднимает HTTP-сервер вебхука и регистрирует его в Telegram.
+    Апдейты уходят в feed (по умолчанию — в dp этого процесса).
+    """
+    if web is None:
+        raise RuntimeError("Для WEBHOOK_URL нужен aiohttp (pip install aiohttp).")
+    secret = WEBHOOK_SECRET or secrets.token_urlsafe(32)
+    receiver = WebhookReceiver(secret, feed)
+    runner = web.AppRunner(receiver.app())
+    await runner.setup()
+    await web.TCPSite(runner, WEBHOOK_HOST, WEBHOOK_PORT).start()
+    try:
+        await bot.set_webhook(
+            WEBHOOK_URL.rstrip("/") + WEBHOOK_PATH,
+            secret_token=secret,
+            max_connections=WEBHOOK_MAX_CONNECTIONS,
+            allowed_updates=dp.resolve_used_update_types(),
+        )
+        logger.info(
+            "Webhook listening on %s:%s%s", WEBHOOK_HOST, WEBHOOK_PORT, WEBHOOK_PATH
+        )
+        await asyncio.Event().wait()
+    finally:
+        await runner.cleanup()
+
+
+# -----------------------------
+#  ВОРКЕРЫ
+# -----------------------------
+
+# Номер воркера и очередь для рассылки инвалидаций; None — один процесс
+_worker_index: int | None = None
+_invalidations = None
+
+
+def update_user_id(update: dict) -> int | None:
+    """from.id апдейта Telegram (message, callback_query, ...), если он есть."""
+    for value in update.values():
+        if isinstance(value, dict):
+            sender = value.get("from")
+            if isinstance(sender, dict) and isinstance(sender.get("id"), int):
+                return sender["id"]
+    return None
+
+
+def shard_for(user_id: int | None, workers: int) -> int:
+    # все апдейты одного пользователя идут в один воркер и по порядку
+    return 0 if user_id is None else user_id % workers
+
 
+def publish_invalidation(kind: str, key=None) -> None:
+    """
+    Сообщает остальным воркерам, что общие данные поменялись:
+    "lectures" — лекция key с её геозонами, "settings" — настройки,
+    "role" — роль пользователя key. В одном процессе ничего не делает.
+    """
+    if _invalidations is not None:
+        _invalidations.put((_worker_index, kind, key))
+
+
+async def apply_invalidation(kind: str, key=None) -> None:
+    if kind == "role":
+        role_cache.invalidate(key)
+    elif kind == "settings":
+        await settings_cache.reload()
+    elif kind == "lectures":
+        await lecture_registry.refresh(key)
+    else:
+        logger.warning("Неизвестная инвалидация: %s", kind)
+
+
+class ShardRouter:
+    """
+    Супервизор: раздаёт апдейты воркерам по from.id и пересылает
+    инвалидации от одного воркера всем остальным. Инвалидации идут в ту же
+    очередь, что и апдейты, поэтому воркер применяет их до апдейтов,
+    пришедших позже.
+    """
+
+    def __init__(self, queues: list, invalidations):
+        self.queues = queues
+        self.invalidations = invalidations
+        self.routed = [0] * len(queues)
+        self._relay: threading.Thread | None = None
+
+    async def feed(self, update: dict) -> None:
+        shard = shard_for(update_user_id(update), len(self.queues))
+        self.queues[shard].put(("update", update))
+        self.routed[shard] += 1
+
+    def start(self) -> None:
+        self._relay = threading.Thread(
+            target=self._run_relay, name="invalidation-relay", daemon=True
+        )
+        self._relay.start()
+
+    def _run_relay(self) -> None:
+        while True:
+            item = self.invalidations.get()
+            if item is None:
+                return
+            source, kind, key = item
+            for index, queue in enumerate(self.queues):
+                if index != source:
+                    queue.put(("invalidate", kind, key))
+
+    def stop(self) -> None:
+        # сначала доставляем накопившиеся инвалидации, потом останавливаем воркеры
+        self.invalidations.put(None)
+        if self._relay is not None:
+            self._relay.join()
+        for queue in self.queues:
+            queue.put(None)
+
+
+async def run_supervisor() -> None:
+    """
+    WORKERS процессов-воркеров за одним вебхуком. Супервизор держит
+    единственного писателя БД (воркеры пишут через aiosqlite.RemoteWriter)
+    и раздаёт апдейты по шардам; обработчики работают только в воркерах.
+    """
+    if not WEBHOOK_URL:
+        raise RuntimeError("WORKERS > 1 работает только с вебхуком (WEBHOOK_URL).")
+    context = multiprocessing.get_context("spawn")
+    server = aiosqlite.WriterServer(await get_writer())
+    invalidations = context.Queue()
+    processes, queues = [], []
+    for index in range(WORKERS):
+        updates = context.Queue()
+        parent_conn, child_conn = context.Pipe()
+        process = context.Process(
+            target=worker_main,
+            args=(index, WORKERS, updates, invalidations, child_conn),
+            name=f"attendance-worker-{index}",
+            daemon=True,
+        )
+        process.start()
+        child_conn.close()
+        server.serve(parent_conn)
+        processes.append(process)
+        queues.append(updates)
+    shard_router = ShardRouter(queues, invalidations)
+    shard_router.start()
+    logger.info("Started %s workers", WORKERS)
+    try:
+        await run_webhook(feed=shard_router.feed)
     finally:
-        await db.close()
+        shard_router.stop()
+        for process in processes:
+            await asyncio.to_thread(process.join)
+        await close_db()
+
+
+def worker_main(index: int, workers: int, updates, invalidations, write_conn) -> None:
+    """Точка входа процесса-воркера."""
+    global _worker_index, _invalidations
+    # остановкой управляет супервизор: он пришлёт None в очередь апдейтов
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    _worker_index = index
+    _invalidations = invalidations
+    asyncio.run(run_worker(index, workers, updates, write_conn))
+
+
+async def run_worker(index: int, workers: int, updates, write_conn) -> None:
+    global _db_writer, _writer_remote, outbound
+    _db_writer = aiosqlite.RemoteWriter(write_conn, DB_PATH)
+    _writer_remote = True
+    # лимиты Telegram общие на бота: каждый воркер берёт свою долю.
+    # Личные чаты шардированы вместе с пользователями, делить их не нужно.
+    outbound = OutboundSender(
+        SEND_GLOBAL_RATE / workers,
+        SEND_CHAT_RATE,
+        SEND_GROUP_PER_MINUTE / 60 / workers,
+        SEND_CONCURRENCY,
+        SEND_MAX_ATTEMPTS,
+        SEND_RETRY_DELAY,
+    )
+    await warm_up()
+    dp.include_router(router)
+    background = await start_services()
+    receiver = WebhookReceiver("", feed_webhook_update)
+    loop = asyncio.get_running_loop()
+    logger.info("Worker %s started", index)
+    try:
+        while True:
+            item = await loop.run_in_executor(None, updates.get)
+            if item is None:
+                break
+            if item[0] == "update":
+                receiver.dispatch(item[1])
+            else:
+                await apply_invalidation(item[1], item[2])
+    finally:
+        await receiver.close()
+        await stop_services(background)
 
 
 # -----------------------------
@@ -1034,11 +4834,107 @@ async def callback_verify_attendance(call: CallbackQuery):
 # -----------------------------
 
 
+async def warm_up() -> None:
+    """Наполняет кэши процесса из БД (схема уже актуальна)."""
+    await (await get_pool()).open()
+    warmed = await role_cache.warm()
+    logger.info("Role cache warmed: %s users", warmed)
+    await settings_cache.load()
+    lectures = await lecture_registry.load()
+    logger.info("Lecture registry loaded: %s lectures", lectures)
+    await load_payload_dictionary()
+    if reporting.mode == "snapshot":
+        await reporting.refresh()
+
+
+async def start_services() -> list[asyncio.Task]:
+    """Запускает очереди и фоновые задачи; остановка — stop_services()."""
+    background = [
+        asyncio.create_task(
+            run_periodically(
+                PROFILE_TOUCH_INTERVAL, flush_profile_touches, "updated_at профилей"
+            )
+        ),
+        asyncio.create_task(
+            run_periodically(GEO_FLUSH_INTERVAL, flush_geo_samples, "запись geo_samples")
+        ),
+        asyncio.create_task(
+            run_periodically(
+                PAYLOAD_FLUSH_INTERVAL, flush_checkin_payloads, "запись payload'ов"
+            )
+        ),
+        asyncio.create_task(
+            run_periodically(SEND_RETRY_INTERVAL, retry_outbox, "повтор отправки")
+        ),
+    ]
+    if idempotency.persistent:
+        background.append(
+            asyncio.create_task(
+                run_periodically(
+                    idempotency.ttl, purge_processed_updates, "чистка processed_updates"
+                )
+            )
+        )
+    if reporting.mode == "snapshot":
+        background.append(
+            asyncio.create_task(
+                run_periodically(
+                    REPORTING_REFRESH_INTERVAL, reporting.refresh, "срез для отчётов"
+                )
+            )
+        )
+    ingestion_queue.start()
+    outbound.start()
+    restored = await retry_outbox()
+    if restored:
+        logger.info("Outbox: %s messages queued for retry", restored)
+    return background
+
+
+async def stop_services(background: list[asyncio.Task]) -> None:
+    """
+    Останавливает очереди и фоновые задачи, дописывает буферы в БД и
+    закрывает её. Упавший flush не мешает остальным; то, что не удалось
+    записать, остаётся в буфере.
+    """
+    await ingestion_queue.stop()
+    await outbound.stop()
+    for task in background:
+        task.cancel()
+    # периодический flush мог быть на середине — не гоняемся с ним
+    await asyncio.gather(*background, return_exceptions=True)
+    try:
+        for flush, what in (
+            (flush_profile_touches, "updated_at профилей"),
+            (flush_geo_samples, "запись geo_samples"),
+            (flush_checkin_payloads, "запись payload'ов"),
+        ):
+            try:
+                await flush()
+            except Exception:
+                logger.exception("Финальная задача «%s» упала", what)
+    finally:
+        await close_db(keep_pending=True)
+
+
 async def main():
     await init_db()
     dp.include_router(router)
-    logger.info("Starting bot polling...")
-    await dp.start_polling(bot)
+    if WORKERS > 1:
+        await run_supervisor()
+        return
+    await warm_up()
+    background = await start_services()
+    try:
+        if WEBHOOK_URL:
+            await run_webhook()
+        else:
+            # вебхук, оставшийся с прошлого запуска, не даст забирать апдейты
+            await bot.delete_webhook()
+            logger.info("Starting bot polling...")
+            await dp.start_polling(bot)
+    finally:
+        await stop_services(background)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,122 @@
+import itertools
+import json
+from types import SimpleNamespace
+
+import pytest
+
+from test_roles import DummyMessage, bot_module, memory_db  # noqa: F401
+
+CALLBACK_IDS = itertools.count(1)
+MESSAGE_IDS = itertools.count(1)
+
+
+@pytest.fixture
+def open_lecture(memory_db):
+    async def open_(speaker_id: int, lecture_id: str):
+        await bot_module.handle_speaker_open_lecture(
+            DummyMessage(speaker_id), {"lectureId": lecture_id}
+        )
+
+    return open_
+
+
+@pytest.fixture
+def attendance_status(memory_db):
+    async def status(user_id: int, lecture_id: str):
+        db = await bot_module.get_db()
+        try:
+            row = await db.execute_fetchone(
+                """
+                SELECT a.status
+                  FROM attendances a
+                  JOIN lectures l ON l.id = a.lecture_id
+                 WHERE a.user_id = ? AND l.code = ?
+                """,
+                (user_id, lecture_id),
+            )
+        finally:
+            await db.close()
+        return row["status"] if row else None
+
+    return status
+
+
+class FakeBot:
+    """Запоминает отправленное; ``errors`` задаёт падения по методам."""
+
+    def __init__(self):
+        self.sent = []
+        self.videos = []
+        self.errors = {"send_message": [], "send_video_note": []}
+
+    def _fail(self, method):
+        if self.errors[method]:
+            raise self.errors[method].pop(0)
+
+    async def send_video_note(self, chat_id, **kwargs):
+        self._fail("send_video_note")
+        self.videos.append(kwargs.get("video_note"))
+        return SimpleNamespace(chat=SimpleNamespace(id=chat_id), message_id=77)
+
+    async def delete_message(self, **kwargs):
+        pass
+
+    async def send_message(self, chat_id, text, **kwargs):
+        self._fail("send_message")
+        self.sent.append((chat_id, text))
+
+
+class DummyCallback:
+    def __init__(self, user_id, data):
+        self.id = str(next(CALLBACK_IDS))
+        self.from_user = SimpleNamespace(id=user_id)
+        self.data = data
+        self.message = SimpleNamespace(edit_reply_markup=self._edit)
+        self.answers = []
+
+    async def _edit(self, **kwargs):
+        pass
+
+    async def answer(self, text=None, **kwargs):
+        self.answers.append(text)
+
+
+@pytest.fixture
+def fake_bot(monkeypatch):
+    fake = FakeBot()
+    monkeypatch.setattr(bot_module, "bot", fake)
+    return fake
+
+
+@pytest.fixture
+def make_callback():
+    return DummyCallback
+
+
+@pytest.fixture
+def make_sender(monkeypatch, fake_bot):
+    def make(chat_rate=1000.0, retry_delay=30.0):
+        sender = bot_module.OutboundSender(
+            1000, chat_rate, chat_rate, 8, 3, retry_delay
+        )
+        monkeypatch.setattr(bot_module, "outbound", sender)
+        return sender
+
+    return make
+
+
+@pytest.fixture
+def webapp_message():
+    def make(user_id, data):
+        message = DummyMessage(user_id)
+        message.from_user = SimpleNamespace(
+            id=user_id, first_name="Ivan", last_name=None, username=None
+        )
+        message.chat = SimpleNamespace(id=user_id)
+        message.message_id = next(MESSAGE_IDS)
+        message.web_app_data = SimpleNamespace(
+            data=data if isinstance(data, str) else json.dumps(data)
+        )
+        return message
+
+    return make
@@ -0,0 +1,167 @@
+import asyncio
+import sys
+import uuid
+from pathlib import Path
+
+import pytest
+
+ROOT_DIR = Path(__file__).resolve().parents[1]
+if str(ROOT_DIR) not in sys.path:
+    sys.path.append(str(ROOT_DIR))
+
+import aiosqlite
+
+
+def make_db_path():
+    return f"file:{uuid.uuid4().hex}?mode=memory&cache=shared"
+
+
+def test_pool_reuses_warm_connections():
+    async def run():
+        pool = aiosqlite.Pool(make_db_path(), size=2, uri=True)
+        await pool.open()
+        assert pool.idle == 2
+
+        db = await pool.acquire()
+        assert pool.idle == 1
+        await db.close()
+        await db.close()  # повторный close не возвращает соединение дважды
+
+        async with pool.acquire():
+            assert pool.idle == 1
+
+        assert pool.idle == 2
+        await pool.close()
+        assert pool.idle == 0
+
+    asyncio.run(run())
+
+
+def test_pool_waits_for_release_when_exhausted():
+    async def run():
+        pool = aiosqlite.Pool(make_db_path(), size=1, uri=True)
+        db = await pool.acquire()
+
+        waiter = asyncio.ensure_future(pool.acquire())
+        await asyncio.sleep(0.01)
+        assert not waiter.done()
+
+        await db.close()
+        db2 = await asyncio.wait_for(waiter, 1)
+        assert db2._conn is db._conn
+        await db2.close()
+        await pool.close()
+
+    asyncio.run(run())
+
+
+def test_pool_rolls_back_uncommitted_work_on_release():
+    async def run():
+        path = make_db_path()
+        keeper = await aiosqlite.connect(path, uri=True)
+        await keeper.execute("CREATE TABLE t (x INTEGER)")
+        await keeper.commit()
+
+        pool = aiosqlite.Pool(path, size=1, uri=True)
+        async with pool.acquire() as db:
+            await db.execute("INSERT INTO t VALUES (1)")
+
+        async with pool.acquire() as db:
+            cur = await db.execute("SELECT COUNT(*) FROM t")
+            (count,) = await cur.fetchone()
+        assert count == 0
+
+        await pool.close()
+        await keeper.close()
+
+    asyncio.run(run())
+
+
+def test_closed_pool_rejects_acquire():
+    async def run():
+        pool = aiosqlite.Pool(make_db_path(), size=1, uri=True)
+        await pool.close()
+        with pytest.raises(aiosqlite.PoolClosedError):
+            await pool.acquire()
+
+    asyncio.run(run())
+
+
+def test_writer_group_commits_concurrent_requests():
+    async def run():
+        path = make_db_path()
+        keeper = await aiosqlite.connect(path, uri=True)
+        await keeper.execute("CREATE TABLE t (x INTEGER PRIMARY KEY)")
+        await keeper.commit()
+
+        writer = aiosqlite.Writer(path, max_batch=100, max_delay=0.05, uri=True)
+        results = await asyncio.gather(
+            *(writer.execute("INSERT INTO t VALUES (?)", (i,)) for i in range(50))
+        )
+        assert all(r.rowcount == 1 for r in results)
+        assert writer.requests_committed == 50
+        assert writer.groups_committed < 50
+
+        cur = await keeper.execute("SELECT COUNT(*) FROM t")
+        (count,) = await cur.fetchone()
+        assert count == 50
+
+        await writer.close()
+        await keeper.close()
+
+    asyncio.run(run())
+
+
+def test_writer_isolates_failed_request_within_group():
+    async def run():
+        path = make_db_path()
+        keeper = await aiosqlite.connect(path, uri=True)
+        await keeper.execute("CREATE TABLE t (x INTEGER PRIMARY KEY)")
+        await keeper.execute("INSERT INTO t VALUES (1)")
+        await keeper.commit()
+
+        writer = aiosqlite.Writer(path, max_delay=0.05, uri=True)
+        ok, dup, tx = await asyncio.gather(
+            writer.execute("INSERT INTO t VALUES (2) RETURNING x"),
+            writer.execute("INSERT INTO t VALUES (1)"),
+            writer.transaction(
+                [("INSERT INTO t VALUES (3)", ()), ("INSERT INTO t VALUES (2)", ())]
+            ),
+            return_exceptions=True,
+        )
+        assert ok.rows == [(2,)]
+        assert isinstance(dup, aiosqlite.IntegrityError)
+        assert isinstance(tx, aiosqlite.IntegrityError)
+
+        cur = await keeper.execute("SELECT x FROM t ORDER BY x")
+        assert [row[0] for row in await cur.fetchall()] == [1, 2]
+
+        await writer.close()
+        with pytest.raises(aiosqlite.WriterClosedError):
+            await writer.execute("INSERT INTO t VALUES (4)")
+        await keeper.close()
+
+    asyncio.run(run())
+
+
+def test_connections_stay_on_their_executor_thread():
+    async def run():
+        executor = aiosqlite.Executor(2, thread_name_prefix="test-db")
+        # check_same_thread=True упадёт, если соединение сменит поток
+        db = await aiosqlite.connect(
+            make_db_path(), uri=True, executor=executor, check_same_thread=True
+        )
+        await db.execute("CREATE TABLE t (x INTEGER)")
+        for i in range(5):
+            await db.execute("INSERT INTO t VALUES (?)", (i,))
+        await db.commit()
+
+        row = await db.execute_fetchone("SELECT COUNT(*) FROM t")
+        rows = await db.execute_fetchall("SELECT x FROM t WHERE x > ?", (2,))
+        assert row[0] == 5
+        assert [r[0] for r in rows] == [3, 4]
+
+        await db.close()
+        executor.shutdown()
+
+    asyncio.run(run())
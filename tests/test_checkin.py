@@ -0,0 +1,661 @@
+import asyncio
+import json
+import zlib
+
+import pytest
+
+from test_roles import DummyMessage, bot_module, insert_user
+
+
+def test_checkin_uses_lecture_registry(memory_db, open_lecture, attendance_status):
+    async def run():
+        await insert_user(1, "speaker")
+        await insert_user(2, "student")
+        await open_lecture(1, "phys201")
+
+        # реестр перестраивается из БД так же, как при старте
+        bot_module.lecture_registry.clear()
+        assert await bot_module.lecture_registry.load() == 1
+        assert bot_module.lecture_registry.get("phys201").is_open
+
+        message = DummyMessage(2)
+        await bot_module.handle_checkin(message, {"lectureId": "phys201"})
+        assert message.answers[0].startswith("✅ Отметка предварительно засчитана.")
+        assert await attendance_status(2, "phys201") == "approved"
+
+    asyncio.run(run())
+
+
+def test_checkin_rejected_for_closed_and_unknown_lectures(
+    memory_db, open_lecture, attendance_status
+):
+    async def run():
+        await insert_user(1, "speaker")
+        await insert_user(2, "student")
+        await open_lecture(1, "phys202")
+        await bot_module.handle_speaker_close_lecture(
+            DummyMessage(1), {"lectureId": "phys202"}
+        )
+
+        message = DummyMessage(2)
+        await bot_module.handle_checkin(message, {"lectureId": "phys202"})
+        await bot_module.handle_checkin(message, {"lectureId": "nope"})
+        assert "закрыта для отметок" in message.answers[0]
+        assert "не зарегистрирована" in message.answers[1]
+        assert await attendance_status(2, "phys202") is None
+
+    asyncio.run(run())
+
+
+def test_checkin_outside_geofence_requires_video(
+    memory_db, open_lecture, attendance_status
+):
+    async def run():
+        await insert_user(1, "speaker")
+        await insert_user(2, "student")
+        await open_lecture(1, "phys203")
+        await bot_module.handle_speaker_set_geo(
+            DummyMessage(1), {"lectureId": "phys203", "lat": 55.75, "lon": 37.61}
+        )
+
+        message = DummyMessage(2)
+        await bot_module.handle_checkin(
+            message,
+            {
+                "lectureId": "phys203",
+                "lastGeo": {"latitude": 55.80, "longitude": 37.61, "accuracy": 10},
+            },
+        )
+        assert "кружок" in message.answers[0]
+        assert await attendance_status(2, "phys203") == "pending_video"
+
+    asyncio.run(run())
+
+
+def test_duplicate_checkin_rejected_from_memory(memory_db, open_lecture):
+    async def run():
+        await insert_user(1, "speaker")
+        await insert_user(2, "student")
+        await open_lecture(1, "phys204")
+
+        message = DummyMessage(2)
+        await bot_module.handle_checkin(message, {"lectureId": "phys204"})
+        lecture = bot_module.lecture_registry.get("phys204")
+        assert lecture.attendees == {2: "approved"}
+
+        writes = (await bot_module.get_writer()).requests_committed
+        await bot_module.handle_checkin(message, {"lectureId": "phys204"})
+        assert "уже существует" in message.answers[1]
+        # профиль не менялся, поэтому дубль не дошёл до БД вообще
+        assert (await bot_module.get_writer()).requests_committed == writes
+
+        await bot_module.handle_speaker_close_lecture(
+            DummyMessage(1), {"lectureId": "phys204"}
+        )
+        assert lecture.attendees is None
+
+        # повторное открытие подтягивает отметки из БД
+        await open_lecture(1, "phys204")
+        assert lecture.attendees == {2: "approved"}
+
+    asyncio.run(run())
+
+
+def test_record_checkin_resolves_outcome_in_one_transaction(memory_db, open_lecture):
+    async def run():
+        await insert_user(1, "speaker")
+        await insert_user(2, "student")
+        await open_lecture(1, "phys205")
+
+        async def record(lecture_id):
+            return await bot_module.record_checkin(
+                2, lecture_id, "approved", None, None, None, None, "{}",
+                "Петров Иван", None,
+            )
+
+        Outcome = bot_module.CheckinOutcome
+        lecture = bot_module.lecture_registry.get("phys205")
+        assert await record(lecture.id) is Outcome.APPROVED
+        # набор в памяти «отстал» — дубль всё равно ловит сама вставка
+        lecture.attendees.clear()
+        assert await record(lecture.id) is Outcome.DUPLICATE
+        assert lecture.attendees == {2: "approved"}
+        assert await record(lecture.id + 1000) is Outcome.UNKNOWN_LECTURE
+
+        await bot_module.handle_speaker_close_lecture(
+            DummyMessage(1), {"lectureId": "phys205"}
+        )
+        await insert_user(3, "student")
+        assert await bot_module.record_checkin(
+            3, lecture.id, "approved", None, None, None, None, "{}", None, None
+        ) is Outcome.CLOSED
+
+        db = await bot_module.get_db()
+        try:
+            row = await db.execute_fetchone(
+                "SELECT fio FROM users WHERE telegram_id = 2"
+            )
+        finally:
+            await db.close()
+        assert row["fio"] == "Петров Иван"
+
+    asyncio.run(run())
+
+
+def test_ingestion_queue_prioritises_and_sheds_load():
+    async def run():
+        queue = bot_module.IngestionQueue(concurrency=1, max_depth=4, low_priority=3)
+        order = []
+        gate = asyncio.Event()
+
+        async def handler(name):
+            await gate.wait()
+            order.append(name)
+
+        assert queue.submit(1, handler, "first")
+        await asyncio.sleep(0)  # воркер забрал первую задачу и ждёт
+        assert queue.submit(3, handler, "geo-1")
+        assert queue.submit(3, handler, "geo-2")
+        assert not queue.submit(3, handler, "geo-3")  # низкий приоритет — до половины
+        assert queue.submit(1, handler, "checkin")
+        assert queue.submit(0, handler, "open")
+        assert not queue.submit(1, handler, "checkin-2")  # очередь полна
+
+        gate.set()
+        await queue.stop()
+        assert order == ["first", "open", "checkin", "geo-1", "geo-2"]
+        assert queue.stats()["rejected"] == 2
+        assert queue.stats()["processed"] == 5
+
+    asyncio.run(run())
+
+
+def test_geo_track_ring_buffer_keeps_latest_points():
+    track = bot_module.GeoTrack(3)
+    for i in range(5):
+        track.append(55.0 + i, 37.0, 10.0, 1000 * i)
+    assert len(track) == 3
+    assert [p[3] for p in track.samples()] == [2000, 3000, 4000]
+    assert track.last() == (59.0, 37.0, 10.0, 4000)
+
+
+def test_geo_stream_is_downsampled_flushed_and_used_for_checkin(
+    memory_db, open_lecture, attendance_status
+):
+    async def run():
+        await insert_user(1, "speaker")
+        await insert_user(2, "student")
+        await open_lecture(1, "phys206")
+        await bot_module.handle_speaker_set_geo(
+            DummyMessage(1), {"lectureId": "phys206", "lat": 55.75, "lon": 37.61}
+        )
+
+        message = DummyMessage(2)
+        for ts in (1_000, 2_000, 7_000):
+            await bot_module.handle_geo_stream(
+                message,
+                {"lat": 55.7501, "lon": 37.6101, "accuracy": 15, "timestamp": ts},
+            )
+        # вторая точка пришла через секунду на то же место — прорежена
+        assert len(bot_module.geo_store.track(2)) == 2
+        assert await bot_module.flush_geo_samples() == 2
+
+        db = await bot_module.get_db()
+        try:
+            rows = await db.execute_fetchall(
+                "SELECT ts FROM geo_samples WHERE user_id = 2 ORDER BY ts"
+            )
+        finally:
+            await db.close()
+        assert [row["ts"] for row in rows] == [1_000, 7_000]
+
+        # без lastGeo отметка использует последнюю точку из geo_stream
+        await bot_module.handle_checkin(message, {"lectureId": "phys206"})
+        assert message.answers[-1].startswith("✅ Отметка предварительно засчитана.")
+        assert await attendance_status(2, "phys206") == "approved"
+
+    asyncio.run(run())
+
+
+def test_haversine_vec_matches_scalar():
+    np = pytest.importorskip("numpy")
+    lats = np.array([55.75, 55.76, 59.93])
+    lons = np.array([37.61, 37.62, 30.31])
+    distances = bot_module.haversine_m_vec(lats, lons, 55.751, 37.618)
+    for lat, lon, d in zip(lats, lons, distances):
+        assert d == pytest.approx(bot_module.haversine_m(lat, lon, 55.751, 37.618))
+
+
+def test_geo_samples_survive_failed_flush(memory_db, monkeypatch):
+    async def run():
+        store = bot_module.GeoStreamStore(
+            capacity=4, min_interval=0, min_distance=0, max_users=10, max_pending=2
+        )
+        monkeypatch.setattr(bot_module, "geo_store", store)
+        for ts in (1_000, 2_000, 3_000):
+            store.add(2, 55.75, 37.61, None, ts)
+        assert store.dropped == 1
+
+        async def broken_writer():
+            raise RuntimeError("disk full")
+
+        with monkeypatch.context() as m:
+            m.setattr(bot_module, "get_writer", broken_writer)
+            with pytest.raises(RuntimeError):
+                await bot_module.flush_geo_samples()
+        assert await bot_module.flush_geo_samples() == 2
+
+        db = await bot_module.get_db()
+        try:
+            rows = await db.execute_fetchall("SELECT ts FROM geo_samples ORDER BY ts")
+        finally:
+            await db.close()
+        assert [row["ts"] for row in rows] == [2_000, 3_000]
+
+    asyncio.run(run())
+
+
+def test_stop_services_keeps_unflushed_geo_samples(memory_db, monkeypatch, caplog):
+    async def run():
+        store = bot_module.GeoStreamStore(
+            capacity=4, min_interval=0, min_distance=0, max_users=10, max_pending=8
+        )
+        monkeypatch.setattr(bot_module, "geo_store", store)
+        store.add(2, 55.75, 37.61, None, 1_000)
+        idle = asyncio.create_task(asyncio.sleep(3600))
+
+        async def broken_writer():
+            raise RuntimeError("disk full")
+
+        with monkeypatch.context() as m:
+            m.setattr(bot_module, "get_writer", broken_writer)
+            await bot_module.stop_services([idle])
+        assert idle.cancelled()
+        assert bot_module._db_pool is None
+
+        # буфер пережил остановку и дописывается после переоткрытия БД
+        assert await bot_module.flush_geo_samples() == 1
+        db = await bot_module.get_db()
+        try:
+            rows = await db.execute_fetchall("SELECT ts FROM geo_samples")
+        finally:
+            await db.close()
+        assert [row["ts"] for row in rows] == [1_000]
+
+    asyncio.run(run())
+    assert "запись geo_samples" in caplog.text
+
+
+@pytest.mark.parametrize("use_numpy", [True, False])
+def test_set_geo_reevaluates_existing_checkins(
+    memory_db, monkeypatch, use_numpy, open_lecture, attendance_status
+):
+    if use_numpy:
+        pytest.importorskip("numpy")
+    else:
+        monkeypatch.setattr(bot_module, "np", None)
+
+    async def run():
+        await insert_user(1, "speaker")
+        await open_lecture(1, "phys207")
+        # зона сначала стоит не там — ближние студенты уходят в pending_video
+        await bot_module.handle_speaker_set_geo(
+            DummyMessage(1), {"lectureId": "phys207", "lat": 59.93, "lon": 30.31}
+        )
+        positions = {
+            2: (55.7501, 37.6101),  # рядом с аудиторией
+            3: (55.7502, 37.6102),  # рядом с аудиторией
+            4: (55.80, 37.61),  # далеко
+            5: (None, None),  # без геопозиции
+        }
+        for user_id, (lat, lon) in positions.items():
+            await insert_user(user_id, "student")
+            geo = {} if lat is None else {"latitude": lat, "longitude": lon}
+            await bot_module.handle_checkin(
+                DummyMessage(user_id), {"lectureId": "phys207", "lastGeo": geo}
+            )
+            assert await attendance_status(user_id, "phys207") == "pending_video"
+
+        speaker = DummyMessage(1)
+        await bot_module.handle_speaker_set_geo(
+            speaker, {"lectureId": "phys207", "lat": 55.75, "lon": 37.61}
+        )
+        assert "засчитано <b>2</b>, ожидают кружок <b>0</b>" in speaker.answers[0]
+        assert await attendance_status(2, "phys207") == "approved"
+        assert await attendance_status(3, "phys207") == "approved"
+        assert await attendance_status(4, "phys207") == "pending_video"
+        assert await attendance_status(5, "phys207") == "pending_video"
+        assert bot_module.lecture_registry.get("phys207").attendees[2] == "approved"
+
+    asyncio.run(run())
+
+
+def test_zone_index_finds_zone_by_grid_cell():
+    index = bot_module.ZoneIndex(0.005)
+    hall = bot_module.GeoZone(1, "hall", "circle", 55.75, 37.61, 100.0)
+    yard = bot_module.GeoZone(
+        2, "yard", "polygon",
+        polygon=[(55.760, 37.600), (55.760, 37.640), (55.770, 37.640), (55.770, 37.600)],
+    )
+    index.add(hall)
+    index.add(yard)
+
+    assert index.find(55.7501, 37.6101) is hall
+    assert index.find(55.765, 37.62) is yard
+    assert index.find(55.765, 37.62, frozenset({1})) is None
+    assert index.find(59.93, 30.31) is None
+
+    index.remove(2)
+    assert index.find(55.765, 37.62) is None
+    assert index.by_name("yard") is None
+
+
+def test_checkin_accepted_in_any_linked_zone(
+    memory_db, open_lecture, attendance_status
+):
+    async def run():
+        await insert_user(1, "speaker")
+        await open_lecture(1, "phys208")
+        speaker = DummyMessage(1)
+        await bot_module.handle_speaker_set_zone(
+            speaker,
+            {"lectureId": "phys208", "name": "hall", "lat": 55.75, "lon": 37.61,
+             "radius": 100},
+        )
+        await bot_module.handle_speaker_set_zone(
+            speaker,
+            {
+                "lectureId": "phys208",
+                "name": "yard",
+                "polygon": [[55.76, 37.60], [55.76, 37.64], [55.77, 37.64], [55.77, 37.60]],
+            },
+        )
+        assert "Зона <b>yard</b> привязана" in speaker.answers[1]
+
+        positions = {2: (55.7501, 37.6101), 3: (55.765, 37.62), 4: (55.80, 37.61)}
+        for user_id, (lat, lon) in positions.items():
+            await insert_user(user_id, "student")
+            await bot_module.handle_checkin(
+                DummyMessage(user_id),
+                {"lectureId": "phys208", "lastGeo": {"latitude": lat, "longitude": lon}},
+            )
+        assert await attendance_status(2, "phys208") == "approved"
+        assert await attendance_status(3, "phys208") == "approved"
+        assert await attendance_status(4, "phys208") == "pending_video"
+
+        # после перезапуска зоны и привязки поднимаются из БД
+        bot_module.lecture_registry.clear()
+        await bot_module.lecture_registry.load()
+        assert len(bot_module.zone_index) == 2
+        assert len(bot_module.lecture_registry.get("phys208").zone_ids) == 2
+
+        await bot_module.handle_speaker_remove_zone(
+            speaker, {"lectureId": "phys208", "name": "yard"}
+        )
+        assert "засчитано <b>0</b>, ожидают кружок <b>1</b>" in speaker.answers[-1]
+        assert await attendance_status(3, "phys208") == "pending_video"
+
+    asyncio.run(run())
+
+
+def test_zone_of_another_speaker_is_not_redefined(memory_db, open_lecture):
+    async def run():
+        await insert_user(1, "speaker")
+        await insert_user(5, "speaker")
+        await open_lecture(1, "phys210")
+        await open_lecture(5, "chem210")
+        first, second = DummyMessage(1), DummyMessage(5)
+        hall = {"name": "hall", "lat": 55.75, "lon": 37.61, "radius": 100}
+        await bot_module.handle_speaker_set_zone(
+            first, {"lectureId": "phys210", **hall}
+        )
+        await bot_module.handle_speaker_set_zone(
+            second, {"lectureId": "chem210", **hall, "lat": 59.93}
+        )
+        assert "другого спикера" in second.answers[-1]
+        zone = bot_module.zone_index.by_name("hall")
+        assert zone.lat == 55.75
+        assert bot_module.lecture_registry.get("chem210").zone_ids == frozenset()
+
+        # свою зону спикер переопределяет как раньше
+        await bot_module.handle_speaker_set_zone(
+            first, {"lectureId": "phys210", **hall, "radius": 200}
+        )
+        assert bot_module.zone_index.by_name("hall").radius == 200
+
+    asyncio.run(run())
+
+
+@pytest.mark.parametrize(
+    "polygon",
+    [
+        [[55.76, 37.60], [55.76, 37.64]],
+        [[55.76, 37.60], [95.0, 37.64], [55.77, 37.64]],
+        [[55.76, 37.60], [55.76, 181.0], [55.77, 37.64]],
+        [[55.76, 37.60], [55.76, "x"], [55.77, 37.64]],
+    ],
+)
+def test_bad_polygon_is_rejected(polygon):
+    assert bot_module.parse_polygon(polygon) is None
+
+
+async def lecture_stats(lecture_id: str):
+    db = await bot_module.get_db()
+    try:
+        row = await db.execute_fetchone(
+            """
+            SELECT s.total, s.approved, s.pending_video, s.pending, s.rejected
+              FROM lecture_stats s
+              JOIN lectures l ON l.id = s.lecture_id
+             WHERE l.code = ?
+            """,
+            (lecture_id,),
+        )
+    finally:
+        await db.close()
+    return tuple(row) if row else None
+
+
+def test_lecture_stats_follow_status_changes(memory_db, monkeypatch, open_lecture):
+    monkeypatch.setattr(bot_module, "MASTER_ADMIN_IDS", {9})
+
+    async def run():
+        await insert_user(1, "speaker")
+        await open_lecture(1, "phys209")
+        await bot_module.handle_speaker_set_geo(
+            DummyMessage(1), {"lectureId": "phys209", "lat": 59.93, "lon": 30.31}
+        )
+        for user_id in (2, 3, 4):
+            await insert_user(user_id, "student")
+            await bot_module.handle_checkin(
+                DummyMessage(user_id),
+                {
+                    "lectureId": "phys209",
+                    "lastGeo": {"latitude": 55.7501, "longitude": 37.6101},
+                },
+            )
+        assert await lecture_stats("phys209") == (3, 0, 3, 0, 0)
+
+        # пересчёт геозоны меняет статусы — счётчики едут вместе с ними
+        await bot_module.handle_speaker_set_geo(
+            DummyMessage(1), {"lectureId": "phys209", "lat": 55.75, "lon": 37.61}
+        )
+        assert await lecture_stats("phys209") == (3, 3, 0, 0, 0)
+
+        writer = await bot_module.get_writer()
+        await writer.execute(
+            "UPDATE attendances SET status = 'rejected' WHERE user_id = 4"
+        )
+        await writer.execute("DELETE FROM attendances WHERE user_id = 3")
+        assert await lecture_stats("phys209") == (2, 1, 0, 0, 1)
+        assert await bot_module.find_lecture_stats_drift() == []
+
+        admin = DummyMessage(9)
+        await bot_module.handle_admin_request_stats(admin, {"lectureId": "phys209"})
+        assert "Всего записей: <b>2</b>" in admin.answers[0]
+        assert "Отклонено: <b>1</b>" in admin.answers[0]
+
+        # счётчики испортили в обход триггеров — команда находит и чинит
+        await writer.execute("UPDATE lecture_stats SET approved = 7")
+        await bot_module.cmd_check_stats(admin)
+        assert "расходилась по лекциям: <b>1</b>" in admin.answers[1]
+        assert await lecture_stats("phys209") == (2, 1, 0, 0, 1)
+        await bot_module.cmd_check_stats(admin)
+        assert admin.answers[2] == "Статистика лекций сходится с отметками."
+
+    asyncio.run(run())
+
+
+def test_lecture_code_is_interned_to_integer_key(memory_db, open_lecture):
+    async def run():
+        await insert_user(1, "speaker")
+        await insert_user(2, "student")
+        code = "https://example.com/qr?lecture=phys210&" + "x" * 200
+        await bot_module.handle_qr_scan(DummyMessage(2), {"qr": code})
+        lecture = bot_module.lecture_registry.get(code)
+        assert isinstance(lecture.id, int)
+
+        writes = (await bot_module.get_writer()).requests_committed
+        await bot_module.handle_qr_scan(DummyMessage(2), {"qr": code})
+        # код уже интернирован — повторный скан в БД не ходит
+        assert (await bot_module.get_writer()).requests_committed == writes
+
+        await open_lecture(1, code)
+        assert bot_module.lecture_registry.get(code) is lecture
+        await bot_module.handle_checkin(DummyMessage(2), {"lectureId": code})
+
+        db = await bot_module.get_db()
+        try:
+            row = await db.execute_fetchone(
+                "SELECT typeof(lecture_id) AS kind, lecture_id FROM attendances"
+            )
+            (lectures,) = await db.execute_fetchone("SELECT COUNT(*) FROM lectures")
+        finally:
+            await db.close()
+        assert (row["kind"], row["lecture_id"]) == ("integer", lecture.id)
+        assert lectures == 1
+
+        # после перезапуска карта code -> id строится заново из БД
+        bot_module.lecture_registry.clear()
+        await bot_module.lecture_registry.load()
+        assert bot_module.lecture_registry.get(code).id == lecture.id
+        assert bot_module.lecture_registry.by_id(lecture.id).code == code
+
+    asyncio.run(run())
+
+
+def test_raw_checkin_payloads_are_archived_compressed(
+    memory_db, monkeypatch, open_lecture
+):
+    monkeypatch.setattr(bot_module.payload_archive, "dict_samples", 3)
+
+    async def run():
+        await insert_user(1, "speaker")
+        await open_lecture(1, "phys211")
+        payloads = {}
+        for user_id in range(2, 8):
+            await insert_user(user_id, "student")
+            payloads[user_id] = {
+                "type": "checkin",
+                "lectureId": "phys211",
+                "fio": f"Студент {user_id}",
+                "email": f"student{user_id}@example.com",
+                "device": "Mozilla/5.0 (iPhone; CPU iPhone OS 17_0 like Mac OS X)",
+                "lastGeo": {"latitude": 55.75, "longitude": 37.61, "accuracy": 12},
+            }
+            await bot_module.handle_checkin(DummyMessage(user_id), payloads[user_id])
+            if user_id == 4:
+                # первые три payload'а обучают словарь и сразу сжимаются с ним
+                assert await bot_module.flush_checkin_payloads() == 3
+
+        db = await bot_module.get_db()
+        try:
+            row = await db.execute_fetchone(
+                "SELECT id FROM attendances WHERE user_id = 7"
+            )
+        finally:
+            await db.close()
+        # ещё не сброшенный payload читается из буфера
+        assert (await bot_module.get_checkin_payload(row["id"]))["raw"] == payloads[7]
+        assert await bot_module.flush_checkin_payloads() == 3
+
+        db = await bot_module.get_db()
+        try:
+            rows = await db.execute_fetchall(
+                """
+                SELECT a.user_id, a.id, p.dict_id, length(p.data) AS size
+                  FROM attendances a
+                  JOIN checkin_payloads p ON p.attendance_id = a.id
+                 ORDER BY a.user_id
+                """
+            )
+            columns = await db.execute_fetchall("PRAGMA table_info(attendances)")
+        finally:
+            await db.close()
+        assert "extra_json" not in {column["name"] for column in columns}
+        assert len({row["dict_id"] for row in rows}) == 1
+        assert rows[0]["dict_id"] is not None
+        plain_zlib = sum(
+            len(zlib.compress(json.dumps({"raw": p}, ensure_ascii=False).encode()))
+            for p in payloads.values()
+        )
+        assert sum(row["size"] for row in rows) < plain_zlib
+
+        # после перезапуска словарь читается из БД
+        bot_module.payload_archive.clear()
+        for row in rows:
+            payload = await bot_module.get_checkin_payload(row["id"])
+            assert payload["raw"] == payloads[row["user_id"]]
+
+    asyncio.run(run())
+
+
+def test_payloads_survive_failed_flush(memory_db, monkeypatch):
+    async def run():
+        archive = bot_module.payload_archive
+        for attendance_id in (1, 2):
+            archive.add(attendance_id, f'{{"raw": {attendance_id}}}')
+
+        async def broken_writer():
+            raise RuntimeError("disk full")
+
+        with monkeypatch.context() as m:
+            m.setattr(bot_module, "get_writer", broken_writer)
+            with pytest.raises(RuntimeError):
+                await bot_module.flush_checkin_payloads()
+        assert await bot_module.get_checkin_payload(1) == {"raw": 1}
+
+        archive.add(3, '{"raw": 3}')
+        assert await bot_module.flush_checkin_payloads() == 3
+        archive.clear()
+        assert await bot_module.get_checkin_payload(2) == {"raw": 2}
+
+    asyncio.run(run())
+
+
+def test_stop_services_keeps_unflushed_payloads(memory_db, monkeypatch):
+    async def run():
+        bot_module.payload_archive.add(1, '{"raw": 1}')
+
+        async def broken_writer():
+            raise RuntimeError("disk full")
+
+        with monkeypatch.context() as m:
+            m.setattr(bot_module, "get_writer", broken_writer)
+            await bot_module.stop_services([])
+
+        assert await bot_module.flush_checkin_payloads() == 1
+        assert await bot_module.get_checkin_payload(1) == {"raw": 1}
+
+    asyncio.run(run())
+
+
+def test_payload_buffer_overflow_is_counted():
+    archive = bot_module.PayloadArchive(max_pending=2, dict_size=1024, dict_samples=0)
+    for attendance_id in range(3):
+        archive.add(attendance_id, "{}")
+    assert archive.dropped == 1
+    archive.requeue([(10, b"{}"), (11, b"{}")])
+    assert archive.dropped == 3
+    # свежие payload'ы важнее старых из неудачной пачки
+    assert [pending_id for pending_id, _ in archive.pop_pending()] == [1, 2]
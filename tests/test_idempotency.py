@@ -0,0 +1,168 @@
+import asyncio
+
+from test_roles import DummyMessage, bot_module, insert_user
+
+
+def test_store_is_bounded_and_windowed(monkeypatch):
+    store = bot_module.IdempotencyStore(max_size=2, ttl=60)
+
+    async def run():
+        assert await store.claim("a") == (True, None)
+        # повтор, пока первая доставка в работе
+        assert await store.claim("a") == (False, None)
+        await store.complete("a", {"text": "ok"})
+        assert await store.claim("a") == (False, {"text": "ok"})
+
+        await store.claim("b")
+        await store.claim("c")  # вытесняет самый старый ключ
+        assert len(store) == 2
+        assert await store.claim("a") == (True, None)
+
+        store.release("c")
+        assert await store.claim("c") == (True, None)
+
+        now = bot_module.time.monotonic()
+        monkeypatch.setattr(bot_module.time, "monotonic", lambda: now + 61)
+        assert await store.claim("c") == (True, None)
+
+    asyncio.run(run())
+    assert store.stats()["hits"] == 2
+
+
+def test_replayed_callback_is_answered_from_cache(
+    memory_db,
+    monkeypatch,
+    open_lecture,
+    attendance_status,
+    fake_bot,
+    make_callback,
+    make_sender,
+):
+    sender = make_sender()
+
+    async def run():
+        await insert_user(1, "speaker")
+        await insert_user(2, "student")
+        await insert_user(3, "rating")
+        await open_lecture(1, "phys501")
+        await bot_module.handle_checkin(DummyMessage(2), {"lectureId": "phys501"})
+        db = await bot_module.get_db()
+        try:
+            row = await db.execute_fetchone("SELECT id FROM attendances")
+        finally:
+            await db.close()
+
+        call = make_callback(3, f"verify_att:{row['id']}:reject")
+        stranger = make_callback(2, f"verify_att:{row['id']}:ok")
+        await bot_module.callback_verify_attendance(call)
+        await bot_module.callback_verify_attendance(stranger)
+        await sender.drain()
+
+        async def no_db():
+            raise AssertionError("повтор не должен ходить в БД")
+
+        with monkeypatch.context() as m:
+            m.setattr(bot_module, "get_db", no_db)
+            m.setattr(bot_module, "get_writer", no_db)
+            await bot_module.callback_verify_attendance(call)
+            # отказ тоже запоминается: повтор не идёт за ролью
+            bot_module.role_cache.clear()
+            await bot_module.callback_verify_attendance(stranger)
+            assert sender.depth == 0
+
+        assert call.answers == ["Решение применено."] * 2
+        assert stranger.answers == ["У вас нет прав оценивать кружки."] * 2
+        assert await attendance_status(2, "phys501") == "rejected"
+
+    asyncio.run(run())
+    assert len(fake_bot.sent) == 1
+    assert "отклонена" in fake_bot.sent[0][1]
+
+
+def test_replayed_webapp_data_is_answered_once_processed(
+    memory_db, open_lecture, attendance_status, webapp_message
+):
+    async def run():
+        await insert_user(1, "speaker")
+        await insert_user(2, "student")
+        await open_lecture(1, "phys502")
+        enqueued = bot_module.ingestion_queue.enqueued
+
+        message = webapp_message(2, {"type": "checkin", "lectureId": "phys502"})
+        await bot_module.webapp_data_handler(message)
+        # повтор, пока первая доставка ещё в очереди
+        await bot_module.webapp_data_handler(message)
+        assert message.answers == ["⏳ Эти данные уже получены и обрабатываются."]
+        await bot_module.ingestion_queue.stop()
+        await bot_module.webapp_data_handler(message)
+
+        assert bot_module.ingestion_queue.enqueued == enqueued + 1
+        assert len(message.answers) == 3
+        assert message.answers[-1] == "✅ Эти данные уже получены и обработаны."
+        assert await attendance_status(2, "phys502") == "approved"
+
+    asyncio.run(run())
+
+
+def test_processed_keys_survive_restart(memory_db, monkeypatch):
+    monkeypatch.setattr(bot_module.idempotency, "persistent", True)
+
+    async def run():
+        store = bot_module.idempotency
+        assert await store.claim("cb:1") == (True, None)
+        await store.complete("cb:1", {"text": "Решение применено.", "alert": False})
+        await store.claim("msg:5:7")
+        await store.complete("msg:5:7")
+
+        store.clear()  # как после рестарта процесса
+        assert await store.claim("cb:1") == (
+            False,
+            {"text": "Решение применено.", "alert": False},
+        )
+        store.clear()
+        assert await store.claim("msg:5:7") == (False, None)
+
+        assert await bot_module.purge_processed_updates() == 0
+        await bot_module.db_write("UPDATE processed_updates SET expires_at = 0")
+        assert await bot_module.purge_processed_updates() == 2
+        store.clear()
+        assert await store.claim("cb:1") == (True, None)
+
+    asyncio.run(run())
+
+
+def test_failed_webapp_job_releases_its_key(
+    memory_db, monkeypatch, open_lecture, attendance_status, webapp_message
+):
+    async def run():
+        await insert_user(1, "speaker")
+        await insert_user(5, "student")
+        await open_lecture(1, "phys503")
+
+        bad = webapp_message(5, {"type": ["checkin"]})
+        await bot_module.webapp_data_handler(bad)
+        await bot_module.webapp_data_handler(bad)
+        assert bad.answers == [
+            "⚠ Не удалось разобрать данные из мини-аппы: поле type: ожидалась строка."
+        ] * 2
+
+        original = bot_module.process_webapp_payload
+
+        async def broken(*args):
+            raise RuntimeError("boom")
+
+        monkeypatch.setattr(bot_module, "process_webapp_payload", broken)
+        message = webapp_message(5, {"type": "checkin", "lectureId": "phys503"})
+        failed = bot_module.ingestion_queue.failed
+        await bot_module.webapp_data_handler(message)
+        await bot_module.ingestion_queue.stop()
+        assert bot_module.ingestion_queue.failed == failed + 1
+        assert await attendance_status(5, "phys503") is None
+
+        # повторная доставка не считается дублем и доходит до обработки
+        monkeypatch.setattr(bot_module, "process_webapp_payload", original)
+        await bot_module.webapp_data_handler(message)
+        await bot_module.ingestion_queue.stop()
+        assert await attendance_status(5, "phys503") == "approved"
+
+    asyncio.run(run())
@@ -0,0 +1,162 @@
+import asyncio
+import sqlite3
+import uuid
+from datetime import datetime
+
+import pytest
+
+from test_roles import bot_module, memory_db  # noqa: F401
+
+LEGACY_SCHEMA = """
+CREATE TABLE users (
+    telegram_id INTEGER PRIMARY KEY, first_name TEXT, last_name TEXT,
+    username TEXT, fio TEXT, email TEXT, role TEXT DEFAULT 'student',
+    created_at TEXT DEFAULT (datetime('now')), updated_at TEXT DEFAULT (datetime('now'))
+);
+CREATE TABLE settings (key TEXT PRIMARY KEY, value TEXT);
+CREATE TABLE lectures (
+    id TEXT PRIMARY KEY, is_open INTEGER DEFAULT 0, created_by INTEGER,
+    geo_lat REAL, geo_lon REAL, geo_radius REAL DEFAULT 150.0,
+    opened_at TEXT, closed_at TEXT
+);
+CREATE TABLE attendances (
+    id INTEGER PRIMARY KEY AUTOINCREMENT, user_id INTEGER, lecture_id TEXT,
+    created_at TEXT DEFAULT (datetime('now')), status TEXT,
+    geo_lat REAL, geo_lon REAL, geo_accuracy REAL, device TEXT, extra_json TEXT,
+    video_chat_id INTEGER, video_message_id INTEGER,
+    reviewer_id INTEGER, reviewed_at TEXT
+);
+CREATE UNIQUE INDEX idx_att_unique ON attendances(user_id, lecture_id);
+INSERT INTO lectures (id, is_open) VALUES ('old101', 0);
+INSERT INTO attendances (user_id, lecture_id, status, created_at, reviewed_at) VALUES
+    (1, 'old101', 'approved', '2024-09-01 10:00:00', NULL),
+    (2, 'old101', 'rejected', '2024-09-01 10:00:00', '2024-09-01T10:05:30'),
+    (3, 'old101', 'approved', '2024-09-01 10:00:00', NULL),
+    (4, 'old101', 'approved', '2024-09-01 10:00:00', NULL);
+DELETE FROM attendances WHERE user_id = 4;
+UPDATE attendances SET extra_json = '{"raw": {"fio": "Старый"}}' WHERE user_id = 1;
+"""
+
+
+def test_up_to_date_schema_starts_with_single_pragma(memory_db, monkeypatch):
+    statements = []
+    original_connect = sqlite3.connect
+
+    def connect(*args, **kwargs):
+        conn = original_connect(*args, **kwargs)
+        conn.set_trace_callback(statements.append)
+        return conn
+
+    monkeypatch.setattr(sqlite3, "connect", connect)
+
+    async def run():
+        await bot_module.close_db()
+        return await bot_module.init_db()
+
+    assert asyncio.run(run()) == len(bot_module.SCHEMA_MIGRATIONS)
+    assert statements == ["PRAGMA user_version"]
+
+
+def test_legacy_database_is_migrated_in_place(monkeypatch):
+    db_path = f"file:{uuid.uuid4().hex}?mode=memory&cache=shared"
+    keeper = sqlite3.connect(db_path, uri=True)
+    keeper.executescript(LEGACY_SCHEMA)
+    monkeypatch.setattr(bot_module, "DB_PATH", db_path)
+
+    async def run():
+        try:
+            return await bot_module.init_db()
+        finally:
+            await bot_module.close_db()
+
+    assert asyncio.run(run()) == len(bot_module.SCHEMA_MIGRATIONS)
+    assert keeper.execute("PRAGMA user_version").fetchone()[0] == len(
+        bot_module.SCHEMA_MIGRATIONS
+    )
+    # счётчики заполнены по уже существующим отметкам
+    assert keeper.execute(
+        """
+        SELECT s.total, s.approved, s.rejected
+          FROM lecture_stats s JOIN lectures l ON l.id = s.lecture_id
+         WHERE l.code = 'old101'
+        """
+    ).fetchone() == (3, 2, 1)
+    indexes = {
+        row[0]
+        for row in keeper.execute("SELECT name FROM sqlite_master WHERE type = 'index'")
+    }
+    assert {
+        "idx_att_unique",
+        "idx_att_lecture_status",
+        "idx_att_pending_video",
+    } <= indexes
+
+    # отметки ссылаются на лекцию по целочисленному ключу
+    assert keeper.execute(
+        """
+        SELECT DISTINCT typeof(a.lecture_id), l.code
+          FROM attendances a JOIN lectures l ON l.id = a.lecture_id
+        """
+    ).fetchall() == [("integer", "old101")]
+
+    # сырой payload уехал из attendances в checkin_payloads
+    (attendance_id,) = keeper.execute(
+        "SELECT id FROM attendances WHERE user_id = 1"
+    ).fetchone()
+    assert keeper.execute(
+        "SELECT attendance_id, codec, dict_id, CAST(data AS TEXT) FROM checkin_payloads"
+    ).fetchall() == [(attendance_id, 0, None, '{"raw": {"fio": "Старый"}}')]
+
+    # время переведено в мс Unix из обоих старых форматов
+    created_at, reviewed_at = keeper.execute(
+        "SELECT created_at, reviewed_at FROM attendances WHERE user_id = 2"
+    ).fetchone()
+    assert created_at == bot_module.datetime_to_ms(datetime(2024, 9, 1, 10, 0))
+    assert reviewed_at == bot_module.datetime_to_ms(datetime(2024, 9, 1, 10, 5, 30))
+    assert (
+        bot_module.ms_to_datetime(reviewed_at).isoformat() == "2024-09-01T10:05:30+00:00"
+    )
+
+    # новые записи получают числовое время, id удалённой отметки не переиспользуется,
+    # а триггеры статистики снова на месте
+    (lecture_key,) = keeper.execute(
+        "SELECT id FROM lectures WHERE code = 'old101'"
+    ).fetchone()
+    keeper.execute(
+        "INSERT INTO attendances (user_id, lecture_id, status) VALUES (5, ?, 'pending')",
+        (lecture_key,),
+    )
+    new_id, new_created_at = keeper.execute(
+        "SELECT id, created_at FROM attendances WHERE user_id = 5"
+    ).fetchone()
+    assert new_id == 5
+    assert isinstance(new_created_at, int)
+    assert abs(new_created_at - bot_module.now_ms()) < 60_000
+    assert keeper.execute(
+        "SELECT total, pending FROM lecture_stats WHERE lecture_id = ?", (lecture_key,)
+    ).fetchone() == (4, 1)
+    keeper.close()
+
+
+def test_failed_migration_step_is_rolled_back(memory_db, monkeypatch):
+    version = len(bot_module.SCHEMA_MIGRATIONS)
+    monkeypatch.setattr(
+        bot_module,
+        "SCHEMA_MIGRATIONS",
+        bot_module.SCHEMA_MIGRATIONS
+        + [("CREATE TABLE half_done (x INTEGER)", "ALTER TABLE missing ADD y")],
+    )
+
+    async def run():
+        with pytest.raises(sqlite3.OperationalError):
+            await bot_module.init_db()
+        db = await bot_module.get_db()
+        try:
+            row = await db.execute_fetchone(
+                "SELECT COUNT(*) FROM sqlite_master WHERE name = 'half_done'"
+            )
+            return await bot_module.get_schema_version(db), row[0]
+        finally:
+            await db.close()
+
+    assert asyncio.run(run()) == (version, 0)
@@ -0,0 +1,282 @@
+import asyncio
+import time
+from types import SimpleNamespace
+
+from test_roles import DummyMessage, bot_module, insert_user
+
+
+class RetryAfter(Exception):
+    def __init__(self, retry_after):
+        super().__init__(f"retry after {retry_after}")
+        self.retry_after = retry_after
+
+
+class TelegramForbiddenError(Exception):
+    pass
+
+
+async def outbox_rows():
+    db = await bot_module.get_db()
+    try:
+        rows = await db.execute_fetchall(
+            "SELECT method, chat_id, params, attempts, last_error FROM outbox"
+        )
+    finally:
+        await db.close()
+    return [tuple(row) for row in rows]
+
+
+def test_token_bucket_refills_at_rate():
+    bucket = bot_module.TokenBucket(rate=2, capacity=1)
+    now = bucket.updated
+    assert bucket.delay(now) == 0
+    bucket.take(now)
+    assert bucket.delay(now) == 0.5
+    assert bucket.delay(now + 0.25) == 0.25
+    assert bucket.delay(now + 10) == 0
+    assert bucket.is_full(now + 10)
+
+
+def test_same_chat_is_paced_and_coalesced(fake_bot, make_sender):
+    sender = make_sender(chat_rate=20)
+
+    async def run():
+        started = time.monotonic()
+        sender.enqueue("send_message", 5, text="a")
+        sender.enqueue("send_message", 5, key="verdict:1", text="b")
+        sender.enqueue("send_message", 6, text="other chat")
+        sender.enqueue("send_message", 5, key="verdict:1", text="c")
+        await sender.drain()
+        return time.monotonic() - started
+
+    elapsed = asyncio.run(run())
+    # b заменён на c; второе сообщение в чат 5 ждёт токен (1/20 с)
+    assert [text for chat, text in fake_bot.sent if chat == 5] == ["a", "c"]
+    assert (6, "other chat") in fake_bot.sent
+    assert elapsed >= 0.04
+    assert sender.stats()["coalesced"] == 1
+
+
+def test_retry_after_pauses_and_keeps_order(fake_bot, make_sender):
+    fake_bot.errors["send_message"].append(RetryAfter(0.05))
+    sender = make_sender()
+
+    async def run():
+        started = time.monotonic()
+        sender.enqueue("send_message", 5, text="1")
+        sender.enqueue("send_message", 5, text="2")
+        await sender.drain()
+        return time.monotonic() - started
+
+    assert asyncio.run(run()) >= 0.05
+    assert fake_bot.sent == [(5, "1"), (5, "2")]
+    assert sender.stats()["flood_waits"] == 1
+
+
+def test_failed_send_is_retried_from_outbox(memory_db, fake_bot, make_sender):
+    fake_bot.errors["send_message"] += [
+        RuntimeError("network down"),
+        TelegramForbiddenError("blocked"),
+    ]
+    sender = make_sender(retry_delay=0)
+
+    async def run():
+        sender.enqueue("send_message", 5, text="важное")
+        await sender.drain()
+        assert fake_bot.sent == []
+        [row] = await outbox_rows()
+        assert row[:4] == ("send_message", 5, '{"text": "важное"}', 1)
+        assert "network down" in row[4]
+
+        # повтор из outbox снова падает, но уже без надежды на успех
+        assert await bot_module.retry_outbox() == 1
+        await sender.drain()
+        assert await outbox_rows() == []
+        assert sender.stats()["dropped"] == 1
+
+        sender.enqueue("send_message", 5, text="ещё раз")
+        fake_bot.errors["send_message"].append(RuntimeError("network down"))
+        await sender.drain()
+        assert await bot_module.retry_outbox() == 1
+        await sender.drain()
+        assert fake_bot.sent == [(5, "ещё раз")]
+        assert await outbox_rows() == []
+
+    asyncio.run(run())
+
+
+def test_dropped_message_survives_outbox_write_error(
+    memory_db, monkeypatch, fake_bot, make_sender, caplog
+):
+    fake_bot.errors["send_message"] += [
+        RuntimeError("network down"),
+        TelegramForbiddenError("blocked"),
+    ]
+    sender = make_sender(retry_delay=0)
+
+    async def run():
+        sender.enqueue("send_message", 5, text="важное")
+        await sender.drain()
+        assert await bot_module.retry_outbox() == 1
+
+        async def broken_write(sql, params=()):
+            raise RuntimeError("writer is down")
+
+        monkeypatch.setattr(bot_module, "db_write", broken_write)
+        await sender.drain()  # ошибка удаления из outbox не вылетает из _send
+        assert sender.stats()["dropped"] == 1
+
+    asyncio.run(run())
+    assert "Не удалось удалить send_message из outbox" in caplog.text
+
+
+def test_unsent_messages_survive_restart(memory_db, fake_bot, make_sender):
+    sender = make_sender(chat_rate=0.001)
+
+    async def run():
+        sender.enqueue("send_message", 5, text="первое")
+        sender.enqueue("send_message", 5, text="второе")
+        await asyncio.sleep(0.05)
+        assert await sender.stop() == 1
+        assert await bot_module.retry_outbox() == 1
+        assert sender.depth == 1
+
+    asyncio.run(run())
+    assert fake_bot.sent == [(5, "первое")]
+
+
+def test_video_note_is_forwarded_in_background(
+    memory_db, monkeypatch, fake_bot, make_callback, make_sender
+):
+    sender = make_sender()
+    monkeypatch.setattr(bot_module, "MASTER_ADMIN_IDS", {9})
+
+    async def run():
+        await insert_user(1, "speaker")
+        await insert_user(2, "student")
+        await bot_module.set_setting("rating_chat_id", "-100")
+        await bot_module.handle_speaker_open_lecture(
+            DummyMessage(1), {"lectureId": "bio101"}
+        )
+        await bot_module.handle_speaker_set_geo(
+            DummyMessage(1), {"lectureId": "bio101", "lat": 55.75, "lon": 37.61}
+        )
+        await bot_module.handle_checkin(
+            DummyMessage(2),
+            {
+                "lectureId": "bio101",
+                "lastGeo": {"latitude": 55.80, "longitude": 37.61, "accuracy": 10},
+            },
+        )
+
+        student = DummyMessage(2)
+        student.video_note = SimpleNamespace(file_id="video")
+        await bot_module.handle_video_note(student)
+        await bot_module.handle_video_note(student)
+        assert sender.depth == 1  # второй кружок заменил первый в очереди
+        await sender.drain()
+
+        db = await bot_module.get_db()
+        try:
+            row = await db.execute_fetchone(
+                """
+                SELECT id, status, video_chat_id, video_message_id
+                  FROM attendances WHERE user_id = 2
+                """
+            )
+        finally:
+            await db.close()
+        assert tuple(row)[1:] == ("pending", -100, 77)
+
+        call = make_callback(9, f"verify_att:{row['id']}:ok")
+        await bot_module.callback_verify_attendance(call)
+        assert call.answers == ["Решение применено."]
+        await sender.drain()
+
+    asyncio.run(run())
+    assert len(fake_bot.sent) == 1
+    assert fake_bot.sent[0][0] == 2
+    assert "подтверждена" in fake_bot.sent[0][1]
+
+
+def test_forwarded_video_keeps_a_newer_status(memory_db, fake_bot, make_sender):
+    sender = make_sender(chat_rate=0.001)
+
+    async def run():
+        await insert_user(1, "speaker")
+        await insert_user(2, "student")
+        await bot_module.set_setting("rating_chat_id", "-100")
+        await bot_module.handle_speaker_open_lecture(
+            DummyMessage(1), {"lectureId": "bio102"}
+        )
+        await bot_module.handle_speaker_set_geo(
+            DummyMessage(1), {"lectureId": "bio102", "lat": 55.75, "lon": 37.61}
+        )
+        far = {"latitude": 55.80, "longitude": 37.61, "accuracy": 10}
+        await bot_module.handle_checkin(
+            DummyMessage(2), {"lectureId": "bio102", "lastGeo": far}
+        )
+
+        # чат рейтинга занят — кружок ждёт своей очереди
+        sender.enqueue("send_message", -100, text="занимает токен чата")
+        student = DummyMessage(2)
+        student.video_note = SimpleNamespace(file_id="video")
+        await bot_module.handle_video_note(student)
+        assert "в очередь" in student.answers[0]
+        assert sender.depth == 1
+
+        # пока кружок ждал, геозону сдвинули к студенту
+        await bot_module.handle_speaker_set_geo(
+            DummyMessage(1), {"lectureId": "bio102", "lat": 55.80, "lon": 37.61}
+        )
+        lecture = bot_module.lecture_registry.get("bio102")
+        fwd = SimpleNamespace(chat=SimpleNamespace(id=-100), message_id=77)
+        await bot_module.store_forwarded_video(
+            fwd, {"attendance_id": 1, "lecture_id": lecture.id, "user_id": 2}
+        )
+
+        db = await bot_module.get_db()
+        try:
+            row = await db.execute_fetchone(
+                "SELECT status, video_message_id FROM attendances WHERE user_id = 2"
+            )
+        finally:
+            await db.close()
+        assert tuple(row) == ("approved", None)
+        assert lecture.attendees[2] == "approved"
+
+    asyncio.run(run())
+
+
+def test_deferred_message_keeps_its_key(memory_db, fake_bot, make_sender):
+    fake_bot.errors["send_video_note"] += [RuntimeError("network down")] * 2
+    sender = make_sender(retry_delay=0)
+
+    async def run():
+        sender.enqueue("send_video_note", -100, key="video:1", video_note="old")
+        await sender.drain()
+        # повторная неудача с тем же key не плодит вторую строку
+        sender.enqueue("send_video_note", -100, key="video:1", video_note="newer")
+        await sender.drain()
+        assert [row[2] for row in await outbox_rows()] == ['{"video_note": "newer"}']
+
+        # свежий кружок ушёл — отложенная копия удаляется, а не досылается
+        sender.enqueue("send_video_note", -100, key="video:1", video_note="latest")
+        await sender.drain()
+        assert await outbox_rows() == []
+        assert await bot_module.retry_outbox() == 0
+
+        # строка из outbox не обгоняет более новое сообщение в очереди
+        fake_bot.errors["send_video_note"].append(RuntimeError("network down"))
+        sender.enqueue("send_video_note", -100, key="video:2", video_note="a")
+        await sender.drain()
+        slow = make_sender(chat_rate=0.001)
+        slow.enqueue("send_message", -100, text="занимает токен чата")
+        slow.enqueue("send_video_note", -100, key="video:2", video_note="b")
+        assert await bot_module.retry_outbox() == 1
+        assert slow.depth == 1  # только «b», строка с «a» не вернулась
+        assert await slow.stop() == 1
+        assert [row[2] for row in await outbox_rows()] == ['{"video_note": "b"}']
+
+    asyncio.run(run())
+    assert fake_bot.videos == ["latest"]
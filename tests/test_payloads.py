@@ -0,0 +1,145 @@
+import asyncio
+import json
+
+import pytest
+
+from test_roles import bot_module, insert_user
+
+
+def test_payload_is_decoded_by_its_schema():
+    spec, payload = bot_module.parse_webapp_payload(
+        json.dumps(
+            {
+                "type": "checkin",
+                "lecture_id": " phys101 ",
+                "fio": "",
+                "lastGeo": {"latitude": "55.75", "longitude": 37.61, "speed": 3},
+                "appVersion": "1.2",
+            }
+        )
+    )
+    assert spec.name == "checkin"
+    assert spec.handler is bot_module.handle_checkin
+    # алиас приведён к lectureId, пустое поле выброшено, числа — float;
+    # незнакомые ключи отметки остаются, во вложенных — нет
+    assert payload == {
+        "type": "checkin",
+        "lectureId": "phys101",
+        "lastGeo": {"latitude": 55.75, "longitude": 37.61},
+        "appVersion": "1.2",
+    }
+
+    # точность — справочная: вне диапазона прижимается, а не валит отметку
+    _, payload = bot_module.parse_webapp_payload(
+        '{"type": "checkin", "lastGeo": {"latitude": 1, "longitude": 2, '
+        '"accuracy": 2500000}}'
+    )
+    assert payload["lastGeo"]["accuracy"] == 100_000
+    assert bot_module.float_field(0, 10, clamp=True)(float("nan")) is None
+
+    spec, payload = bot_module.parse_webapp_payload(
+        '{"type": "admin_set_role", "targetUserId": "42", "newRole": "Rating", "x": 1}'
+    )
+    assert payload == {"type": "admin_set_role", "targetUserId": 42, "newRole": "Rating"}
+
+    assert bot_module.parse_webapp_payload('{"type": "check_in"}') == (
+        None,
+        {"type": "check_in"},
+    )
+
+
+@pytest.mark.parametrize(
+    "raw, error",
+    [
+        ("{not json", "некорректный JSON"),
+        ("[1, 2]", "ожидался JSON-объект"),
+        ('{"type": []}', "поле type: ожидалась строка"),
+        ('{"type": {"a": 1}}', "поле type: ожидалась строка"),
+        ('{"lectureId": "x"}', "поле type: ожидалась строка"),
+        ('{"type": "checkin", "lectureId": ["x"]}', "поле lectureId: ожидалась строка"),
+        (
+            '{"type": "speaker_set_geo", "lat": 95, "lon": 0}',
+            "поле lat: вне диапазона [-90, 90]",
+        ),
+        ('{"type": "geo_stream", "lat": true, "lon": 0}', "поле lat: ожидалось число"),
+        ('{"type": "admin_set_role", "targetUserId": -5}', "поле targetUserId: меньше 1"),
+        ('{"type": "checkin", "lastGeo": 1}', "поле lastGeo: ожидался объект"),
+        (json.dumps({"type": "register", "fio": "я" * 3000}), "длиннее 4096 байт"),
+    ],
+)
+def test_malformed_payload_is_rejected(raw, error):
+    with pytest.raises(bot_module.PayloadError, match=error.replace("[", r"\[")):
+        bot_module.parse_webapp_payload(raw)
+
+
+def test_rejected_payloads_never_reach_the_queue(memory_db, webapp_message):
+    async def run():
+        enqueued = bot_module.ingestion_queue.enqueued
+
+        bad = webapp_message(5, {"type": "checkin", "lectureId": {"id": 1}})
+        await bot_module.webapp_data_handler(bad)
+        assert bad.answers == [
+            "⚠ Не удалось разобрать данные из мини-аппы: поле lectureId: ожидалась строка."
+        ]
+
+        unknown = webapp_message(5, {"type": "<b>"})
+        await bot_module.webapp_data_handler(unknown)
+        assert unknown.answers == ["⚠ Неизвестный тип события: <code>&lt;b&gt;</code>."]
+
+        # битый geo_stream отбрасывается молча
+        geo = webapp_message(5, {"type": "geo_stream", "lat": 200, "lon": 0})
+        await bot_module.webapp_data_handler(geo)
+        assert geo.answers == []
+
+        assert bot_module.ingestion_queue.enqueued == enqueued
+        db = await bot_module.get_db()
+        try:
+            row = await db.execute_fetchone("SELECT COUNT(*) FROM users")
+        finally:
+            await db.close()
+        assert row[0] == 0
+
+    asyncio.run(run())
+
+
+def test_valid_payload_is_dispatched_through_registry(
+    memory_db, open_lecture, attendance_status, webapp_message
+):
+    async def run():
+        await insert_user(1, "speaker")
+        await insert_user(2, "student")
+        await open_lecture(1, "phys401")
+
+        message = webapp_message(
+            2, {"type": "checkin", "lecture_id": "phys401", "fio": "Иванов"}
+        )
+        await bot_module.webapp_data_handler(message)
+        await bot_module.ingestion_queue.stop()
+
+        assert message.answers[0].startswith("✅ Отметка предварительно засчитана.")
+        assert await attendance_status(2, "phys401") == "approved"
+
+    asyncio.run(run())
+
+
+def test_checkin_archive_keeps_payload_as_sent(memory_db, open_lecture, webapp_message):
+    async def run():
+        await insert_user(1, "speaker")
+        await insert_user(2, "student")
+        await open_lecture(1, "phys402")
+
+        raw = '{"type":"checkin", "lecture_id":" phys402 ", "fio":"", "x":[1]}'
+        await bot_module.webapp_data_handler(webapp_message(2, raw))
+        await bot_module.ingestion_queue.stop()
+
+        db = await bot_module.get_db()
+        try:
+            row = await db.execute_fetchone("SELECT id FROM attendances")
+        finally:
+            await db.close()
+        # без алиасов, обрезки и отброса пустых полей
+        assert (await bot_module.get_checkin_payload(row["id"]))["raw"] == json.loads(
+            raw
+        )
+
+    asyncio.run(run())
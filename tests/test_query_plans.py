@@ -0,0 +1,125 @@
+import asyncio
+import re
+import sqlite3
+from types import SimpleNamespace
+
+from test_roles import DummyMessage, bot_module, insert_user
+
+DATA_STATEMENT = re.compile(r"^\s*(SELECT|WITH|INSERT|UPDATE|DELETE)\b", re.IGNORECASE)
+FULL_SCAN = re.compile(r"^SCAN (\w+)$")
+
+
+def capture_statements(monkeypatch) -> list[str]:
+    """Пишет каждый выполненный запрос (с подставленными параметрами)."""
+    statements = []
+    original_connect = sqlite3.connect
+
+    def connect(*args, **kwargs):
+        conn = original_connect(*args, **kwargs)
+        conn.set_trace_callback(statements.append)
+        return conn
+
+    monkeypatch.setattr(sqlite3, "connect", connect)
+    return statements
+
+
+async def exercise_bot(make_callback):
+    """Прогоняет все пути бота, которые ходят в БД."""
+    await insert_user(1, "speaker")
+    await insert_user(2, "student")
+    await insert_user(3, "rating")
+    await bot_module.set_setting("rating_chat_id", "-100")
+    await bot_module.settings_cache.reload()
+    await bot_module.role_cache.warm()
+    await bot_module.lecture_registry.load()
+
+    speaker = DummyMessage(1)
+    await bot_module.handle_speaker_open_lecture(speaker, {"lectureId": "phys301"})
+    await bot_module.handle_speaker_set_geo(
+        speaker, {"lectureId": "phys301", "lat": 59.93, "lon": 30.31}
+    )
+    await bot_module.handle_speaker_set_zone(
+        speaker,
+        {"lectureId": "phys301", "name": "hall", "lat": 59.94, "lon": 30.32},
+    )
+
+    student = DummyMessage(2)
+    await bot_module.handle_geo_stream(
+        student, {"lat": 55.75, "lon": 37.61, "timestamp": 1_000}
+    )
+    await bot_module.flush_geo_samples()
+    await bot_module.handle_checkin(student, {"lectureId": "phys301", "fio": "Иванов"})
+    await bot_module.flush_profile_touches()
+
+    student.video_note = SimpleNamespace(file_id="video")
+    await bot_module.handle_video_note(student)
+    await bot_module.outbound.drain()
+    db = await bot_module.get_db()
+    try:
+        row = await db.execute_fetchone("SELECT id FROM attendances WHERE user_id = 2")
+    finally:
+        await db.close()
+    await bot_module.callback_verify_attendance(
+        make_callback(3, f"verify_att:{row['id']}:ok")
+    )
+    await bot_module.outbound.drain()
+    await bot_module.retry_outbox()
+    await bot_module.purge_processed_updates()
+
+    await bot_module.lecture_registry.refresh(
+        bot_module.lecture_registry.get("phys301").id
+    )
+    await bot_module.handle_speaker_remove_zone(
+        speaker, {"lectureId": "phys301", "name": "hall"}
+    )
+    await bot_module.handle_admin_request_stats(
+        DummyMessage(9), {"lectureId": "phys301"}
+    )
+    await bot_module.cmd_check_stats(DummyMessage(9))
+    await bot_module.handle_speaker_close_lecture(speaker, {"lectureId": "phys301"})
+    bot_module.role_cache.clear()
+    await bot_module.get_user_role(2)
+
+
+def plan_problems(conn, sql: str) -> list[str]:
+    problems = []
+    subqueries = set()
+    whole_table = sql == bot_module.LECTURE_STATS_DRIFT_SQL.strip()
+    for row in conn.execute("EXPLAIN QUERY PLAN " + sql):
+        detail = row[3]
+        subqueries.update(re.findall(r"^(?:CO-ROUTINE|MATERIALIZE) (\w+)", detail))
+        scan = FULL_SCAN.match(detail)
+        if "USE TEMP B-TREE" in detail:
+            problems.append(detail)
+        elif scan and scan.group(1) not in subqueries and not whole_table:
+            # полная выгрузка таблицы без условий в кэш — это осознанный скан
+            if re.search(r"\b(WHERE|JOIN|ORDER BY|GROUP BY)\b", sql, re.IGNORECASE):
+                problems.append(detail)
+    return problems
+
+
+def test_bot_queries_use_indexes(memory_db, monkeypatch, fake_bot, make_callback):
+    monkeypatch.setattr(bot_module, "MASTER_ADMIN_IDS", {9})
+    monkeypatch.setattr(bot_module.idempotency, "persistent", True)
+    statements = capture_statements(monkeypatch)
+
+    async def run():
+        # пул и писатель открываются заново уже с трассировкой
+        await bot_module.close_db()
+        await exercise_bot(make_callback)
+        await bot_module.close_db()
+
+    asyncio.run(run())
+
+    queries = {sql.strip() for sql in statements if DATA_STATEMENT.match(sql)}
+    queries = {sql for sql in queries if not sql.startswith("--")}
+    assert any("pending_video" in sql and "ORDER BY" in sql for sql in queries)
+    assert any("FROM lecture_stats" in sql for sql in queries)
+
+    conn = sqlite3.connect(bot_module.DB_PATH, uri=True)
+    try:
+        bad = {sql: plan_problems(conn, sql) for sql in queries}
+    finally:
+        conn.close()
+    bad = {sql: problems for sql, problems in bad.items() if problems}
+    assert bad == {}
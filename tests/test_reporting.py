@@ -0,0 +1,112 @@
+import asyncio
+import sqlite3
+
+import pytest
+
+from test_roles import DummyMessage, bot_module, insert_user
+
+
+async def checkin(user_id: int, lecture_id: str):
+    await insert_user(user_id, "student")
+    await bot_module.handle_checkin(DummyMessage(user_id), {"lectureId": lecture_id})
+
+
+async def request_stats(lecture_id: str) -> str:
+    admin = DummyMessage(9)
+    await bot_module.handle_admin_request_stats(admin, {"lectureId": lecture_id})
+    return admin.answers[0]
+
+
+@pytest.mark.parametrize("on_disk", [False, True])
+def test_stats_are_served_from_snapshot(
+    memory_db, monkeypatch, tmp_path, on_disk, open_lecture
+):
+    monkeypatch.setattr(bot_module, "MASTER_ADMIN_IDS", {9})
+    monkeypatch.setattr(bot_module.reporting, "mode", "snapshot")
+    snapshot_path = str(tmp_path / "report.db") if on_disk else ""
+    monkeypatch.setattr(bot_module.reporting, "snapshot_path", snapshot_path)
+
+    async def run():
+        await insert_user(1, "speaker")
+        await open_lecture(1, "phys401")
+        await checkin(2, "phys401")
+        await bot_module.reporting.refresh()
+
+        # отметка после среза видна только после следующего обновления
+        await checkin(3, "phys401")
+        text = await request_stats("phys401")
+        assert "Всего записей: <b>1</b>" in text
+        assert "Срез данных на" in text
+
+        db = await bot_module.get_report_db()
+        try:
+            await bot_module.reporting.refresh()
+            # старый срез дочитывается, пока соединение не вернули
+            row = await db.execute_fetchone("SELECT COUNT(*) FROM attendances")
+            assert row[0] == 1
+        finally:
+            await db.close()
+        assert "Всего записей: <b>2</b>" in await request_stats("phys401")
+
+        if on_disk:
+            db = await bot_module.get_report_db()
+            try:
+                with pytest.raises(sqlite3.OperationalError):
+                    await db.execute("DELETE FROM attendances")
+            finally:
+                await db.close()
+
+    asyncio.run(run())
+
+
+def test_snapshot_never_touches_the_live_pool(memory_db, monkeypatch):
+    monkeypatch.setattr(bot_module.reporting, "mode", "snapshot")
+    monkeypatch.setattr(bot_module.reporting, "snapshot_path", "")
+
+    async def run():
+        await insert_user(1, "student")
+
+        async def busy():
+            raise AssertionError("срез не должен брать соединение из общего пула")
+
+        with monkeypatch.context() as m:
+            m.setattr(bot_module, "get_db", busy)
+            await bot_module.reporting.refresh()
+            db = await bot_module.get_report_db()
+            try:
+                row = await db.execute_fetchone("SELECT COUNT(*) FROM users")
+                assert row[0] == 1
+                # и запросы отчётов идут в своих потоках
+                assert db._lane in bot_module.reporting.executor._lanes
+                assert db._lane not in bot_module.db_executor._lanes
+            finally:
+                await db.close()
+
+    asyncio.run(run())
+
+
+def test_readonly_reporting_pool_rejects_writes(monkeypatch, tmp_path):
+    monkeypatch.setattr(bot_module, "DB_PATH", str(tmp_path / "attendance.db"))
+    monkeypatch.setattr(bot_module.reporting, "mode", "readonly")
+
+    async def run():
+        await bot_module.init_db()
+        try:
+            await insert_user(1, "student")
+            db = await bot_module.get_report_db()
+            try:
+                row = await db.execute_fetchone("SELECT COUNT(*) FROM users")
+                assert row[0] == 1
+                with pytest.raises(sqlite3.OperationalError, match="readonly"):
+                    await db.execute("DELETE FROM users")
+            finally:
+                await db.close()
+        finally:
+            await bot_module.close_db()
+
+    asyncio.run(run())
+
+
+def test_unknown_reporting_mode_is_rejected():
+    with pytest.raises(ValueError):
+        bot_module.ReportingStore("replica", "", 1)
@@ -133,6 +133,7 @@ def memory_db(monkeypatch):
     keeper_conn = asyncio.run(original_connect(db_path, uri=True))
     asyncio.run(bot_module.init_db())
     yield
+    asyncio.run(bot_module.close_db())
     asyncio.run(keeper_conn.close())
 
 
@@ -140,8 +141,8 @@ async def insert_user(user_id: int, role: str):
     db = await bot_module.get_db()
     try:
         await db.execute(
-            "INSERT INTO users (telegram_id, role, updated_at) VALUES (?, ?, datetime('now'))",
-            (user_id, role),
+            "INSERT INTO users (telegram_id, role, updated_at) VALUES (?, ?, ?)",
+            (user_id, role, bot_module.now_ms()),
         )
         await db.commit()
     finally:
@@ -188,7 +189,7 @@ def test_speaker_opens_lecture_successfully(memory_db):
         db = await bot_module.get_db()
         try:
             cur = await db.execute(
-                "SELECT is_open, created_by FROM lectures WHERE id = ?", ("math102",)
+                "SELECT is_open, created_by FROM lectures WHERE code = ?", ("math102",)
             )
             row = await cur.fetchone()
         finally:
@@ -219,7 +220,7 @@ def test_master_admin_can_open_lecture(memory_db, monkeypatch):
         db = await bot_module.get_db()
         try:
             cur = await db.execute(
-                "SELECT is_open, created_by FROM lectures WHERE id = ?", ("math103",)
+                "SELECT is_open, created_by FROM lectures WHERE code = ?", ("math103",)
             )
             row = await cur.fetchone()
         finally:
@@ -230,3 +231,122 @@ def test_master_admin_can_open_lecture(memory_db, monkeypatch):
         assert row["created_by"] == admin_id
 
     asyncio.run(run())
+
+
+def test_role_cache_is_updated_on_write(memory_db):
+    async def run():
+        user_id = 4004
+        await insert_user(user_id, "student")
+
+        assert await bot_module.get_user_role(user_id) == "student"
+        hits = bot_module.role_cache.hits
+        assert await bot_module.get_user_role(user_id) == "student"
+        assert bot_module.role_cache.hits == hits + 1
+
+        await bot_module.set_user_role(user_id, "speaker")
+        assert bot_module.role_cache.get(user_id) == "speaker"
+        assert await bot_module.get_user_role(user_id) == "speaker"
+
+    asyncio.run(run())
+
+
+def test_role_read_does_not_overwrite_concurrent_write(memory_db, monkeypatch):
+    async def run():
+        user_id = 4005
+        await insert_user(user_id, "speaker")
+        bot_module.role_cache.clear()
+
+        # роль отзывают, пока промах кэша ещё читает старую из БД
+        original_get_db = bot_module.get_db
+
+        async def get_db_then_revoke():
+            db = await original_get_db()
+            row = await db.execute_fetchone(
+                "SELECT role FROM users WHERE telegram_id = ?", (user_id,)
+            )
+
+            async def stale_read(*args, **kwargs):
+                await bot_module.set_user_role(user_id, "student")
+                return row
+
+            db.execute_fetchone = stale_read
+            return db
+
+        monkeypatch.setattr(bot_module, "get_db", get_db_then_revoke)
+        assert await bot_module.get_user_role(user_id) == "speaker"
+        monkeypatch.setattr(bot_module, "get_db", original_get_db)
+
+        assert bot_module.role_cache.get(user_id) == "student"
+        assert await bot_module.get_user_role(user_id) == "student"
+
+    asyncio.run(run())
+
+
+def test_role_cache_warm_loads_users(memory_db):
+    async def run():
+        await insert_user(5005, "rating")
+        await insert_user(5006, "admin")
+
+        bot_module.role_cache.clear()
+        assert await bot_module.role_cache.warm() == 2
+        assert bot_module.role_cache.get(5005) == "rating"
+        assert bot_module.role_cache.get(5006) == "admin"
+
+    asyncio.run(run())
+
+
+def test_settings_are_served_from_cache(memory_db):
+    async def run():
+        await bot_module.set_setting("rating_chat_id", "-100500")
+        assert await bot_module.get_setting_int("rating_chat_id") == -100500
+
+        db = await bot_module.get_db()
+        try:
+            await db.execute(
+                "UPDATE settings SET value = '-42' WHERE key = 'rating_chat_id'"
+            )
+            await db.commit()
+        finally:
+            await db.close()
+
+        # правка в обход бота видна только после reload
+        assert await bot_module.get_setting("rating_chat_id") == "-100500"
+        await bot_module.settings_cache.reload()
+        assert await bot_module.get_setting_int("rating_chat_id") == -42
+
+    asyncio.run(run())
+
+
+def test_unchanged_profile_skips_writes(memory_db):
+    async def run():
+        user_id = 6006
+        message = DummyMessage(user_id)
+        message.from_user = SimpleNamespace(
+            id=user_id, first_name="Ivan", last_name="Petrov", username="ivan"
+        )
+
+        await bot_module.ensure_user(message)
+        await bot_module.set_user_profile(user_id, "Петров Иван", "ivan@example.com")
+        writes = (await bot_module.get_writer()).requests_committed
+
+        await bot_module.ensure_user(message)
+        await bot_module.set_user_profile(user_id, "Петров Иван", "ivan@example.com")
+        await bot_module.set_user_profile(user_id, None, None)
+        assert (await bot_module.get_writer()).requests_committed == writes
+
+        assert await bot_module.flush_profile_touches() == 1
+
+        message.from_user.username = "ivan_p"
+        await bot_module.ensure_user(message)
+
+        db = await bot_module.get_db()
+        try:
+            row = await db.execute_fetchone(
+                "SELECT username, fio FROM users WHERE telegram_id = ?", (user_id,)
+            )
+        finally:
+            await db.close()
+        assert row["username"] == "ivan_p"
+        assert row["fio"] == "Петров Иван"
+
+    asyncio.run(run())
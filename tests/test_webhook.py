@@ -0,0 +1,87 @@
+import asyncio
+import json
+
+import pytest
+
+from test_roles import bot_module
+
+SECRET = "s3cret-token"
+
+
+class SlowFeed:
+    """Обработчик апдейтов, который ждёт отмашки теста."""
+
+    def __init__(self):
+        self.release = asyncio.Event()
+        self.updates = []
+
+    async def __call__(self, update):
+        await self.release.wait()
+        self.updates.append(update)
+
+
+def test_receiver_answers_before_update_is_handled():
+    async def run():
+        feed = SlowFeed()
+        receiver = bot_module.WebhookReceiver(SECRET, feed)
+        body = json.dumps({"update_id": 1, "message": {"text": "/start"}}).encode()
+
+        assert receiver.receive(None, body) == 401
+        assert receiver.receive("wrong", body) == 401
+        assert receiver.receive(SECRET, b"{not json") == 400
+        assert receiver.receive(SECRET, b"[1, 2]") == 400
+
+        # 200 уходит сразу, обработка ещё не закончилась
+        assert receiver.receive(SECRET, body) == 200
+        await asyncio.sleep(0)
+        assert feed.updates == []
+
+        feed.release.set()
+        await receiver.close()
+        assert feed.updates == [{"update_id": 1, "message": {"text": "/start"}}]
+        assert (receiver.accepted, receiver.rejected) == (1, 4)
+
+    asyncio.run(run())
+
+
+def test_failed_update_does_not_break_receiver(caplog):
+    async def run():
+        async def feed(update):
+            raise RuntimeError("handler crashed")
+
+        receiver = bot_module.WebhookReceiver(SECRET, feed)
+        assert receiver.receive(SECRET, b'{"update_id": 7}') == 200
+        await receiver.close()
+
+    asyncio.run(run())
+    assert "7" in caplog.text
+
+
+def test_webhook_server_over_http():
+    pytest.importorskip("aiohttp")
+    from aiohttp.test_utils import TestClient, TestServer
+
+    async def run():
+        feed = SlowFeed()
+        receiver = bot_module.WebhookReceiver(SECRET, feed)
+        async with TestClient(TestServer(receiver.app("/hook"))) as client:
+            update = {"update_id": 2, "message": {"text": "hi"}}
+            response = await client.post(
+                "/hook",
+                json=update,
+                headers={bot_module.WEBHOOK_SECRET_HEADER: "wrong"},
+            )
+            assert response.status == 401
+
+            response = await client.post(
+                "/hook",
+                json=update,
+                headers={bot_module.WEBHOOK_SECRET_HEADER: SECRET},
+            )
+            assert response.status == 200
+            assert feed.updates == []
+            feed.release.set()
+            await receiver.close()
+        return feed.updates
+
+    assert asyncio.run(run()) == [{"update_id": 2, "message": {"text": "hi"}}]
@@ -0,0 +1,316 @@
+import asyncio
+import multiprocessing
+import queue
+import sqlite3
+
+import pytest
+
+from test_roles import DummyMessage, bot_module, insert_user
+
+aiosqlite = bot_module.aiosqlite
+
+
+def message_update(update_id, user_id, text="hi"):
+    return {
+        "update_id": update_id,
+        "message": {"message_id": update_id, "from": {"id": user_id}, "text": text},
+    }
+
+
+def remote_worker(conn, path, user_ids):
+    """Тело процесса-воркера: пишет только через RemoteWriter."""
+
+    async def run():
+        writer = aiosqlite.RemoteWriter(conn, path)
+        await writer.executemany(
+            "INSERT INTO users (telegram_id, role) VALUES (?, 'student')",
+            [(user_id,) for user_id in user_ids],
+        )
+        await writer.close()
+
+    asyncio.run(run())
+
+
+def test_updates_are_routed_by_user():
+    assert bot_module.update_user_id(message_update(1, 42)) == 42
+    assert (
+        bot_module.update_user_id(
+            {"update_id": 2, "callback_query": {"id": "x", "from": {"id": 7}}}
+        )
+        == 7
+    )
+    assert bot_module.update_user_id({"update_id": 3, "poll": {"id": "p"}}) is None
+
+    async def run():
+        queues = [queue.SimpleQueue() for _ in range(3)]
+        router = bot_module.ShardRouter(queues, queue.SimpleQueue())
+        for update_id, user_id in enumerate([10, 11, 10, 12, 10, 13]):
+            await router.feed(message_update(update_id, user_id))
+        return queues, router.routed
+
+    queues, routed = asyncio.run(run())
+    assert routed == [1, 4, 1]
+    shard = queues[bot_module.shard_for(10, 3)]
+    updates = []
+    while not shard.empty():
+        updates.append(shard.get()[1])
+    # апдейты одного пользователя приходят в свой воркер по порядку
+    assert [u["update_id"] for u in updates if u["message"]["from"]["id"] == 10] == [
+        0,
+        2,
+        4,
+    ]
+
+
+def test_invalidations_are_relayed_to_other_workers():
+    queues = [queue.SimpleQueue() for _ in range(3)]
+    invalidations = queue.SimpleQueue()
+    router = bot_module.ShardRouter(queues, invalidations)
+    router.start()
+    invalidations.put((1, "role", 5))
+    router.stop()
+
+    received = []
+    for q in queues:
+        items = []
+        while not q.empty():
+            items.append(q.get())
+        received.append(items)
+    assert received == [
+        [("invalidate", "role", 5), None],
+        [None],
+        [("invalidate", "role", 5), None],
+    ]
+
+
+def test_worker_keeps_per_user_order(memory_db, monkeypatch, webapp_message):
+    events = []
+
+    def recorder(delay):
+        async def handler(message, payload):
+            user_id = message.from_user.id
+            events.append(("start", user_id, payload["seq"]))
+            await asyncio.sleep(delay)
+            events.append(("end", user_id, payload["seq"]))
+
+        return handler
+
+    # отметка обгоняет geo_stream по приоритету, но не внутри одного пользователя
+    types = bot_module.PAYLOAD_TYPES
+    monkeypatch.setitem(
+        types,
+        "geo_stream",
+        bot_module.PayloadType(
+            "geo_stream", recorder(0.03), dict, bot_module.LOW_PRIORITY
+        ),
+    )
+    monkeypatch.setitem(
+        types, "checkin", bot_module.PayloadType("checkin", recorder(0), dict, 0)
+    )
+    messages = {}
+
+    async def feed(update):
+        await bot_module.webapp_data_handler(messages[update["update_id"]])
+
+    async def run():
+        receiver = bot_module.WebhookReceiver("", feed)
+        plan = [(5, "geo_stream"), (6, "geo_stream"), (5, "checkin"), (5, "geo_stream")]
+        for seq, (user_id, p_type) in enumerate(plan):
+            messages[seq] = webapp_message(user_id, {"type": p_type, "seq": seq})
+            receiver.dispatch(message_update(seq, user_id))
+        await receiver.close()
+        await bot_module.ingestion_queue.stop()
+
+    asyncio.run(run())
+    mine = [event for event in events if event[1] == 5]
+    assert mine == [
+        ("start", 5, 0),
+        ("end", 5, 0),
+        ("start", 5, 2),
+        ("end", 5, 2),
+        ("start", 5, 3),
+        ("end", 5, 3),
+    ]
+    # другой пользователь не ждёт пятого
+    assert events.index(("start", 6, 1)) < events.index(("end", 5, 0))
+
+
+def test_worker_applies_invalidations(memory_db, monkeypatch):
+    published = queue.SimpleQueue()
+    monkeypatch.setattr(bot_module, "_invalidations", published)
+    monkeypatch.setattr(bot_module, "_worker_index", 0)
+
+    async def run():
+        await insert_user(1, "speaker")
+        await insert_user(2, "student")
+        await bot_module.lecture_registry.load()
+        await bot_module.settings_cache.load()
+        assert await bot_module.get_user_role(2) == "student"
+
+        # другой воркер поменял данные в обход кэшей этого
+        db = await bot_module.get_db()
+        try:
+            await db.execute("UPDATE users SET role = 'rating' WHERE telegram_id = 2")
+            await db.execute(
+                "INSERT INTO settings (key, value) VALUES ('rating_chat_id', '-5')"
+            )
+            (chem1,) = await db.execute_fetchone(
+                "INSERT INTO lectures (code, is_open) VALUES ('chem1', 1) RETURNING id"
+            )
+            await db.execute("INSERT INTO lectures (code, is_open) VALUES ('chem2', 1)")
+            await db.execute(
+                "INSERT INTO geo_zones (name, kind, lat, lon, radius) "
+                "VALUES ('lab', 'circle', 55.7, 37.6, 50)"
+            )
+            await db.execute(
+                "INSERT INTO lecture_zones (lecture_id, zone_id) VALUES (?, 1)",
+                (chem1,),
+            )
+            await db.commit()
+        finally:
+            await db.close()
+        assert await bot_module.get_user_role(2) == "student"
+
+        await bot_module.apply_invalidation("role", 2)
+        await bot_module.apply_invalidation("settings")
+        await bot_module.apply_invalidation("lectures", chem1)
+        assert await bot_module.get_user_role(2) == "rating"
+        assert await bot_module.get_setting_int("rating_chat_id") == -5
+        lecture = bot_module.lecture_registry.get("chem1")
+        assert lecture.is_open and lecture.attendees == {}
+        assert bot_module.zone_index.get(next(iter(lecture.zone_ids))).name == "lab"
+        # перечитывается только названная лекция, не весь реестр
+        assert bot_module.lecture_registry.get("chem2") is None
+
+        # свои изменения воркер рассылает остальным
+        await bot_module.set_user_role(2, "admin")
+        await bot_module.handle_speaker_close_lecture(
+            DummyMessage(1), {"lectureId": "chem1"}
+        )
+        return chem1
+
+    chem1 = asyncio.run(run())
+    assert published.get_nowait() == (0, "role", 2)
+    assert published.get_nowait() == (0, "lectures", chem1)
+
+
+def test_worker_rereads_lecture_before_rejecting_checkin(
+    memory_db, monkeypatch, attendance_status
+):
+    monkeypatch.setattr(bot_module, "_worker_index", 0)
+
+    async def run():
+        await insert_user(2, "student")
+        await insert_user(3, "student")
+        await bot_module.lecture_registry.load()
+        db = await bot_module.get_db()
+        try:
+            await db.execute("INSERT INTO lectures (code, is_open) VALUES ('bio1', 0)")
+            await db.commit()
+        finally:
+            await db.close()
+        # лекция закрыта и в реестре этого воркера
+        await bot_module.handle_checkin(DummyMessage(2), {"lectureId": "bio1"})
+        assert await attendance_status(2, "bio1") is None
+        assert not bot_module.lecture_registry.get("bio1").is_open
+
+        # другой воркер открыл её и ещё одну, инвалидации не дошли
+        db = await bot_module.get_db()
+        try:
+            await db.execute("UPDATE lectures SET is_open = 1 WHERE code = 'bio1'")
+            await db.execute("INSERT INTO lectures (code, is_open) VALUES ('bio2', 1)")
+            await db.commit()
+        finally:
+            await db.close()
+        await bot_module.handle_checkin(DummyMessage(2), {"lectureId": "bio1"})
+        await bot_module.handle_checkin(DummyMessage(3), {"lectureId": "bio2"})
+        assert await attendance_status(2, "bio1") == "approved"
+        assert await attendance_status(3, "bio2") == "approved"
+
+    asyncio.run(run())
+
+
+def test_remote_writer_shares_group_commit(memory_db):
+    async def run():
+        writer = await bot_module.get_writer()
+        server = aiosqlite.WriterServer(writer)
+        parent_conn, child_conn = multiprocessing.Pipe()
+        server.serve(parent_conn)
+        remote = aiosqlite.RemoteWriter(child_conn, bot_module.DB_PATH)
+
+        result = await remote.execute(
+            "INSERT INTO users (telegram_id) VALUES (?) RETURNING telegram_id", (1,)
+        )
+        assert result.rows == [(1,)]
+        with pytest.raises(sqlite3.IntegrityError):
+            await remote.execute("INSERT INTO users (telegram_id) VALUES (1)")
+        results = await remote.transaction(
+            [
+                ("INSERT INTO users (telegram_id) VALUES (?)", (2,)),
+                ("UPDATE users SET role = 'rating' WHERE telegram_id = ?", (2,)),
+            ]
+        )
+        assert [r.rowcount for r in results] == [1, 1]
+        await remote.close()
+        server.join(timeout=5)
+        with pytest.raises(aiosqlite.WriterClosedError):
+            await remote.execute("INSERT INTO users (telegram_id) VALUES (3)")
+
+        db = await bot_module.get_db()
+        try:
+            rows = await db.execute_fetchall(
+                "SELECT telegram_id, role FROM users ORDER BY telegram_id"
+            )
+        finally:
+            await db.close()
+        return [tuple(row) for row in rows]
+
+    assert asyncio.run(run()) == [(1, "student"), (2, "rating")]
+
+
+def test_worker_never_opens_its_own_writer(memory_db, monkeypatch):
+    parent_conn, child_conn = multiprocessing.Pipe()
+    remote = aiosqlite.RemoteWriter(child_conn, bot_module.DB_PATH)
+    monkeypatch.setattr(bot_module, "_db_writer", remote)
+    monkeypatch.setattr(bot_module, "_writer_remote", True)
+
+    async def run():
+        parent_conn.close()  # супервизор ушёл
+        with pytest.raises(aiosqlite.WriterClosedError):
+            await bot_module.db_write("INSERT INTO users (telegram_id) VALUES (1)")
+        assert remote.closed
+        with pytest.raises(aiosqlite.WriterClosedError):
+            await bot_module.get_writer()
+        assert bot_module._db_writer is remote
+
+    asyncio.run(run())
+
+
+def test_writes_from_another_process(memory_db):
+    context = multiprocessing.get_context("spawn")
+
+    async def run():
+        server = aiosqlite.WriterServer(await bot_module.get_writer())
+        processes = []
+        for start in (100, 200):
+            parent_conn, child_conn = context.Pipe()
+            process = context.Process(
+                target=remote_worker,
+                args=(child_conn, bot_module.DB_PATH, range(start, start + 50)),
+            )
+            process.start()
+            child_conn.close()
+            server.serve(parent_conn)
+            processes.append(process)
+        for process in processes:
+            await asyncio.to_thread(process.join, 30)
+            assert process.exitcode == 0
+
+        db = await bot_module.get_db()
+        try:
+            row = await db.execute_fetchone("SELECT COUNT(*) FROM users")
+        finally:
+            await db.close()
+        return row[0]
+
+    assert asyncio.run(run()) == 100